@@ -0,0 +1,25 @@
+"""Helpers for reading the forecast archives written by `scripts/backtest.py`"""
+
+import glob
+
+import xarray as xr
+
+
+def open_backtest_archive(path: str | list[str]) -> xr.Dataset:
+    """Open a backtest archive as a single lazy dataset
+
+    Args:
+        path: Path to a forecast zarr store, a glob of `part_*.zarr` stores, or a list of stores
+    """
+    if isinstance(path, str):
+        paths = sorted(glob.glob(path))
+    else:
+        paths = list(path)
+
+    if len(paths) == 0:
+        raise FileNotFoundError(f"No forecast stores found at {path}")
+    if len(paths) == 1:
+        return xr.open_zarr(paths[0])
+
+    ds = xr.concat([xr.open_zarr(p) for p in paths], dim="init_time")
+    return ds.sortby("init_time")
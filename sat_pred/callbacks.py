@@ -0,0 +1,548 @@
+"""Lightning callbacks used during training"""
+
+import json
+import os
+import time
+import warnings
+from collections import deque
+from functools import wraps
+
+import numpy as np
+import torch
+import lightning.pytorch as pl
+from lightning.pytorch.utilities import rank_zero_info, rank_zero_warn
+
+
+PHASES = [
+    "data_wait",
+    "host_to_device",
+    "forward",
+    "losses",
+    "backward",
+    "optimizer_step",
+    "logging",
+]
+
+
+class StepPhaseProfiler(pl.Callback):
+
+    def __init__(
+        self,
+        window: int = 200,
+        log_every_n_steps: int = 50,
+        percentiles: list[float] = [50, 90, 99],
+        starvation_threshold: float = 0.3,
+        sync_cuda: bool = True,
+        trace_dir: str | None = None,
+        trace_start_step: int = 20,
+        trace_num_steps: int = 5,
+    ):
+        """Callback to time each phase of a training step
+
+        The phases timed are the dataloader wait, host-to-device copy, model forward, loss
+        calculation, backward, optimizer step and logging. Rolling percentiles of each phase are
+        logged to the configured logger under `step_profiler/`.
+
+        Args:
+            window: The number of recent steps used to calculate the rolling percentiles
+            log_every_n_steps: How often to log the percentiles
+            percentiles: The percentiles of each phase time to log
+            starvation_threshold: If the median fraction of the step spent waiting on the
+                dataloader is above this value the step is flagged as data-starved
+            sync_cuda: Whether to synchronize CUDA at each phase boundary. Without this the
+                timings of asynchronous GPU work are attributed to whichever phase next syncs
+            trace_dir: If set, a `torch.profiler` trace is captured and saved to this directory
+            trace_start_step: The training batch on which to start the profiler trace
+            trace_num_steps: The number of training batches to capture in the trace
+        """
+        super().__init__()
+        self.window = window
+        self.log_every_n_steps = log_every_n_steps
+        self.percentiles = percentiles
+        self.starvation_threshold = starvation_threshold
+        self.sync_cuda = sync_cuda
+        self.trace_dir = trace_dir
+        self.trace_start_step = trace_start_step
+        self.trace_num_steps = trace_num_steps
+
+        self._history = {phase: deque(maxlen=window) for phase in PHASES + ["total"]}
+        self._current = {}
+        self._marks = {}
+        self._last_batch_end = None
+        self._batch_start = None
+        self._num_batches = 0
+        self._starvation_warned = False
+        self._profiler = None
+        self._hook_handles = []
+        self._original_methods = {}
+        self._device = None
+
+    def _now(self) -> float:
+        if self.sync_cuda and self._device is not None and self._device.type == "cuda":
+            torch.cuda.synchronize(self._device)
+        return time.perf_counter()
+
+    def _start(self, phase: str) -> None:
+        self._marks[phase] = self._now()
+
+    def _stop(self, phase: str) -> None:
+        if phase in self._marks:
+            elapsed = self._now() - self._marks.pop(phase)
+            self._current[phase] = self._current.get(phase, 0.0) + elapsed
+
+    def _timed(self, phase: str, func, condition=None):
+        """Wrap a function so that its run time is added to the given phase
+
+        If a condition is given, the time is only counted when it returns True.
+        """
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if condition is not None and not condition():
+                return func(*args, **kwargs)
+            self._start(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._stop(phase)
+
+        return wrapper
+
+    def setup(self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str) -> None:
+        """Instrument the parts of the step which have no callback hook"""
+        if stage != "fit":
+            return
+
+        # The instance attributes shadow the class methods, so lightning calls the wrapped versions.
+        # Some methods may already be instance attributes, e.g. the compiled loss calculation, so
+        # these are kept to be restored in teardown. The batch transfer and loss calculation are
+        # also run in validation, which isn't part of the training step
+        self._original_methods = {}
+        in_training = lambda: pl_module.training  # noqa: E731
+        for method_name, phase, condition in [
+            ("transfer_batch_to_device", "host_to_device", in_training),
+            ("_calculate_loss_terms", "losses", in_training),
+            ("_training_accumulate_log", "logging", None),
+        ]:
+            if hasattr(pl_module, method_name):
+                self._original_methods[method_name] = pl_module.__dict__.get(method_name)
+                setattr(
+                    pl_module,
+                    method_name,
+                    self._timed(phase, getattr(pl_module, method_name), condition),
+                )
+
+        self._hook_handles = [
+            pl_module.model.register_forward_pre_hook(
+                lambda *_: self._start("forward") if pl_module.training else None
+            ),
+            pl_module.model.register_forward_hook(
+                lambda *_: self._stop("forward") if pl_module.training else None
+            ),
+        ]
+
+    def teardown(self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str) -> None:
+        """Remove the instrumentation added in setup"""
+        if stage != "fit":
+            return
+
+        for method_name, original in self._original_methods.items():
+            if original is not None:
+                setattr(pl_module, method_name, original)
+            elif method_name in pl_module.__dict__:
+                delattr(pl_module, method_name)
+        self._original_methods = {}
+
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+        self._stop_trace()
+
+    def on_train_epoch_start(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        # Don't count the time between epochs (validation, checkpointing) as data wait
+        self._last_batch_end = self._now()
+
+    def on_train_batch_start(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, batch, batch_idx: int
+    ) -> None:
+        self._device = pl_module.device
+        batch_start = self._now()
+
+        # The host-to-device copy happens after the batch is fetched and before this hook, so it
+        # is measured separately and removed from the wait time
+        if self._last_batch_end is not None:
+            wait = batch_start - self._last_batch_end - self._current.get("host_to_device", 0.0)
+            self._current["data_wait"] = max(wait, 0.0)
+
+        self._batch_start = batch_start
+        self._maybe_start_trace()
+
+    def on_before_backward(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, loss: torch.Tensor
+    ) -> None:
+        self._start("backward")
+
+    def on_after_backward(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        self._stop("backward")
+
+    def on_before_optimizer_step(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, optimizer
+    ) -> None:
+        self._start("optimizer_step")
+
+    def on_train_batch_end(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, outputs, batch, batch_idx: int
+    ) -> None:
+        self._stop("optimizer_step")
+
+        batch_end = self._now()
+
+        # Steps skipped by the module (e.g. NaN loss) never reach backward or the optimizer
+        self._marks = {}
+        self._current["total"] = (
+            batch_end - self._batch_start + self._current.get("data_wait", 0.0)
+            + self._current.get("host_to_device", 0.0)
+        )
+
+        for phase in PHASES + ["total"]:
+            self._history[phase].append(self._current.get(phase, 0.0))
+
+        self._current = {}
+        self._last_batch_end = batch_end
+        self._num_batches += 1
+
+        if self._profiler is not None:
+            self._profiler.step()
+            if self._num_batches >= self.trace_start_step + self.trace_num_steps:
+                self._stop_trace()
+
+        if self._num_batches % self.log_every_n_steps == 0:
+            self._log_percentiles(pl_module)
+
+    def _log_percentiles(self, pl_module: pl.LightningModule) -> None:
+        """Log rolling percentiles of each phase and flag dataloader starvation"""
+
+        metrics = {}
+        for phase, times in self._history.items():
+            if len(times) == 0:
+                continue
+            values = np.percentile(np.array(times) * 1000, self.percentiles)
+            for p, v in zip(self.percentiles, values):
+                metrics[f"step_profiler/{phase}_ms_p{p:g}"] = v
+
+        total = np.array(self._history["total"])
+        data_wait = np.array(self._history["data_wait"])
+        data_fraction = float(np.median(data_wait / np.maximum(total, 1e-9)))
+        starved = data_fraction > self.starvation_threshold
+
+        metrics["step_profiler/data_wait_fraction"] = data_fraction
+        metrics["step_profiler/data_starved"] = float(starved)
+
+        if starved and not self._starvation_warned:
+            rank_zero_warn(
+                f"Training is data-starved: {data_fraction:.0%} of the median step is spent "
+                "waiting on the dataloader. Consider increasing `num_workers` or "
+                "`prefetch_factor` in the datamodule config."
+            )
+            self._starvation_warned = True
+
+        pl_module.log_dict(metrics, on_step=True, on_epoch=False)
+
+    def _maybe_start_trace(self) -> None:
+        if self.trace_dir is None or self._profiler is not None:
+            return
+        if self._num_batches != self.trace_start_step:
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=0, warmup=0, active=self.trace_num_steps),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True,
+        )
+        self._profiler.start()
+
+    def _stop_trace(self) -> None:
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+            # Make sure we don't start tracing again
+            self.trace_dir = None
+
+
+def _named_tensors(x, name: str) -> dict[str, torch.Tensor]:
+    """Flatten nested tuples and lists of tensors into a dictionary of named tensors"""
+    if isinstance(x, torch.Tensor):
+        return {name: x}
+    elif isinstance(x, (tuple, list)):
+        tensors = {}
+        for i, v in enumerate(x):
+            tensors.update(_named_tensors(v, f"{name}.{i}"))
+        return tensors
+    return {}
+
+
+def _tensor_stats(x: torch.Tensor) -> dict:
+    """Summary statistics of a tensor, with the min, max and mean over the finite values"""
+    x = x.detach().float()
+    finite = x[torch.isfinite(x)]
+    stats = {
+        "shape": list(x.shape),
+        "num_nan": int(torch.isnan(x).sum()),
+        "num_inf": int(torch.isinf(x).sum()),
+    }
+    if finite.numel() > 0:
+        stats.update(
+            min=float(finite.min()),
+            max=float(finite.max()),
+            mean=float(finite.mean()),
+            std=float(finite.std()) if finite.numel() > 1 else 0.0,
+        )
+    return stats
+
+
+class NumericsGuard(pl.Callback):
+
+    def __init__(
+        self,
+        every_n_steps: int = 100,
+        sample_fraction: float | None = None,
+        check_inputs: bool = True,
+        check_gradients: bool = True,
+        dump_dir: str = "numerics_guard",
+        action: str = "warn",
+        seed: int = 0,
+    ):
+        """Callback to check the training inputs, outputs, loss and gradients for NaNs and infs
+
+        On the checked steps the number of non-finite values in each tensor is counted on the
+        device and copied to the host in a single transfer, so the check only synchronises once.
+        Steps the module skips because the loss is NaN, e.g. batches with no valid targets, are
+        expected and not flagged. With 16-bit mixed precision the gradient scaler skips steps
+        with non-finite gradients, so the gradients are not checked.
+
+        When non-finite values are found, the t0 times of the batch (if the datamodule can
+        record them) and the statistics of each tensor are saved as JSON to `dump_dir`.
+
+        With multiple devices every device checks the same steps, and the result of each check
+        is reduced over the devices, so with `action="raise"` all the devices raise together
+        rather than the others waiting for the one which raised. The device which found the
+        values saves the report and warns.
+
+        Args:
+            every_n_steps: Check every n-th training batch, and the gradients on every n-th
+                optimizer step
+            sample_fraction: If set, each batch is instead checked with this probability. The
+                checked batches are drawn from `seed`, so they are the same on every device
+            check_inputs: Whether to check the input and target batch. Disable this if the data
+                is loaded without `nan_to_num`
+            check_gradients: Whether to check the gradients before the optimizer step
+            dump_dir: The directory to save the batch t0 times and tensor statistics to
+            action: What to do when non-finite values are found. "warn" or "raise"
+            seed: The random seed used to choose the checked batches with `sample_fraction`
+        """
+        super().__init__()
+        if action not in ["warn", "raise"]:
+            raise ValueError(f"Unknown action: {action}")
+
+        self.every_n_steps = every_n_steps
+        self.sample_fraction = sample_fraction
+        self.check_inputs = check_inputs
+        self.check_gradients = check_gradients
+        self.dump_dir = dump_dir
+        self.action = action
+
+        self.seed = seed
+        self._active = False
+        self._outputs = None
+        self._hook_handle = None
+        self._check_time = 0.0
+        self._num_checks = 0
+
+    def setup(self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str) -> None:
+        if stage != "fit":
+            return
+
+        # Record the training batch indices so the t0 times of a flagged batch can be found
+        if hasattr(trainer.datamodule, "record_train_indices"):
+            trainer.datamodule.record_train_indices = True
+
+        if trainer.precision.startswith("16"):
+            self.check_gradients = False
+
+        def hook(module, args, output):
+            if self._active and pl_module.training:
+                self._outputs = output
+
+        self._hook_handle = pl_module.model.register_forward_hook(hook)
+
+    def teardown(self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str) -> None:
+        if stage != "fit":
+            return
+
+        if self._hook_handle is not None:
+            self._hook_handle.remove()
+            self._hook_handle = None
+
+        if self._num_checks > 0:
+            rank_zero_info(
+                f"Numerics guard: {self._num_checks} checks, "
+                f"{1e3 * self._check_time / self._num_checks:.2f} ms per check"
+            )
+
+    def _should_check(self, epoch: int, step: int) -> bool:
+        if self.sample_fraction is not None:
+            # Seeded by the step so every device makes the same choice
+            rng = np.random.default_rng([self.seed, epoch, step])
+            return rng.random() < self.sample_fraction
+        return step % self.every_n_steps == 0
+
+    def _found_on_any_device(self, trainer: pl.Trainer, found: bool) -> bool:
+        """Reduce the result of a check over all the devices"""
+        return trainer.strategy.reduce_boolean_decision(found, all=False)
+
+    def _check(self, tensors: dict[str, torch.Tensor]) -> dict[str, int]:
+        """Count the non-finite values in each tensor with a single device-to-host transfer"""
+        start = time.perf_counter()
+        counts = torch.stack([(~torch.isfinite(t.detach())).sum() for t in tensors.values()])
+        counts = dict(zip(tensors, counts.tolist()))
+        self._check_time += time.perf_counter() - start
+        self._num_checks += 1
+        return counts
+
+    def _batch_t0_times(self, trainer: pl.Trainer, batch_idx: int) -> list[str] | None:
+        dataloader = trainer.train_dataloader
+        sampler = getattr(dataloader, "sampler", None)
+        dataset = getattr(dataloader, "dataset", None)
+        if not hasattr(sampler, "batch_indices") or not hasattr(dataset, "t0_times"):
+            return None
+        indices = sampler.batch_indices(batch_idx, dataloader.batch_size)
+        return [str(t) for t in dataset.t0_times[indices]]
+
+    def _report(
+        self,
+        trainer: pl.Trainer,
+        counts: dict[str, int],
+        tensors: dict[str, torch.Tensor],
+        batch_idx: int | None = None,
+    ) -> str:
+        """Save the batch t0 times and tensor statistics and warn
+
+        Returns:
+            The warning message
+        """
+        bad = {k: v for k, v in counts.items() if v > 0}
+        report = {
+            "epoch": trainer.current_epoch,
+            "global_step": trainer.global_step,
+            "batch_idx": batch_idx,
+            "t0_times": None if batch_idx is None else self._batch_t0_times(trainer, batch_idx),
+            "non_finite_counts": bad,
+            "stats": {k: _tensor_stats(v) for k, v in tensors.items()},
+        }
+
+        os.makedirs(self.dump_dir, exist_ok=True)
+        path = f"{self.dump_dir}/rank={trainer.global_rank}-step={trainer.global_step}.json"
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        message = (
+            f"Non-finite values on rank {trainer.global_rank} at step {trainer.global_step}: "
+            f"{bad}. Saved to {path}"
+        )
+        warnings.warn(message)
+        return message
+
+    def _handle(
+        self,
+        trainer: pl.Trainer,
+        counts: dict[str, int],
+        tensors: dict[str, torch.Tensor],
+        batch_idx: int | None = None,
+    ) -> None:
+        """Report the non-finite values found on this device and raise on every device
+
+        This must be called on every device for each check, since the result is reduced over
+        the devices.
+        """
+        found = any(v > 0 for v in counts.values())
+        message = self._report(trainer, counts, tensors, batch_idx) if found else None
+
+        if self.action == "raise" and self._found_on_any_device(trainer, found):
+            raise FloatingPointError(
+                message or f"Non-finite values on another device at step {trainer.global_step}"
+            )
+
+    def on_train_batch_start(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, batch, batch_idx: int
+    ) -> None:
+        self._active = self._should_check(trainer.current_epoch, batch_idx)
+        self._outputs = None
+
+    def on_train_batch_end(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, outputs, batch, batch_idx: int
+    ) -> None:
+        if not self._active:
+            return
+        self._active = False
+
+        tensors = {}
+        if self.check_inputs:
+            tensors.update(_named_tensors(batch, "batch"))
+        tensors.update(_named_tensors(self._outputs, "y_hat"))
+        self._outputs = None
+
+        # Steps skipped by the module return no loss
+        loss = outputs["loss"] if isinstance(outputs, dict) else outputs
+        if isinstance(loss, torch.Tensor):
+            tensors["loss"] = loss
+
+        # Every device takes part in the reduction, even if it has nothing to check
+        counts = self._check(tensors) if tensors else {}
+        self._handle(trainer, counts, tensors, batch_idx)
+
+    def on_before_optimizer_step(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, optimizer
+    ) -> None:
+        if not self.check_gradients or trainer.global_step % self.every_n_steps != 0:
+            return
+
+        grads = {
+            f"grad.{name}": p.grad for name, p in pl_module.named_parameters()
+            if p.grad is not None
+        }
+        counts = {}
+        if grads:
+            # The norm of a tensor is only finite if all its values are, so the check is done on
+            # the norms which are computed together
+            norms = torch._foreach_norm(list(grads.values()))
+            counts = self._check(dict(zip(grads, norms)))
+        self._handle(trainer, counts, {k: v for k, v in grads.items() if counts[k] > 0})
+
+
+class ElapsedTimeLogger(pl.Callback):
+
+    def __init__(self):
+        """Callback to log the training wall time in minutes at the end of each validation
+
+        This lets the validation losses be compared against time as well as steps, e.g. to find
+        the time taken to reach a target loss. The time spent in the sanity check is excluded.
+        """
+        super().__init__()
+        self._start = None
+
+    def on_train_start(self, trainer: pl.Trainer, pl_module: pl.LightningModule) -> None:
+        self._start = time.perf_counter()
+
+    def on_validation_epoch_end(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule
+    ) -> None:
+        if self._start is None or trainer.sanity_checking:
+            return
+        elapsed_mins = (time.perf_counter() - self._start) / 60
+        pl_module.log("elapsed_mins", elapsed_mins, on_step=False, on_epoch=True)
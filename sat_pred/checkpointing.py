@@ -0,0 +1,194 @@
+"""Asynchronous checkpointing with an inference-ready export bundle
+
+Lightning writes each checkpoint on the training process, so training stalls while the model and
+optimizer states are written to disk. `HostCopyAsyncCheckpointIO` is a checkpoint IO plugin which
+copies the checkpoint to host memory and writes it from Lightning's `AsyncCheckpointIO`
+background thread. It is set in the trainer `plugins`, so the stock `ModelCheckpoint` callback
+is used unchanged.
+
+The `InferenceBundle` callback writes an inference bundle alongside the best checkpoint: the model
+weights as safetensors, optionally in float16, the model and data configs, and a manifest with
+the sha256 of each file. The bundle directory can be loaded with `sat_pred.inference.load_model`
+or `get_model_from_checkpoints`, so inference tools never need the full checkpoint.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import torch
+import yaml
+import lightning.pytorch as pl
+from lightning.pytorch.plugins.io import AsyncCheckpointIO
+from lightning_utilities.core.apply_func import apply_to_collection
+
+
+def _to_host(collection: Any) -> Any:
+    """Copy the tensors in a collection to host memory so training can continue to update them"""
+    return apply_to_collection(
+        collection, torch.Tensor, lambda t: t.detach().to("cpu", copy=True)
+    )
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_inference_bundle(
+    bundle_dir: str,
+    state_dict: dict[str, torch.Tensor],
+    model_config: dict | None = None,
+    data_config: dict | None = None,
+    dtype: torch.dtype | None = None,
+    metadata: dict | None = None,
+) -> str:
+    """Write the model weights and configs needed for inference to a directory
+
+    The bundle is written to a temporary directory and then moved into place, so a partly
+    written bundle is never read.
+
+    Args:
+        bundle_dir: The directory to write the bundle to. Any existing bundle is replaced
+        state_dict: The state dict of the training module. Only the model weights are kept
+        model_config: The training module config, saved as model_config.yaml
+        data_config: The datamodule config, saved as data_config.yaml
+        dtype: If set, the floating point weights are saved with this dtype
+        metadata: Extra information to save in the manifest, e.g. the epoch and step
+
+    Returns:
+        The sha256 of the bundle, combined from the hashes of its files
+    """
+    from safetensors.torch import save_file
+
+    weights = {
+        k.removeprefix("model."): v.contiguous()
+        for k, v in state_dict.items()
+        if k.startswith("model.")
+    }
+    if dtype is not None:
+        weights = {k: v.to(dtype) if v.is_floating_point() else v for k, v in weights.items()}
+
+    tmp_dir = f"{bundle_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    save_file(weights, f"{tmp_dir}/model.safetensors")
+    for name, config in [("model_config", model_config), ("data_config", data_config)]:
+        if config is not None:
+            with open(f"{tmp_dir}/{name}.yaml", "w") as f:
+                yaml.dump(config, f, default_flow_style=False)
+
+    files = {name: _sha256(f"{tmp_dir}/{name}") for name in sorted(os.listdir(tmp_dir))}
+    content_hash = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+    manifest = {"sha256": content_hash, "files": files, **(metadata or {})}
+    with open(f"{tmp_dir}/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.replace(tmp_dir, bundle_dir)
+    return content_hash
+
+
+class HostCopyAsyncCheckpointIO(AsyncCheckpointIO):
+    """AsyncCheckpointIO which copies the checkpoint to host memory before writing it
+
+    The checkpoint dict references the live model and optimizer tensors, so without a copy the
+    background thread could write tensors which training has already updated. Only the copy is
+    done on the training process. The checkpoints are written in order by a single thread, and
+    any error from a write is raised on the next save.
+    """
+
+    def save_checkpoint(
+        self, checkpoint: dict[str, Any], path: str, storage_options: Any | None = None
+    ) -> None:
+        super().save_checkpoint(_to_host(checkpoint), path, storage_options=storage_options)
+
+
+class InferenceBundle(pl.Callback):
+
+    def __init__(self, dirname: str = "inference", dtype: str | None = None):
+        """Callback to write an inference bundle of the best checkpoint from a background thread
+
+        When the `ModelCheckpoint` callback saves a new best checkpoint, the model weights are
+        copied to host memory and the bundle is written to `dirname` inside the checkpoint
+        directory. The model and data configs saved in the bundle are set with
+        `set_bundle_configs()`.
+
+        Args:
+            dirname: The name of the bundle directory inside the checkpoint directory
+            dtype: If set, e.g. "float16", the bundle weights are saved with this dtype
+        """
+        super().__init__()
+        self.dirname = dirname
+        self.dtype = None if dtype is None else getattr(torch, dtype)
+
+        self.model_config = None
+        self.data_config = None
+
+        self._best_model_path = None
+        self._executor = None
+        self._pending: list[Future] = []
+
+    def set_bundle_configs(self, model_config: dict, data_config: dict) -> None:
+        """Set the model and data configs saved in the inference bundle"""
+        self.model_config = model_config
+        self.data_config = data_config
+
+    def wait(self) -> None:
+        """Wait for the pending bundle writes to finish, raising any errors"""
+        while self._pending:
+            self._pending.pop(0).result()
+
+    def on_save_checkpoint(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, checkpoint: dict[str, Any]
+    ) -> None:
+        # ModelCheckpoint updates the best model path before saving the new best checkpoint
+        checkpoint_callback = trainer.checkpoint_callback
+        if not trainer.is_global_zero or checkpoint_callback is None:
+            return
+        best_model_path = checkpoint_callback.best_model_path
+        if not best_model_path or best_model_path == self._best_model_path:
+            return
+        self._best_model_path = best_model_path
+
+        state_dict = _to_host(
+            {k: v for k, v in checkpoint["state_dict"].items() if k.startswith("model.")}
+        )
+
+        # Raise any errors from earlier writes, and only keep one write in flight
+        self.wait()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bundle")
+        self._pending.append(
+            self._executor.submit(
+                write_inference_bundle,
+                f"{checkpoint_callback.dirpath}/{self.dirname}",
+                state_dict,
+                model_config=self.model_config,
+                data_config=self.data_config,
+                dtype=self.dtype,
+                metadata={
+                    "checkpoint": os.path.basename(best_model_path),
+                    "epoch": checkpoint["epoch"],
+                    "global_step": checkpoint["global_step"],
+                },
+            )
+        )
+
+    def on_exception(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, exception: BaseException
+    ) -> None:
+        self.wait()
+
+    def teardown(self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str) -> None:
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
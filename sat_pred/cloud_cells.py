@@ -0,0 +1,127 @@
+"""Low-resolution index of the cloud structure used to weight random training crops
+
+Weighting the random crops by their cloud structure needs a score for each candidate crop before
+any data is loaded, since reading a frame of each candidate would decode more chunks than the
+crop itself. The index stores the mean and mean square of one channel in coarse cells of the
+grid at every timestamp, from which the spatial standard deviation within any crop is estimated
+from the cells it overlaps. The index is built once with `scripts/build_cloud_cell_index.py`
+and memory-mapped when loaded, so it is shared between the dataloader workers.
+"""
+
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def compute_cloud_cells(
+    ds: xr.Dataset, channel: int = 8, cell_size: int = 32, stride: int = 4
+) -> xr.Dataset:
+    """Compute the mean and mean square of a channel in coarse cells at each timestamp
+
+    Args:
+        ds: The satellite dataset with a `data` variable
+        channel: The channel index to use
+        cell_size: The width of the cells in pixels. This must be a multiple of the stride
+        stride: The spacing in pixels of the grid of pixels used within each cell
+
+    Returns:
+        Dataset of the `mean` and `mean_sq` of each cell, with dimensions (time, y_cell, x_cell)
+    """
+    if cell_size % stride != 0:
+        raise ValueError("cell_size must be a multiple of stride")
+
+    frames = ds.data.isel(
+        variable=channel,
+        x_geostationary=slice(None, None, stride),
+        y_geostationary=slice(None, None, stride),
+    ).transpose("time", "y_geostationary", "x_geostationary")
+
+    # Cells at the edges of the grid are padded with NaNs, which are skipped in the mean
+    window = cell_size // stride
+    coarsen = dict(y_geostationary=window, x_geostationary=window, boundary="pad")
+    cells = xr.Dataset(
+        {
+            "mean": frames.coarsen(**coarsen).mean(),
+            "mean_sq": (frames**2).coarsen(**coarsen).mean(),
+        }
+    )
+    cells = cells.rename(y_geostationary="y_cell", x_geostationary="x_cell")
+    cells = cells.drop_vars(["y_geostationary", "x_geostationary"], errors="ignore")
+    cells.attrs = {"cell_size": cell_size, "channel": channel}
+    return cells.astype(np.float32).compute()
+
+
+def save_cloud_cell_index(cells: xr.Dataset, path: str) -> None:
+    """Save the cloud cell index as a directory of .npy files"""
+    os.makedirs(path, exist_ok=True)
+    np.save(f"{path}/times.npy", cells.time.values.astype("datetime64[ns]"))
+    np.save(f"{path}/mean.npy", cells["mean"].values)
+    np.save(f"{path}/mean_sq.npy", cells["mean_sq"].values)
+    with open(f"{path}/attrs.json", "w") as f:
+        json.dump(cells.attrs, f)
+
+
+class CloudCellIndex:
+    def __init__(self, path: str):
+        """Cloud cell index built by `scripts/build_cloud_cell_index.py`
+
+        The arrays are memory-mapped on first use, and are not pickled with the index so each
+        dataloader worker maps them itself.
+
+        Args:
+            path: The directory of the index
+        """
+        self.path = path
+        with open(f"{path}/attrs.json") as f:
+            self.cell_size = json.load(f)["cell_size"]
+        self.times = pd.DatetimeIndex(np.load(f"{path}/times.npy"))
+        self._arrays = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def _cells(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = (
+                np.load(f"{self.path}/mean.npy", mmap_mode="r"),
+                np.load(f"{self.path}/mean_sq.npy", mmap_mode="r"),
+            )
+        return self._arrays
+
+    def crop_std(
+        self, t0: pd.Timestamp, origins: list[tuple[int, int]], crop_size: tuple[int, int]
+    ) -> np.ndarray:
+        """Estimate the spatial standard deviation of the channel within each crop at t0
+
+        Args:
+            t0: The timestamp
+            origins: The (y, x) pixel origin of each crop
+            crop_size: The (height, width) of the crops in pixels
+
+        Returns:
+            The standard deviation within each crop. NaN if t0 isn't in the index or the crop
+            has no valid values
+        """
+        i = self.times.get_indexer([pd.Timestamp(t0)])[0]
+        if i < 0:
+            return np.full(len(origins), np.nan)
+
+        means, mean_sqs = self._cells()
+        mean, mean_sq = np.asarray(means[i]), np.asarray(mean_sqs[i])
+
+        (h, w), c = crop_size, self.cell_size
+        stds = []
+        for y, x in origins:
+            cells = np.s_[y // c:-(-(y + h) // c), x // c:-(-(x + w) // c)]
+            with warnings.catch_warnings():
+                # Crops with no valid values raise an all-NaN warning
+                warnings.simplefilter("ignore", RuntimeWarning)
+                variance = np.nanmean(mean_sq[cells]) - np.nanmean(mean[cells]) ** 2
+            stds.append(np.sqrt(max(variance, 0)) if np.isfinite(variance) else np.nan)
+        return np.array(stds)
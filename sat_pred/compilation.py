@@ -0,0 +1,57 @@
+"""Helpers for compiling models and losses with torch.compile"""
+
+import os
+
+import torch
+
+
+def enable_compile_cache(cache_dir: str) -> None:
+    """Persist the torch.compile caches to a directory so restarts reuse compiled artifacts
+
+    This must be called before the first compilation.
+
+    Args:
+        cache_dir: The directory to store the inductor, autograd and triton caches in
+    """
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    os.environ["TORCHINDUCTOR_AUTOGRAD_CACHE"] = "1"
+
+    # The inductor config may already have been imported, in which case it won't read the
+    # environment variables above
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autograd_cache"):
+        inductor_config.autograd_cache = True
+
+
+def compile_model(
+    model: torch.nn.Module,
+    cache_dir: str | None = None,
+    **compile_kwargs,
+) -> torch.nn.Module:
+    """Compile a model in place
+
+    The model is compiled in place so its state dict keys are unchanged and checkpoints remain
+    compatible with the eager model.
+
+    Args:
+        model: The model to compile
+        cache_dir: If set, the compile caches are persisted to this directory
+        compile_kwargs: Keyword arguments passed to `torch.compile`
+    """
+    if cache_dir is not None:
+        enable_compile_cache(cache_dir)
+    model.compile(**compile_kwargs)
+    return model
+
+
+def mark_batch_dynamic(x: torch.Tensor) -> torch.Tensor:
+    """Mark the batch dimension as dynamic to avoid recompiling for partial or plot batches"""
+    torch._dynamo.maybe_mark_dynamic(x, 0)
+    return x
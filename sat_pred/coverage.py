@@ -0,0 +1,125 @@
+"""Per-timestamp data coverage index used to skip samples with little or no valid data"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+COVERAGE_COLUMN = "valid_fraction"
+
+
+def compute_coverage(ds: xr.Dataset) -> pd.Series:
+    """Compute the fraction of valid (non-NaN) pixels at each timestamp
+
+    Args:
+        ds: The satellite dataset with a `data` variable
+
+    Returns:
+        Series of the valid fraction indexed by time
+    """
+    valid_fraction = (
+        ds.data.notnull()
+        .mean(dim=[d for d in ds.data.dims if d != "time"])
+        .compute()
+    )
+    return pd.Series(
+        valid_fraction.values.astype(np.float32),
+        index=pd.DatetimeIndex(valid_fraction.time.values, name="time"),
+        name=COVERAGE_COLUMN,
+    )
+
+
+def save_coverage_index(coverage: pd.Series, path: str) -> None:
+    """Save the coverage index to parquet"""
+    coverage.to_frame(COVERAGE_COLUMN).to_parquet(path)
+
+
+def load_coverage_index(path: str) -> pd.Series:
+    """Load the coverage index from parquet"""
+    coverage = pd.read_parquet(path)[COVERAGE_COLUMN]
+    return coverage[~coverage.index.duplicated()].sort_index()
+
+
+@dataclass
+class CoverageFilterReport:
+    """Summary of the samples removed by filtering on coverage"""
+
+    num_samples: int
+    num_kept: int
+    num_empty: int
+
+    @property
+    def num_skipped(self) -> int:
+        return self.num_samples - self.num_kept
+
+    def __str__(self) -> str:
+        skipped_fraction = self.num_skipped / max(self.num_samples, 1)
+        return (
+            f"Coverage filter kept {self.num_kept}/{self.num_samples} samples. "
+            f"Skipped {self.num_skipped} ({skipped_fraction:.1%} of sample loads and model "
+            f"steps), of which {self.num_empty} had no valid data at all and would have produced "
+            "a NaN loss after a full forward pass"
+        )
+
+
+def sample_coverage(
+    t0_times: pd.DatetimeIndex,
+    coverage: pd.Series,
+    start_mins: int,
+    end_mins: int,
+    sample_freq_mins: int,
+) -> np.ndarray:
+    """Find the mean coverage of the frames in a window around each t0
+
+    Args:
+        t0_times: The t0 times of the samples
+        coverage: The coverage index
+        start_mins: The offset in minutes from t0 of the first frame in the window
+        end_mins: The offset in minutes from t0 of the last frame in the window
+        sample_freq_mins: The time between frames
+
+    Returns:
+        Array of the mean valid fraction of each sample. Timestamps missing from the index are
+        treated as having zero coverage
+    """
+    offsets = pd.timedelta_range(
+        f"{start_mins}min", f"{end_mins}min", freq=f"{sample_freq_mins}min"
+    )
+    frame_coverage = np.stack(
+        [coverage.reindex(t0_times + offset).fillna(0).values for offset in offsets]
+    )
+    return frame_coverage.mean(axis=0)
+
+
+def filter_t0_times(
+    t0_times: pd.DatetimeIndex,
+    coverage: pd.Series,
+    min_coverage: float,
+    start_mins: int,
+    end_mins: int,
+    sample_freq_mins: int,
+) -> tuple[pd.DatetimeIndex, CoverageFilterReport]:
+    """Remove t0 times whose frames in the given window have too little valid data
+
+    Args:
+        t0_times: The t0 times of the samples
+        coverage: The coverage index
+        min_coverage: Samples with a mean valid fraction below this are removed. Samples with no
+            valid data are always removed
+        start_mins: The offset in minutes from t0 of the first frame in the window
+        end_mins: The offset in minutes from t0 of the last frame in the window
+        sample_freq_mins: The time between frames
+    """
+    t0_times = pd.DatetimeIndex(t0_times)
+    mean_coverage = sample_coverage(t0_times, coverage, start_mins, end_mins, sample_freq_mins)
+
+    keep = (mean_coverage > 0) & (mean_coverage >= min_coverage)
+
+    report = CoverageFilterReport(
+        num_samples=len(t0_times),
+        num_kept=int(keep.sum()),
+        num_empty=int((mean_coverage == 0).sum()),
+    )
+    return t0_times[keep], report
@@ -0,0 +1,729 @@
+"""Extensions to the cloudcasting satellite datasets and datamodule used for training"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from cloudcasting.dataset import SatelliteDataModule, SatelliteDataset
+
+from sat_pred.cloud_cells import CloudCellIndex
+from sat_pred.coverage import filter_t0_times, load_coverage_index, sample_coverage
+from sat_pred.dataset_index import IndexedDatasetMixin
+from sat_pred.importance import ImportanceSampler, load_variability_index
+from sat_pred.latent_cache import LatentCacheDataset
+from sat_pred.resident import ResidentDataset
+from sat_pred.samplers import (
+    BalancedDistributedSampler,
+    ChunkBlockShuffleSampler,
+    RecordingSampler,
+    time_chunk_ids,
+)
+from sat_pred.transport import (
+    EncodedBatch,
+    SharedSlotRing,
+    SlotCollate,
+    StagedBatch,
+    TransportDataLoader,
+    TransportStager,
+)
+
+
+class IndexedSatelliteDataset(IndexedDatasetMixin, SatelliteDataset):
+    def __init__(
+        self,
+        zarr_path: list[str] | str,
+        start_time: str | None,
+        end_time: str | None,
+        history_mins: int,
+        forecast_mins: int,
+        sample_freq_mins: int,
+        nan_to_num: bool = False,
+        index_cache_dir: str | None = None,
+    ):
+        """A SatelliteDataset which loads its time index from the dataset index cache
+
+        The satellite data is only opened to build the index. It is dropped when the dataset is
+        pickled and reopened lazily in each dataloader worker.
+
+        Args:
+            zarr_path: Path to the satellite data. Can be a string or list
+            start_time: The satellite data is filtered to exclude timestamps before this
+            end_time: The satellite data is filtered to exclude timestamps after this
+            history_mins: How many minutes of history will be used as input features
+            forecast_mins: How many minutes of future will be used as target features
+            sample_freq_mins: The sample frequency to use for the satellite data
+            nan_to_num: Whether to convert NaNs to -1.
+            index_cache_dir: The directory of the dataset index cache. If None the index is built
+                without caching
+        """
+        # The SatelliteDataset init is replaced since it opens the data and builds the index
+        self._init_index(
+            zarr_path,
+            start_time,
+            end_time,
+            history_mins,
+            forecast_mins,
+            sample_freq_mins,
+            index_cache_dir=index_cache_dir,
+        )
+        self.history_mins = history_mins
+        self.forecast_mins = forecast_mins
+        self.sample_freq_mins = sample_freq_mins
+        self.nan_to_num = nan_to_num
+
+
+class CropSatelliteDataset(IndexedSatelliteDataset):
+    def __init__(
+        self,
+        zarr_path: list[str] | str,
+        start_time: str | None,
+        end_time: str | None,
+        history_mins: int,
+        forecast_mins: int,
+        sample_freq_mins: int,
+        nan_to_num: bool = False,
+        index_cache_dir: str | None = None,
+        crop_size: tuple[int, int] = (128, 128),
+        align: int = 4,
+        cloud_weighted: bool = False,
+        cloud_index_path: str | None = None,
+        num_candidates: int = 4,
+    ):
+        """A torch Dataset which returns random fixed-size spatial crops of the satellite data
+
+        The crop is selected before any data is loaded so only the zarr chunks which overlap the
+        crop are read and decoded. The crops are drawn from a generator in each dataloader worker
+        seeded from the torch seed of the worker, so they follow `seed_everything`.
+
+        Args:
+            zarr_path: Path to the satellite data. Can be a string or list
+            start_time: The satellite data is filtered to exclude timestamps before this
+            end_time: The satellite data is filtered to exclude timestamps after this
+            history_mins: How many minutes of history will be used as input features
+            forecast_mins: How many minutes of future will be used as target features
+            sample_freq_mins: The sample frequency to use for the satellite data
+            nan_to_num: Whether to convert NaNs to -1.
+            index_cache_dir: The directory of the dataset index cache. If None the index is built
+                without caching
+            crop_size: The (height, width) of the crops in pixels
+            align: The crop origin is aligned to a multiple of this many pixels. This should be
+                the total downsampling factor of the model
+            cloud_weighted: Whether to favour crops with more cloud structure. A few candidate
+                crops are drawn and one is chosen with probability proportional to the spatial
+                standard deviation of a channel at t0 within the crop, estimated from the cloud
+                cell index so no extra data is read
+            cloud_index_path: Path to a cloud cell index built with
+                `scripts/build_cloud_cell_index.py`. Required when using cloud weighting
+            num_candidates: The number of candidate crops drawn when using cloud weighting
+        """
+        super().__init__(
+            zarr_path=zarr_path,
+            start_time=start_time,
+            end_time=end_time,
+            history_mins=history_mins,
+            forecast_mins=forecast_mins,
+            sample_freq_mins=sample_freq_mins,
+            nan_to_num=nan_to_num,
+            index_cache_dir=index_cache_dir,
+        )
+
+        self.crop_size = tuple(crop_size)
+        self.align = align
+        if cloud_weighted and cloud_index_path is None:
+            raise ValueError("Cloud weighted crops need a cloud cell index")
+
+        self.cloud_weighted = cloud_weighted
+        self.cloud_index = CloudCellIndex(cloud_index_path) if cloud_weighted else None
+        self.num_candidates = num_candidates
+        self._rng = None
+
+        self.full_size = (self.ds.sizes["y_geostationary"], self.ds.sizes["x_geostationary"])
+        assert all(c <= s for c, s in zip(self.crop_size, self.full_size)), (
+            f"Crop size {self.crop_size} larger than domain {self.full_size}"
+        )
+
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        # Each worker creates its own generator from its own seed
+        state["_rng"] = None
+        return state
+
+    @property
+    def rng(self) -> np.random.Generator:
+        if self._rng is None:
+            self._rng = np.random.default_rng(torch.initial_seed())
+        return self._rng
+
+    def _random_origin(self, rng: np.random.Generator) -> tuple[int, int]:
+        """Draw a random aligned crop origin"""
+        origin = []
+        for c, s in zip(self.crop_size, self.full_size):
+            num_positions = (s - c) // self.align + 1
+            origin.append(int(rng.integers(num_positions)) * self.align)
+        return tuple(origin)
+
+    def _crop_slices(self, origin: tuple[int, int]) -> dict[str, slice]:
+        (i, j), (h, w) = origin, self.crop_size
+        return dict(y_geostationary=slice(i, i + h), x_geostationary=slice(j, j + w))
+
+    def _choose_origin(self, t0: datetime) -> tuple[int, int]:
+        """Choose the crop origin, optionally weighted by the cloud structure in each crop"""
+
+        rng = self.rng
+
+        if not self.cloud_weighted:
+            return self._random_origin(rng)
+
+        candidates = [self._random_origin(rng) for _ in range(self.num_candidates)]
+
+        # Score the candidates from the low-resolution index rather than reading their data
+        scores = np.nan_to_num(self.cloud_index.crop_std(t0, candidates, self.crop_size)) + 1e-3
+        return candidates[rng.choice(len(candidates), p=scores / scores.sum())]
+
+    def _get_datetime(self, t0: datetime) -> tuple[np.ndarray, np.ndarray]:
+        origin = self._choose_origin(t0)
+
+        # Crop before loading so only the chunks overlapping the crop are read
+        ds_sel = self.ds.isel(**self._crop_slices(origin)).sel(
+            time=slice(
+                t0 - timedelta(minutes=self.history_mins),
+                t0 + timedelta(minutes=self.forecast_mins),
+            )
+        )
+
+        # Load the data eagerly so that the same chunks aren't loaded multiple times after we split
+        # further
+        ds_sel = ds_sel.compute(scheduler="single-threaded")
+
+        # Reshape to (channel, time, height, width)
+        ds_sel = ds_sel.transpose("variable", "time", "y_geostationary", "x_geostationary")
+
+        ds_input = ds_sel.sel(time=slice(None, t0))
+        ds_target = ds_sel.sel(time=slice(t0 + timedelta(minutes=self.sample_freq_mins), None))
+
+        X = ds_input.data.values
+        y = ds_target.data.values
+
+        if self.nan_to_num:
+            X = np.nan_to_num(X, nan=-1)
+            y = np.nan_to_num(y, nan=-1)
+
+        return X.astype(np.float32), y.astype(np.float32)
+
+
+class ChunkCacheSatelliteDataset(IndexedSatelliteDataset):
+    def __init__(
+        self,
+        zarr_path: list[str] | str,
+        start_time: str | None,
+        end_time: str | None,
+        history_mins: int,
+        forecast_mins: int,
+        sample_freq_mins: int,
+        nan_to_num: bool = False,
+        index_cache_dir: str | None = None,
+        cache_chunks: int = 4,
+    ):
+        """A SatelliteDataset which keeps the most recently decoded zarr time chunks in memory
+
+        Samples are built from whole zarr time chunks, which are kept in a least-recently-used
+        cache. Consecutive samples from the same chunks, e.g. from `ChunkBlockShuffleSampler`,
+        reuse the decoded chunks rather than reading and decoding them again. Each dataloader
+        worker has its own cache.
+
+        Args:
+            zarr_path: Path to the satellite data. Can be a string or list
+            start_time: The satellite data is filtered to exclude timestamps before this
+            end_time: The satellite data is filtered to exclude timestamps after this
+            history_mins: How many minutes of history will be used as input features
+            forecast_mins: How many minutes of future will be used as target features
+            sample_freq_mins: The sample frequency to use for the satellite data
+            nan_to_num: Whether to convert NaNs to -1.
+            index_cache_dir: The directory of the dataset index cache. If None the index is built
+                without caching
+            cache_chunks: The number of decoded time chunks to keep in memory
+        """
+        super().__init__(
+            zarr_path=zarr_path,
+            start_time=start_time,
+            end_time=end_time,
+            history_mins=history_mins,
+            forecast_mins=forecast_mins,
+            sample_freq_mins=sample_freq_mins,
+            nan_to_num=nan_to_num,
+            index_cache_dir=index_cache_dir,
+        )
+        self.cache_chunks = cache_chunks
+        self._chunk_bounds = None
+        self._chunk_cache = OrderedDict()
+        self.chunk_hits = 0
+        self.chunk_misses = 0
+
+    def __getstate__(self) -> dict:
+        # Each worker starts with an empty cache
+        state = super().__getstate__()
+        state["_chunk_cache"] = OrderedDict()
+        return state
+
+    @property
+    def chunk_bounds(self) -> np.ndarray:
+        """The start position of each time chunk, and the end of the last chunk"""
+        if self._chunk_bounds is None:
+            chunk_ids = time_chunk_ids(self.ds, self.ds.get_index("time"))
+            self._chunk_bounds = np.append(
+                np.nonzero(np.diff(chunk_ids, prepend=-1))[0], len(chunk_ids)
+            )
+        return self._chunk_bounds
+
+    def _load_chunk(self, chunk_id: int) -> np.ndarray:
+        """Load a time chunk as a (channel, time, height, width) array, using the cache"""
+        if chunk_id in self._chunk_cache:
+            self.chunk_hits += 1
+            self._chunk_cache.move_to_end(chunk_id)
+            return self._chunk_cache[chunk_id]
+
+        self.chunk_misses += 1
+        start, end = self.chunk_bounds[chunk_id:chunk_id + 2]
+        chunk = (
+            self.ds.data.isel(time=slice(start, end))
+            .transpose("variable", "time", "y_geostationary", "x_geostationary")
+            .values
+        )
+
+        self._chunk_cache[chunk_id] = chunk
+        if len(self._chunk_cache) > self.cache_chunks:
+            self._chunk_cache.popitem(last=False)
+        return chunk
+
+    def _get_datetime(self, t0: datetime) -> tuple[np.ndarray, np.ndarray]:
+        times = self.ds.get_index("time")
+        start, end = times.slice_locs(
+            t0 - timedelta(minutes=self.history_mins),
+            t0 + timedelta(minutes=self.forecast_mins),
+        )
+
+        # Stitch the window together from the chunks it overlaps
+        first, last = np.searchsorted(self.chunk_bounds, [start, end - 1], side="right") - 1
+        data = np.concatenate(
+            [self._load_chunk(int(c)) for c in range(first, last + 1)], axis=1
+        )
+        offset = self.chunk_bounds[first]
+        data = data[:, start - offset:end - offset]
+
+        num_history = times.get_loc(t0) + 1 - start
+        X = data[:, :num_history]
+        y = data[:, num_history:]
+
+        if self.nan_to_num:
+            X = np.nan_to_num(X, nan=-1)
+            y = np.nan_to_num(y, nan=-1)
+
+        return X.astype(np.float32), y.astype(np.float32)
+
+
+class SatPredDataModule(SatelliteDataModule):
+    def __init__(
+        self,
+        zarr_path: list[str] | str,
+        history_mins: int,
+        forecast_mins: int,
+        sample_freq_mins: int,
+        batch_size: int = 16,
+        num_workers: int = 0,
+        prefetch_factor: int | None = None,
+        train_period: list[str | None] = [None, None],
+        val_period: list[str | None] = [None, None],
+        test_period: list[str | None] = [None, None],
+        nan_to_num: bool = False,
+        pin_memory: bool = False,
+        persistent_workers: bool = False,
+        crop_size: tuple[int, int] | None = None,
+        crop_batch_size: int | None = None,
+        crop_align: int = 4,
+        cloud_weighted_crops: bool = False,
+        crop_cloud_index_path: str | None = None,
+        coverage_index_path: str | None = None,
+        min_coverage: float = 0.0,
+        balanced_distributed_sampler: bool = False,
+        latent_cache_dir: str | None = None,
+        index_cache_dir: str | None = None,
+        transport: str | None = None,
+        transport_slots_per_worker: int | None = None,
+        resident_val: bool = False,
+        resident_val_max_gb: float = 8.0,
+        resident_val_dir: str | None = None,
+        block_shuffle_chunks: int | None = None,
+        cache_chunks: int = 4,
+        record_train_indices: bool = False,
+        importance_sampling: bool = False,
+        importance_ema_decay: float = 0.9,
+        importance_uniform_fraction: float = 0.2,
+        importance_prior_path: str | None = None,
+    ):
+        """A lightning DataModule for loading past and future satellite data
+
+        This extends the cloudcasting SatelliteDataModule with extra training data options.
+        Validation always uses the full domain.
+
+        Args:
+            zarr_path: Path to the satellite data. Can be a string or list
+            history_mins: How many minutes of history will be used as input features
+            forecast_mins: How many minutes of future will be used as target features
+            sample_freq_mins: The sample frequency to use for the satellite data
+            batch_size: Batch size.
+            num_workers: Number of workers to use in multiprocess batch loading.
+            prefetch_factor: Number of batches loaded in advance by each worker.
+            train_period: Date range filter for train dataloader.
+            val_period: Date range filter for val dataloader.
+            test_period: Date range filter for test dataloader.
+            nan_to_num: Whether to convert NaNs to -1.
+            pin_memory: If True, the data loader will copy Tensors into device/CUDA pinned memory
+                before returning them.
+            persistent_workers: If True, the data loader will not shut down the worker processes
+                after a dataset has been consumed once.
+            crop_size: If set, train on random (height, width) spatial crops of this size rather
+                than the full domain. Only suitable for fully-convolutional models
+            crop_batch_size: The training batch size when cropping. Defaults to `batch_size` times
+                the number of crops which fit in the full domain area, so each step sees roughly
+                the same number of pixels
+            crop_align: The crop origin is aligned to a multiple of this many pixels
+            cloud_weighted_crops: Whether to favour crops with more cloud structure
+            crop_cloud_index_path: Path to a cloud cell index built with
+                `scripts/build_cloud_cell_index.py`, used to score the crops when using
+                `cloud_weighted_crops`
+            coverage_index_path: Path to a coverage index built with
+                `scripts/build_coverage_index.py`. If set, train and val samples whose target
+                frames have too little valid data are removed before sampling
+            min_coverage: The minimum mean valid fraction of the target frames for a sample to be
+                kept. Samples with no valid targets are always removed if using a coverage index
+            balanced_distributed_sampler: Whether to use a sampler which gives each device the
+                same number of training samples, with similar target coverage on each step if a
+                coverage index is used. Requires `use_distributed_sampler: false` in the trainer
+            latent_cache_dir: If set, the training samples are served from a cache of frozen
+                encoder outputs and quantised inputs built with
+                `scripts/cache_encoder_latents.py`. The model must have a frozen encoder
+            index_cache_dir: If set, the dataset time indexes are cached in this directory and the
+                satellite data is reopened lazily in each dataloader worker rather than pickled.
+                This speeds up the dataset and worker startup
+            transport: If set, the batches are collated inside the workers into shared memory
+                with this encoding, either "float16" or "uint8", and are only upcast to float32
+                on the compute device. See `sat_pred/transport.py`
+            transport_slots_per_worker: The number of shared memory batch slots for each worker.
+                Defaults to the prefetch factor plus two
+            resident_val: Whether to keep the validation samples in memory once they have been
+                loaded, so later validation epochs don't read the satellite data. Only the samples
+                used with an integer `limit_val_batches` are kept. See `sat_pred/resident.py`
+            resident_val_max_gb: The maximum size of the resident validation samples. Samples
+                which don't fit are streamed from the satellite data as usual
+            resident_val_dir: If set, the resident validation samples are stored in
+                memory-mapped files in this local directory rather than in shared memory
+            block_shuffle_chunks: If set, the training samples are shuffled in blocks of this many
+                consecutive zarr time chunks rather than uniformly, and each dataloader worker
+                keeps its most recently decoded chunks in memory. Larger blocks mean fewer chunk
+                reads but less random batches. See `ChunkBlockShuffleSampler`
+            cache_chunks: The number of decoded time chunks each worker keeps in memory when
+                using `block_shuffle_chunks`. Not used with `crop_size`
+            record_train_indices: Whether to record the dataset indices of the training batches,
+                so the t0 times of a batch can be found. This is set by the `NumericsGuard`
+                callback
+            importance_sampling: Whether to draw the training samples in proportion to a running
+                estimate of their loss rather than uniformly. The training module weights the
+                loss of each sample so it stays unbiased. See `sat_pred/importance.py`. Requires
+                `use_distributed_sampler: false` in the trainer when using multiple devices
+            importance_ema_decay: The decay of the moving average of the loss of each sample
+            importance_uniform_fraction: The fraction of the sampling probability spread
+                uniformly over all samples. This bounds the loss weights by its inverse
+            importance_prior_path: Path to a cloud variability index built with
+                `scripts/build_cloud_variability_index.py`. If set, the loss estimates of samples
+                which haven't been trained on are scaled by the variability of their targets
+        """
+        super().__init__(
+            zarr_path=zarr_path,
+            history_mins=history_mins,
+            forecast_mins=forecast_mins,
+            sample_freq_mins=sample_freq_mins,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            train_period=train_period,
+            val_period=val_period,
+            test_period=test_period,
+            nan_to_num=nan_to_num,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+        )
+
+        self.zarr_path = zarr_path
+        self.history_mins = history_mins
+        self.forecast_mins = forecast_mins
+        self.sample_freq_mins = sample_freq_mins
+        self.batch_size = batch_size
+        self.train_period = train_period
+        self.val_period = val_period
+        self.test_period = test_period
+        self.nan_to_num = nan_to_num
+
+        self.crop_size = crop_size
+        self.crop_batch_size = crop_batch_size
+        self.crop_align = crop_align
+        self.cloud_weighted_crops = cloud_weighted_crops
+        self.crop_cloud_index_path = crop_cloud_index_path
+        self.coverage_index_path = coverage_index_path
+        self.min_coverage = min_coverage
+        self.balanced_distributed_sampler = balanced_distributed_sampler
+        self.latent_cache_dir = latent_cache_dir
+        self.index_cache_dir = index_cache_dir
+        self.transport = transport
+        self.transport_slots_per_worker = transport_slots_per_worker
+        self._transport_stagers = {}
+        self.resident_val = resident_val
+        self.resident_val_max_gb = resident_val_max_gb
+        self.resident_val_dir = resident_val_dir
+        self._resident_val_dataset = None
+        self.block_shuffle_chunks = block_shuffle_chunks
+        self.cache_chunks = cache_chunks
+        self.record_train_indices = record_train_indices
+        self.importance_sampling = importance_sampling
+        self.importance_ema_decay = importance_ema_decay
+        self.importance_uniform_fraction = importance_uniform_fraction
+        self.importance_prior_path = importance_prior_path
+
+        num_samplers = sum(
+            [balanced_distributed_sampler, block_shuffle_chunks is not None, importance_sampling]
+        )
+        if num_samplers > 1:
+            raise ValueError(
+                "Only one of balanced_distributed_sampler, block_shuffle_chunks and "
+                "importance_sampling can be used"
+            )
+
+        self._dataloader_kwargs = dict(
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+        )
+
+    def _dataset_kwargs(self, period: list[str | None]) -> dict:
+        return dict(
+            zarr_path=self.zarr_path,
+            start_time=period[0],
+            end_time=period[1],
+            history_mins=self.history_mins,
+            forecast_mins=self.forecast_mins,
+            sample_freq_mins=self.sample_freq_mins,
+            nan_to_num=self.nan_to_num,
+        )
+
+    def _filter_coverage(self, dataset: SatelliteDataset, name: str) -> SatelliteDataset:
+        """Remove the samples with too little valid target data"""
+        if self.coverage_index_path is not None:
+            dataset.t0_times, report = filter_t0_times(
+                dataset.t0_times,
+                load_coverage_index(self.coverage_index_path),
+                min_coverage=self.min_coverage,
+                start_mins=self.sample_freq_mins,
+                end_mins=self.forecast_mins,
+                sample_freq_mins=self.sample_freq_mins,
+            )
+            print(f"{name}: {report}")
+        return dataset
+
+    def _make_full_domain_dataset(self, period: list[str | None]) -> SatelliteDataset:
+        if self.index_cache_dir is None:
+            return SatelliteDataset(**self._dataset_kwargs(period))
+        else:
+            return IndexedSatelliteDataset(
+                **self._dataset_kwargs(period), index_cache_dir=self.index_cache_dir
+            )
+
+    def _make_train_dataset(self) -> SatelliteDataset | LatentCacheDataset:
+        if self.latent_cache_dir is not None:
+            # The cache is built from the already-filtered training samples
+            return LatentCacheDataset(self.latent_cache_dir)
+        elif self.crop_size is None and self.block_shuffle_chunks is not None:
+            dataset = ChunkCacheSatelliteDataset(
+                **self._dataset_kwargs(self.train_period),
+                index_cache_dir=self.index_cache_dir,
+                cache_chunks=self.cache_chunks,
+            )
+        elif self.crop_size is None:
+            dataset = self._make_full_domain_dataset(self.train_period)
+        else:
+            dataset = CropSatelliteDataset(
+                **self._dataset_kwargs(self.train_period),
+                index_cache_dir=self.index_cache_dir,
+                crop_size=self.crop_size,
+                align=self.crop_align,
+                cloud_weighted=self.cloud_weighted_crops,
+                cloud_index_path=self.crop_cloud_index_path,
+            )
+        return self._filter_coverage(dataset, "train")
+
+    def _make_val_dataset(self) -> SatelliteDataset | ResidentDataset:
+        if self._resident_val_dataset is not None:
+            return self._resident_val_dataset
+
+        dataset = self._make_full_domain_dataset(self.val_period)
+        dataset = self._filter_coverage(dataset, "val")
+
+        if self.resident_val:
+            # Only the first batches are used if the validation batches are limited to a count.
+            # Under DDP each device runs this many batches of its own shard of the samples
+            limit_val_batches = self.trainer.limit_val_batches if self.trainer else None
+            if isinstance(limit_val_batches, int):
+                world_size = self.trainer.world_size
+                num_samples = limit_val_batches * self.batch_size * world_size
+            else:
+                num_samples = None
+
+            # Kept so the same resident samples are reused if the dataloader is rebuilt
+            self._resident_val_dataset = dataset = ResidentDataset(
+                dataset,
+                num_samples=num_samples,
+                max_gb=self.resident_val_max_gb,
+                mmap_dir=self.resident_val_dir,
+            )
+
+        return dataset
+
+    def _train_batch_size(self, dataset: SatelliteDataset) -> int:
+        if self.crop_size is None:
+            return self.batch_size
+        elif self.crop_batch_size is not None:
+            return self.crop_batch_size
+        else:
+            crops_per_domain = np.prod(dataset.full_size) // np.prod(dataset.crop_size)
+            return self.batch_size * max(1, int(crops_per_domain))
+
+    def _make_train_sampler(
+        self, dataset: SatelliteDataset, batch_size: int
+    ) -> BalancedDistributedSampler | ChunkBlockShuffleSampler | ImportanceSampler | None:
+        if self.importance_sampling:
+            if self.importance_prior_path is not None:
+                # The mean variability of the target frames of each sample
+                prior_scores = sample_coverage(
+                    dataset.t0_times,
+                    load_variability_index(self.importance_prior_path),
+                    start_mins=self.sample_freq_mins,
+                    end_mins=self.forecast_mins,
+                    sample_freq_mins=self.sample_freq_mins,
+                )
+            else:
+                prior_scores = None
+
+            return ImportanceSampler(
+                len(dataset),
+                prior_scores=prior_scores,
+                ema_decay=self.importance_ema_decay,
+                uniform_fraction=self.importance_uniform_fraction,
+            )
+
+        if self.block_shuffle_chunks is not None:
+            if isinstance(dataset, LatentCacheDataset):
+                raise ValueError("Block shuffling can't be used with the latent cache")
+            return ChunkBlockShuffleSampler(
+                time_chunk_ids(dataset.ds, dataset.t0_times),
+                block_chunks=self.block_shuffle_chunks,
+                batch_size=batch_size,
+                num_workers=self._dataloader_kwargs["num_workers"],
+            )
+
+        if not self.balanced_distributed_sampler:
+            return None
+
+        if self.coverage_index_path is not None:
+            sample_weights = sample_coverage(
+                dataset.t0_times,
+                load_coverage_index(self.coverage_index_path),
+                start_mins=self.sample_freq_mins,
+                end_mins=self.forecast_mins,
+                sample_freq_mins=self.sample_freq_mins,
+            )
+        else:
+            sample_weights = None
+
+        return BalancedDistributedSampler(len(dataset), sample_weights=sample_weights)
+
+    def _transport_collate_fn(
+        self, name: str, dataset: SatelliteDataset, batch_size: int
+    ) -> SlotCollate | None:
+        """Create the shared slot ring for a dataloader and return its collate function"""
+        if self.transport is None:
+            return None
+
+        if isinstance(dataset, LatentCacheDataset):
+            raise ValueError("The transport can't be used with the latent cache")
+
+        X, y = dataset[0]
+        num_workers = self._dataloader_kwargs["num_workers"]
+        prefetch_factor = self._dataloader_kwargs["prefetch_factor"] or 2
+        ring = SharedSlotRing(
+            name,
+            shapes={"X": X.shape, "y": y.shape},
+            batch_size=batch_size,
+            num_workers=num_workers,
+            slots_per_worker=self.transport_slots_per_worker or prefetch_factor + 2,
+            encoding=self.transport,
+        )
+        self._transport_stagers[name] = TransportStager(
+            ring,
+            missing_value=-1 if self.nan_to_num else float("nan"),
+            pin_memory=self._dataloader_kwargs["pin_memory"],
+        )
+        print(
+            f"{name}: {ring.nbytes / 1e9:.2f} GB shared memory transport, "
+            f"{(X.nbytes + y.nbytes) * ring.buffers['X'].element_size() / 4 / 1e6:.1f} MB "
+            f"per sample"
+        )
+        return SlotCollate(ring)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx: int):
+        """Copy batches out of the shared memory transport into the staging buffers"""
+        if isinstance(batch, EncodedBatch):
+            return self._transport_stagers[batch.ring_name].stage(batch)
+        return batch
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        """Upcast transported batches to float32 on the compute device"""
+        if isinstance(batch, StagedBatch):
+            return batch.decode()
+        return batch
+
+    def train_dataloader(self) -> DataLoader:
+        """Construct train dataloader"""
+        dataset = self._make_train_dataset()
+        batch_size = self._train_batch_size(dataset)
+        sampler = self._make_train_sampler(dataset, batch_size)
+
+        # Lightning replaces the default sampler when training on multiple devices, so the
+        # indices are only recorded when they match the batches on this device
+        world_size = self.trainer.world_size if self.trainer else 1
+        if self.record_train_indices and (sampler is not None or world_size == 1):
+            sampler = RecordingSampler(sampler or RandomSampler(dataset))
+
+        collate_fn = self._transport_collate_fn("train", dataset, batch_size)
+        dataloader_cls = DataLoader if collate_fn is None else TransportDataLoader
+        return dataloader_cls(
+            dataset,
+            batch_size=batch_size,
+            shuffle=sampler is None,
+            sampler=sampler,
+            collate_fn=collate_fn,
+            **self._dataloader_kwargs,
+        )
+
+    def val_dataloader(self) -> DataLoader:
+        """Construct val dataloader"""
+        dataset = self._make_val_dataset()
+        collate_fn = self._transport_collate_fn("val", dataset, self.batch_size)
+        dataloader_cls = DataLoader if collate_fn is None else TransportDataLoader
+        return dataloader_cls(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=False,
+            collate_fn=collate_fn,
+            **self._dataloader_kwargs,
+        )
@@ -0,0 +1,223 @@
+"""Persistent cache of the satellite dataset time index for fast dataset and worker startup
+
+Building a satellite dataset means opening and concatenating several yearly zarr stores, selecting
+the timestamps at the sample frequency and finding the valid t0 times. With the `spawn` start
+method the dataset, including its lazily loaded xarray dataset, is also pickled and sent to every
+dataloader worker.
+
+The index cache stores the positions of the selected timestamps in the concatenated stores and
+the valid t0 times as .npy files which are memory-mapped when loaded. `IndexedDatasetMixin` uses
+the cache to skip rebuilding the index, drops the xarray dataset when the dataset is pickled, and
+reopens it lazily in each worker using the cached time positions.
+
+Opening stores with consolidated metadata only reads a single metadata file per store. Training
+never writes to the data stores, so stores without it should be consolidated once offline with
+`scripts/consolidate_zarr_metadata.py`.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from cloudcasting.dataset import find_valid_t0_times, load_satellite_zarrs
+from torch.utils.data import get_worker_info
+
+
+DEFAULT_INDEX_CACHE_DIR = "~/.cache/sat_pred/dataset_index"
+
+# Increased whenever the way the index is built changes, so old cached indexes aren't reused
+INDEX_VERSION = 2
+
+
+def consolidate_zarr_metadata(zarr_path: list[str] | str) -> list[str]:
+    """Add consolidated metadata to any of the zarr stores which don't have it
+
+    This writes to the stores, so it is only run offline and never during training.
+
+    Returns:
+        The paths of the stores which were consolidated
+    """
+    consolidated = []
+    for path in [zarr_path] if isinstance(zarr_path, str) else zarr_path:
+        if not os.path.exists(f"{path}/.zmetadata"):
+            zarr.consolidate_metadata(path)
+            consolidated.append(path)
+    return consolidated
+
+
+def _store_fingerprint(path: str) -> str:
+    """A fingerprint of a zarr store which changes if the store is rewritten
+
+    The time coordinate metadata changes if the store is rewritten or extended in time, and
+    unlike the store level metadata it isn't touched by consolidating the store.
+    """
+    for name in ["time/.zarray", ".zgroup", "."]:
+        if os.path.exists(f"{path}/{name}"):
+            return f"{path}:{os.path.getmtime(f'{path}/{name}')}"
+    return path
+
+
+def index_cache_key(zarr_path: list[str] | str, **params) -> str:
+    """Create a key for the dataset index from the stores and the dataset parameters"""
+    paths = [zarr_path] if isinstance(zarr_path, str) else list(zarr_path)
+    spec = {"version": INDEX_VERSION, "stores": [_store_fingerprint(p) for p in paths], **params}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def build_dataset_index(
+    ds: xr.Dataset,
+    start_time: str | None,
+    end_time: str | None,
+    history_mins: int,
+    forecast_mins: int,
+    sample_freq_mins: int,
+) -> tuple[np.ndarray, pd.DatetimeIndex]:
+    """Find the timestamps used by a dataset and its valid t0 times
+
+    Returns:
+        time_indices: The positions of the selected timestamps in the concatenated stores
+        t0_times: The valid t0 times
+    """
+    # Select the period with the same partial string semantics as `ds.sel(time=slice(...))`, so
+    # e.g. an end time of "2016-12-31" includes the whole of that day
+    positions = pd.Series(np.arange(ds.sizes["time"]), index=pd.DatetimeIndex(ds.time.values))
+    positions = positions.loc[start_time:end_time]
+
+    # Convert to the sample frequency
+    positions = positions[(positions.index.minute % sample_freq_mins) == 0]
+
+    time_indices = positions.values
+    t0_times = find_valid_t0_times(
+        positions.index, history_mins, forecast_mins, sample_freq_mins
+    )
+    return time_indices, pd.DatetimeIndex(t0_times)
+
+
+def load_or_build_dataset_index(
+    zarr_path: list[str] | str,
+    start_time: str | None,
+    end_time: str | None,
+    history_mins: int,
+    forecast_mins: int,
+    sample_freq_mins: int,
+    cache_dir: str | None = DEFAULT_INDEX_CACHE_DIR,
+) -> tuple[np.ndarray, pd.DatetimeIndex, xr.Dataset | None]:
+    """Load the dataset index from the cache, or build and cache it
+
+    Args:
+        zarr_path: Path to the satellite data. Can be a string or list
+        start_time: The satellite data is filtered to exclude timestamps before this
+        end_time: The satellite data is filtered to exclude timestamps after this
+        history_mins: How many minutes of history will be used as input features
+        forecast_mins: How many minutes of future will be used as target features
+        sample_freq_mins: The sample frequency to use for the satellite data
+        cache_dir: The directory of the index cache. If None the index is built without caching
+
+    Returns:
+        time_indices: The positions of the selected timestamps in the concatenated stores
+        t0_times: The valid t0 times
+        ds: The concatenated stores if they had to be opened to build the index, else None
+    """
+    params = dict(
+        start_time=start_time,
+        end_time=end_time,
+        history_mins=history_mins,
+        forecast_mins=forecast_mins,
+        sample_freq_mins=sample_freq_mins,
+    )
+
+    if cache_dir is None:
+        ds = load_satellite_zarrs(zarr_path)
+        return *build_dataset_index(ds, **params), ds
+
+    index_dir = os.path.join(
+        os.path.expanduser(cache_dir), index_cache_key(zarr_path, **params)
+    )
+
+    try:
+        time_indices = np.load(f"{index_dir}/time_indices.npy", mmap_mode="r")
+        t0_times = pd.DatetimeIndex(np.load(f"{index_dir}/t0_times.npy", mmap_mode="r"))
+        return time_indices, t0_times, None
+    except FileNotFoundError:
+        pass
+
+    ds = load_satellite_zarrs(zarr_path)
+    time_indices, t0_times = build_dataset_index(ds, **params)
+
+    # Write to a temporary directory first so a partly written index is never read
+    tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(f"{tmp_dir}/time_indices.npy", time_indices)
+    np.save(f"{tmp_dir}/t0_times.npy", t0_times.values)
+    try:
+        os.replace(tmp_dir, index_dir)
+    except OSError:
+        # Another process wrote the same index first
+        pass
+
+    return time_indices, t0_times, ds
+
+
+class IndexedDatasetMixin:
+    """Mixin for satellite datasets which load their time index from the index cache
+
+    The dataset's xarray dataset is dropped when it is pickled to send to the dataloader workers
+    and is reopened lazily on first access.
+    """
+
+    def _init_index(
+        self,
+        zarr_path: list[str] | str,
+        start_time: str | None,
+        end_time: str | None,
+        history_mins: int,
+        forecast_mins: int,
+        sample_freq_mins: int,
+        index_cache_dir: str | None = DEFAULT_INDEX_CACHE_DIR,
+    ) -> None:
+        start = time.perf_counter()
+        self.zarr_path = zarr_path
+        self._time_indices, self.t0_times, ds = load_or_build_dataset_index(
+            zarr_path,
+            start_time,
+            end_time,
+            history_mins,
+            forecast_mins,
+            sample_freq_mins,
+            cache_dir=index_cache_dir,
+        )
+        self._ds = None if ds is None else ds.isel(time=self._time_indices)
+
+        source = "built" if ds is not None else "loaded from cache"
+        print(
+            f"Dataset index with {len(self.t0_times)} samples {source} in "
+            f"{time.perf_counter() - start:.2f} s"
+        )
+
+    @property
+    def ds(self) -> xr.Dataset:
+        if self._ds is None:
+            start = time.perf_counter()
+            self._ds = load_satellite_zarrs(self.zarr_path).isel(time=self._time_indices)
+
+            worker_info = get_worker_info()
+            if worker_info is not None:
+                print(
+                    f"Worker {worker_info.id} opened the dataset in "
+                    f"{time.perf_counter() - start:.2f} s"
+                )
+        return self._ds
+
+    @ds.setter
+    def ds(self, value: xr.Dataset) -> None:
+        self._ds = value
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_ds"] = None
+        return state
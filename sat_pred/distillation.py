@@ -0,0 +1,106 @@
+"""Utilities for distilling a trained teacher model into a smaller student model"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from sat_pred.loss import LossFunction
+
+
+def sample_keys(X: torch.Tensor, stride: int = 8) -> list[str]:
+    """Create a key for each sample in a batch from a strided subset of its input pixels
+
+    The training batches don't carry their t0 times so the inputs themselves are used to identify
+    the samples. Only a strided subset of the pixels is copied to the host.
+    """
+    X_sub = X[..., ::stride, ::stride].detach().cpu().numpy()
+    return [hashlib.sha1(x.tobytes()).hexdigest() for x in X_sub]
+
+
+class TeacherOutputCache:
+    def __init__(self, cache_dir: str, max_gb: float = 100):
+        """On-disk cache of teacher predictions so the teacher isn't rerun every epoch
+
+        Args:
+            cache_dir: Directory to store the teacher predictions in
+            max_gb: The cache stops storing new predictions once it reaches this size
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_gb * 1e9
+        self._size = sum(
+            os.path.getsize(f"{cache_dir}/{f}") for f in os.listdir(cache_dir) if f.endswith(".npy")
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key}.npy"
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Return the cached prediction or None if it is not in the cache"""
+        try:
+            y_teacher = np.load(self._path(key))
+            self.hits += 1
+            return y_teacher
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+    def put(self, key: str, y_teacher: np.ndarray) -> None:
+        """Store a prediction as float16 if the cache is not full"""
+        y_teacher = y_teacher.astype(np.float16)
+        if self._size + y_teacher.nbytes > self.max_bytes:
+            return
+        # Write to a temporary file first so a partly written file is never read
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, y_teacher)
+        os.replace(tmp_path, self._path(key))
+        self._size += y_teacher.nbytes
+
+
+@torch.no_grad()
+def predict_with_cache(
+    teacher: torch.nn.Module,
+    X: torch.Tensor,
+    cache: TeacherOutputCache | None = None,
+) -> torch.Tensor:
+    """Run the teacher on a batch, using cached predictions where available"""
+
+    if cache is None:
+        return teacher(X).clip(0, 1)
+
+    keys = sample_keys(X)
+    cached = [cache.get(key) for key in keys]
+    missing = [i for i, y in enumerate(cached) if y is None]
+
+    if len(missing) > 0:
+        y_missing = teacher(X[missing]).clip(0, 1)
+        for i, y in zip(missing, y_missing.float().cpu().numpy()):
+            cache.put(keys[i], y)
+            cached[i] = y
+
+    return torch.stack([torch.as_tensor(y, device=X.device) for y in cached]).to(X.dtype)
+
+
+def distillation_loss(
+    y_hat: torch.Tensor,
+    y_teacher: torch.Tensor,
+    target_loss: str | LossFunction,
+) -> torch.Tensor:
+    """Calculate the loss between the student and teacher predictions
+
+    The teacher predictions are dense, so unlike the target loss there are no masked pixels.
+    """
+    y_teacher = y_teacher.to(y_hat.dtype)
+    if isinstance(target_loss, LossFunction):
+        return target_loss(y_hat, y_teacher)
+    elif target_loss == "MSE":
+        return F.mse_loss(y_hat, y_teacher)
+    else:
+        # The MAE is also used when the target loss is SSIM
+        return F.l1_loss(y_hat, y_teacher)
@@ -0,0 +1,88 @@
+"""Run several checkpoints of the same architecture as one vectorised ensemble"""
+
+import copy
+
+import torch
+from torch import nn
+from torch.func import functional_call, stack_module_state
+
+
+class EnsembleModel(nn.Module):
+    def __init__(
+        self,
+        models: list[nn.Module],
+        vectorize: bool = True,
+        chunk_size: int | None = None,
+    ):
+        """Stack the parameters of several models with the same architecture
+
+        The members are evaluated together with `torch.func.vmap` over their stacked parameters so
+        each input batch is run through all members in one call.
+
+        Args:
+            models: The ensemble members. These must have the same architecture
+            vectorize: Whether to run the members with vmap. If False the members are run one
+                after another, which uses less memory and works for any model
+            chunk_size: If set, vmap runs this many members at a time to limit memory use
+        """
+        super().__init__()
+
+        if len(models) == 0:
+            raise ValueError("An ensemble needs at least one member")
+
+        shapes = [{k: v.shape for k, v in m.state_dict().items()} for m in models]
+        if any(s != shapes[0] for s in shapes[1:]):
+            raise ValueError("All ensemble members must have the same architecture")
+
+        params, buffers = stack_module_state(models)
+
+        # The stacked tensors are registered as buffers so the ensemble can be moved between
+        # devices and compiled like any other module. Buffer names can't contain dots
+        self._param_names = list(params)
+        self._buffer_names = list(buffers)
+        for name, tensor in {**params, **buffers}.items():
+            self.register_buffer(self._safe_name(name), tensor.detach())
+
+        # A copy of the first member on the meta device provides the forward function
+        self._base_model = [copy.deepcopy(models[0]).to("meta").eval()]
+
+        self.num_members = len(models)
+        self.vectorize = vectorize
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def _safe_name(name: str) -> str:
+        return "member_" + name.replace(".", "__")
+
+    def _stacked(self, names: list[str]) -> dict[str, torch.Tensor]:
+        return {name: getattr(self, self._safe_name(name)) for name in names}
+
+    def _member_forward(self, params, buffers, X):
+        return functional_call(self._base_model[0], (params, buffers), (X,))
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        """Run all members on the input batch
+
+        Returns:
+            The member predictions stacked along a new leading dimension
+        """
+        params = self._stacked(self._param_names)
+        buffers = self._stacked(self._buffer_names)
+
+        if self.vectorize:
+            return torch.func.vmap(
+                self._member_forward,
+                in_dims=(0, 0, None),
+                chunk_size=self.chunk_size,
+            )(params, buffers, X)
+
+        return torch.stack(
+            [
+                self._member_forward(
+                    {k: v[i] for k, v in params.items()},
+                    {k: v[i] for k, v in buffers.items()},
+                    X,
+                )
+                for i in range(self.num_members)
+            ]
+        )
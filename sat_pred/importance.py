@@ -0,0 +1,221 @@
+"""Importance sampling of the training samples by how hard they are to predict
+
+Most training samples are easy, e.g. clear sky or night with stable cloud, so sampling the t0
+times uniformly spends most steps on samples the model already predicts well.
+`ImportanceSampler` keeps a running estimate of the loss of each sample and draws samples in
+proportion to it, mixed with a uniform share so every sample can still be drawn. The training
+module weights the error sum and valid pixel count of each sample by the inverse of its sampling
+probability, so the loss remains an estimate of the uniformly sampled loss, which is averaged
+over all the valid pixels of the batch.
+
+Before a sample has been trained on, its loss is estimated from the running mean loss. This can
+be scaled by a cheap precomputed cloud variability score, so samples with changing cloud are
+drawn more often from the start. The scores are built with
+`scripts/build_cloud_variability_index.py`.
+"""
+
+import math
+from collections.abc import Iterator
+
+import numpy as np
+import pandas as pd
+import torch.distributed as dist
+import xarray as xr
+from torch.utils.data import Sampler
+
+
+VARIABILITY_COLUMN = "cloud_variability"
+
+
+def compute_cloud_variability(ds: xr.Dataset, channel: int = 8, stride: int = 8) -> pd.Series:
+    """Compute the mean absolute change of a channel since the previous timestamp
+
+    Only one channel on a strided grid of pixels is used, which is enough to tell changing cloud
+    apart from clear sky and stable cloud.
+
+    Args:
+        ds: The satellite dataset with a `data` variable
+        channel: The channel index to use
+        stride: The spacing in pixels of the grid to use
+
+    Returns:
+        Series of the cloud variability indexed by time. The first timestamp has no previous
+        frame and is given zero variability
+    """
+    frames = ds.data.isel(
+        variable=channel,
+        x_geostationary=slice(None, None, stride),
+        y_geostationary=slice(None, None, stride),
+    )
+    change = (
+        abs(frames.diff("time"))
+        .mean(dim=[d for d in frames.dims if d != "time"], skipna=True)
+        .compute()
+    )
+    variability = pd.Series(
+        change.values.astype(np.float32),
+        index=pd.DatetimeIndex(change.time.values, name="time"),
+        name=VARIABILITY_COLUMN,
+    )
+    times = pd.DatetimeIndex(frames.time.values, name="time")
+    return variability.reindex(times).fillna(0)
+
+
+def save_variability_index(variability: pd.Series, path: str) -> None:
+    """Save the cloud variability index to parquet"""
+    variability.to_frame(VARIABILITY_COLUMN).to_parquet(path)
+
+
+def load_variability_index(path: str) -> pd.Series:
+    """Load the cloud variability index from parquet"""
+    variability = pd.read_parquet(path)[VARIABILITY_COLUMN]
+    return variability[~variability.index.duplicated()].sort_index()
+
+
+class ImportanceSampler(Sampler[int]):
+    def __init__(
+        self,
+        num_samples: int,
+        prior_scores: np.ndarray | None = None,
+        ema_decay: float = 0.9,
+        uniform_fraction: float = 0.2,
+        refresh_every: int = 256,
+        num_replicas: int | None = None,
+        rank: int | None = None,
+        seed: int = 0,
+    ):
+        """Sampler which draws samples in proportion to a running estimate of their loss
+
+        Samples are drawn with replacement with probability
+
+            p_i = uniform_fraction / N + (1 - uniform_fraction) * s_i / sum(s)
+
+        where s_i is the exponential moving average of the loss of sample i. The probabilities
+        are recalculated every `refresh_every` draws so they follow the losses passed to
+        `update()` during the epoch. Every sample has a probability of at least
+        `uniform_fraction / N`, which bounds the importance weights `1 / (N p_i)` by
+        `1 / uniform_fraction`.
+
+        When training on multiple devices each device draws its own samples from the whole
+        dataset and keeps its own loss estimates. The training module sums the weighted valid
+        counts over the devices, so the weighted loss is normalised over the global batch. This
+        requires `use_distributed_sampler: false` in the trainer.
+
+        Args:
+            num_samples: The number of samples in the dataset
+            prior_scores: Optional score of each sample, e.g. its cloud variability, used to
+                scale the loss estimate of samples which haven't been trained on yet
+            ema_decay: The decay of the moving average of the loss of each sample
+            uniform_fraction: The fraction of the sampling probability spread uniformly over all
+                samples
+            refresh_every: The number of samples drawn between updates of the probabilities
+            num_replicas: The number of devices. Defaults to the distributed world size
+            rank: The rank of this device. Defaults to the distributed rank
+            seed: The random seed
+        """
+        if not 0 < uniform_fraction <= 1:
+            raise ValueError("uniform_fraction must be in (0, 1] to keep the loss unbiased")
+
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+
+        self.num_samples = num_samples
+        self.ema_decay = ema_decay
+        self.uniform_fraction = uniform_fraction
+        self.refresh_every = refresh_every
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        if prior_scores is not None:
+            prior_scores = np.asarray(prior_scores, dtype=np.float64)
+            prior_scores = prior_scores / max(prior_scores.mean(), 1e-12)
+        self.prior_scores = prior_scores
+
+        # The moving average loss of each sample, NaN until the sample is trained on
+        self.scores = np.full(num_samples, np.nan)
+        self.mean_loss = None
+
+        # The indices drawn in the current epoch and their sampling probabilities
+        self.indices = []
+        self.probs = []
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch so each epoch uses a different order"""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return math.ceil(self.num_samples / self.num_replicas)
+
+    def probabilities(self) -> np.ndarray:
+        """The current sampling probability of each sample"""
+        # Samples which haven't been trained on are given the mean loss, scaled by their prior
+        unseen_scores = 1.0 if self.mean_loss is None else self.mean_loss
+        if self.prior_scores is not None:
+            unseen_scores = unseen_scores * self.prior_scores
+
+        scores = np.where(np.isnan(self.scores), unseen_scores, self.scores).clip(min=0)
+        total = scores.sum()
+
+        uniform = np.full(self.num_samples, 1 / self.num_samples)
+        if not total > 0:
+            return uniform
+        return self.uniform_fraction * uniform + (1 - self.uniform_fraction) * scores / total
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        self.indices = []
+        self.probs = []
+
+        while len(self.indices) < len(self):
+            p = self.probabilities()
+            n = min(self.refresh_every, len(self) - len(self.indices))
+            draws = rng.choice(self.num_samples, size=n, p=p)
+            self.indices.extend(draws.tolist())
+            self.probs.extend(p[draws].tolist())
+            yield from draws.tolist()
+
+    def batch_weights(self, batch_idx: int, batch_size: int) -> tuple[list[int], np.ndarray]:
+        """The dataset indices and importance weights of a batch of the current epoch
+
+        The batches are returned by the dataloader in the order they are sampled, so batch `i`
+        holds the samples drawn at positions `i * batch_size` to `(i + 1) * batch_size`.
+        """
+        positions = slice(batch_idx * batch_size, (batch_idx + 1) * batch_size)
+        probs = np.array(self.probs[positions])
+        return self.indices[positions], 1 / (self.num_samples * probs)
+
+    def update(self, indices: list[int], losses: np.ndarray, weights: np.ndarray) -> None:
+        """Update the loss estimates with the losses of a batch
+
+        Args:
+            indices: The dataset indices of the samples in the batch
+            losses: The loss of each sample
+            weights: The importance weight of each sample, used to keep an unbiased estimate of
+                the mean loss over all samples
+        """
+        indices = np.asarray(indices)
+        losses = np.asarray(losses, dtype=np.float64)
+        seen = self.scores[indices]
+        self.scores[indices] = np.where(
+            np.isnan(seen), losses, self.ema_decay * seen + (1 - self.ema_decay) * losses
+        )
+
+        batch_mean = float(np.mean(weights * losses))
+        if self.mean_loss is None:
+            self.mean_loss = batch_mean
+        else:
+            self.mean_loss = self.ema_decay * self.mean_loss + (1 - self.ema_decay) * batch_mean
+
+    def summary(self) -> dict[str, float]:
+        """Statistics of the loss estimates and sampling probabilities"""
+        p = self.probabilities()
+        return {
+            "seen_fraction": float(np.mean(~np.isnan(self.scores))),
+            "max_weight": float(1 / (self.num_samples * p.min())),
+            # The effective number of samples of the distribution, as a fraction of the dataset
+            "effective_fraction": float(1 / (self.num_samples * np.sum(p**2))),
+        }
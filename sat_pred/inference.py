@@ -0,0 +1,213 @@
+"""Lightweight model loading and inference without Lightning or hydra
+
+Loading a model through the training module imports Lightning, wandb, pandas and hydra, and
+instantiates the whole training wrapper just to get the model out of it. This module only imports
+torch and the model classes named in the saved config. The models are built directly from their
+`_target_` config and their weights are loaded from a safetensors file or from the model entries of
+a Lightning checkpoint. Other heavy imports are deferred until they are needed.
+
+use:
+python -m sat_pred.inference path/to/checkpoint_dir --input X.npy --output y_hat.npy
+python -m sat_pred.inference path/to/checkpoint_dir --zarr-path sat.zarr --t0 "2023-01-01 12:00" \
+    --output y_hat.npy
+"""
+
+import argparse
+import importlib
+import itertools
+import os
+from functools import partial
+from glob import glob
+
+import numpy as np
+import torch
+
+
+def _import_target(target: str):
+    module_name, _, attr = target.rpartition(".")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def instantiate(config):
+    """Recursively build the objects in a config which have a `_target_`
+
+    This supports the subset of hydra's instantiation used by the model configs: a `_target_`
+    with keyword arguments, optional positional `_args_`, and `_partial_`.
+    """
+    if isinstance(config, list):
+        return [instantiate(c) for c in config]
+    if not isinstance(config, dict):
+        return config
+
+    kwargs = {
+        k: instantiate(v) for k, v in config.items()
+        if k not in ["_target_", "_args_", "_partial_", "_convert_", "_recursive_"]
+    }
+    if "_target_" not in config:
+        return kwargs
+
+    target = _import_target(config["_target_"])
+    args = [instantiate(a) for a in config.get("_args_", [])]
+    if config.get("_partial_", False):
+        return partial(target, *args, **kwargs)
+    return target(*args, **kwargs)
+
+
+def load_config(path: str) -> dict:
+    """Load a yaml config, resolving any environment variable tags"""
+    from pyaml_env import parse_config
+
+    return parse_config(path)
+
+
+def find_weights(checkpoint_dir_path: str, val_best: bool = True) -> str:
+    """Find the weights file of a model directory
+
+    A `model.safetensors` file is used if there is one. Otherwise the best or last Lightning
+    checkpoint is used.
+    """
+    if os.path.exists(f"{checkpoint_dir_path}/model.safetensors"):
+        return f"{checkpoint_dir_path}/model.safetensors"
+
+    if val_best:
+        # Only one epoch (best) saved per model
+        files = glob(f"{checkpoint_dir_path}/epoch*.ckpt")
+        if len(files) != 1:
+            raise ValueError(
+                f"Found {len(files)} checkpoints @ {checkpoint_dir_path}/epoch*.ckpt. Expected one."
+            )
+        return files[0]
+    else:
+        return f"{checkpoint_dir_path}/last.ckpt"
+
+
+def load_state_dict(path: str) -> dict[str, torch.Tensor]:
+    """Load the model weights from a safetensors file or a Lightning checkpoint"""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        # Bundles may store the weights as float16 to halve their size
+        return {
+            k: v.float() if v.dtype == torch.float16 else v for k, v in load_file(path).items()
+        }
+
+    checkpoint = torch.load(path, map_location="cpu", mmap=True)
+    # The training module stores the model under `model.` and may have other entries
+    return {
+        k.removeprefix("model."): v
+        for k, v in checkpoint["state_dict"].items()
+        if k.startswith("model.")
+    }
+
+
+def load_model(
+    checkpoint_dir_path: str,
+    val_best: bool = True,
+    device: str | torch.device = "cpu",
+) -> tuple[torch.nn.Module, dict, dict | None]:
+    """Build a model from its saved config and load its weights
+
+    Args:
+        checkpoint_dir_path: Path to the checkpoint directory, or to a directory with a
+            `model.safetensors` file
+        val_best: Whether to use the best performing checkpoint found during training, else uses
+            the last checkpoint saved during training
+        device: The device to load the model onto
+
+    Returns:
+        model: The model in eval mode
+        model_config: The config of the model
+        data_config: The data config if saved with the model, else None
+    """
+    model_config = load_config(f"{checkpoint_dir_path}/model_config.yaml")
+
+    # Checkpoint directories save the training module config, with the model config inside it
+    if isinstance(model_config.get("model"), dict) and "_target_" in model_config["model"]:
+        model_config = model_config["model"]
+
+    state_dict = load_state_dict(find_weights(checkpoint_dir_path, val_best))
+
+    # Build the model on the meta device to skip initialising weights which are then replaced
+    try:
+        with torch.device("meta"):
+            model = instantiate(model_config)
+        model.load_state_dict(state_dict, assign=True)
+        on_meta = any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers()))
+    except (NotImplementedError, RuntimeError):
+        on_meta = True
+
+    if on_meta:
+        # Some models can't be built on the meta device, or have tensors which aren't saved such
+        # as non-persistent buffers, so these are built normally
+        model = instantiate(model_config)
+        model.load_state_dict(state_dict)
+
+    model = model.to(device).eval()
+
+    if os.path.exists(f"{checkpoint_dir_path}/data_config.yaml"):
+        data_config = load_config(f"{checkpoint_dir_path}/data_config.yaml")
+    else:
+        data_config = None
+
+    return model, model_config, data_config
+
+
+@torch.inference_mode()
+def predict(model: torch.nn.Module, X: np.ndarray | torch.Tensor) -> np.ndarray:
+    """Run the model on a sample or batch of shape ([batch,] channel, time, height, width)"""
+    X = torch.as_tensor(X, dtype=torch.float32)
+    single_sample = X.ndim == 4
+    if single_sample:
+        X = X[None]
+
+    device = next(model.parameters()).device
+    y_hat = model(X.to(device)).cpu().numpy()
+    return y_hat[0] if single_sample else y_hat
+
+
+def load_input(zarr_path: list[str], t0: str, data_config: dict) -> np.ndarray:
+    """Load the model input for a t0 time from the satellite zarrs"""
+    from cloudcasting.dataset import SatelliteDataset
+
+    dataset = SatelliteDataset(
+        zarr_path=zarr_path,
+        start_time=None,
+        end_time=None,
+        history_mins=data_config["history_mins"],
+        forecast_mins=data_config["forecast_mins"],
+        sample_freq_mins=data_config["sample_freq_mins"],
+        nan_to_num=data_config["nan_to_num"],
+    )
+    X, _ = dataset[t0]
+    return X
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Run a saved model on a single input")
+    parser.add_argument("checkpoint_dir_path", help="The checkpoint or safetensors directory")
+    parser.add_argument("--input", help="A .npy file of shape ([batch,] channel, time, y, x)")
+    parser.add_argument("--zarr-path", nargs="+", help="Satellite zarrs to load the input from")
+    parser.add_argument("--t0", help="The t0 time of the input to load from the zarrs")
+    parser.add_argument("--output", required=True, help="The .npy file to save the forecast to")
+    parser.add_argument("--last", action="store_true", help="Use the last checkpoint")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args(argv)
+
+    model, _, data_config = load_model(
+        args.checkpoint_dir_path, val_best=not args.last, device=args.device
+    )
+
+    if args.input is not None:
+        X = np.load(args.input)
+    elif args.zarr_path is not None and args.t0 is not None:
+        if data_config is None:
+            parser.error("A data_config.yaml is needed to load the input from the zarrs")
+        X = load_input(args.zarr_path, args.t0, data_config)
+    else:
+        parser.error("Either --input or both --zarr-path and --t0 are required")
+
+    np.save(args.output, predict(model, X))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""On-disk cache of frozen SimVP encoder outputs for fast fine-tuning
+
+The cache stores the encoder `embed` tensor of the input frames of each training sample as a
+memory-mapped float16 array, and the input and target frames as uint8 with a scale and offset
+for each channel, encoded as in `sat_pred/transport.py`. Training from the cache skips the zarr
+decode and most of the encoder forward pass on every step.
+
+The encoder `skip` output is not stored. It is the full resolution output of the first encoder
+layer, with `hid_S` channels for every input frame, so it would be larger than the input frames
+themselves. The model recomputes it from the cached input frames, which only costs the first
+encoder layer. See `scripts/cache_encoder_latents.py`, which reports the size of the cache
+relative to the source data.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from sat_pred.transport import decode_uint8, encode_uint8
+
+
+ARRAY_NAMES = ["embed", "X", "X_scale", "y", "y_scale"]
+
+# Increased when the layout of the cache changes
+CACHE_VERSION = 2
+
+
+def _array_specs(shapes: dict[str, tuple[int, ...]]) -> dict[str, tuple[np.dtype, tuple]]:
+    """The dtype and per-sample shape of each cached array"""
+    return {
+        "embed": (np.float16, tuple(shapes["embed"])),
+        "X": (np.uint8, tuple(shapes["X"])),
+        "X_scale": (np.float32, (shapes["X"][0], 2)),
+        "y": (np.uint8, tuple(shapes["y"])),
+        "y_scale": (np.float32, (shapes["y"][0], 2)),
+    }
+
+
+class LatentCacheWriter:
+    def __init__(
+        self,
+        cache_dir: str,
+        t0_times: pd.DatetimeIndex,
+        shapes: dict[str, tuple[int, ...]],
+        metadata: dict | None = None,
+    ):
+        """Writer for a latent cache
+
+        Args:
+            cache_dir: The directory to write the cache to
+            t0_times: The t0 time of each sample to be written
+            shapes: The per-sample shape of the "embed", "X" and "y" arrays
+            metadata: Extra metadata to store, e.g. the checkpoint used to create the cache
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+        np.save(f"{cache_dir}/t0_times.npy", pd.DatetimeIndex(t0_times).values)
+
+        self.arrays = {
+            name: np.lib.format.open_memmap(
+                f"{cache_dir}/{name}.npy",
+                mode="w+",
+                dtype=dtype,
+                shape=(len(t0_times), *shape),
+            )
+            for name, (dtype, shape) in _array_specs(shapes).items()
+        }
+
+        with open(f"{cache_dir}/metadata.json", "w") as f:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "shapes": {k: list(v) for k, v in shapes.items()},
+                    **(metadata or {}),
+                },
+                f,
+            )
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def write(
+        self,
+        index: int,
+        embed: np.ndarray | torch.Tensor,
+        X: np.ndarray | torch.Tensor,
+        y: np.ndarray | torch.Tensor,
+    ) -> None:
+        """Write a batch of samples starting at the given index"""
+        if isinstance(embed, torch.Tensor):
+            embed = embed.detach().cpu().numpy()
+        self.arrays["embed"][index:index + len(embed)] = embed.astype(np.float16)
+
+        for name, values in [("X", X), ("y", y)]:
+            if isinstance(values, torch.Tensor):
+                values = values.detach().cpu().numpy()
+            for i, sample in enumerate(values):
+                encode_uint8(
+                    sample,
+                    torch.from_numpy(self.arrays[name][index + i]),
+                    torch.from_numpy(self.arrays[f"{name}_scale"][index + i]),
+                )
+
+    def close(self) -> None:
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+
+class LatentCacheDataset(Dataset):
+    def __init__(self, cache_dir: str):
+        """A torch Dataset which serves samples from a latent cache
+
+        Each sample is ((embed, X), y). The encoder output and the input frames, which the model
+        uses to recompute the encoder skip connection, are returned in float16 and are cast to
+        the model dtype on the device. The targets are returned as float32.
+
+        Args:
+            cache_dir: The directory of the latent cache
+        """
+        with open(f"{cache_dir}/metadata.json") as f:
+            if json.load(f).get("version") != CACHE_VERSION:
+                raise ValueError(
+                    f"The latent cache {cache_dir} was built with an older version of "
+                    "scripts/cache_encoder_latents.py. Rebuild it"
+                )
+
+        self.cache_dir = cache_dir
+        self.t0_times = pd.DatetimeIndex(np.load(f"{cache_dir}/t0_times.npy"))
+
+        # The memory maps are opened lazily so each dataloader worker opens its own
+        self._arrays = None
+
+    def __len__(self) -> int:
+        return len(self.t0_times)
+
+    def _open(self) -> dict[str, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(f"{self.cache_dir}/{name}.npy", mmap_mode="r")
+                for name in ARRAY_NAMES
+            }
+        return self._arrays
+
+    def __getstate__(self) -> dict:
+        # Don't pickle the memory maps when sending the dataset to the workers
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __getitem__(self, idx: int) -> tuple[tuple[np.ndarray, np.ndarray], np.ndarray]:
+        arrays = self._open()
+        embed = np.ascontiguousarray(arrays["embed"][idx])
+        X = decode_uint8(arrays["X"][idx], arrays["X_scale"][idx]).astype(np.float16)
+        y = decode_uint8(arrays["y"][idx], arrays["y_scale"][idx])
+        return (embed, X), y
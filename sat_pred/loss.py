@@ -1,3 +1,4 @@
+import math
 from abc import ABC, abstractmethod
 
 import torch
@@ -18,28 +19,158 @@ class LossFunction(ABC):
         """Return loss"""
         pass
 
+    def masked_terms(
+        self, input: torch.Tensor, target: torch.Tensor
+    ) -> list[tuple[float, torch.Tensor, torch.Tensor]]:
+        """Return the loss as a list of (weight, masked error sum, valid count) terms
+
+        The loss is the weighted mean of error sum / valid count over the terms. Expressing the
+        loss like this allows it to be reduced correctly across devices. Losses which don't
+        override this are treated as a single term with a unit count.
+        """
+        return [(1.0, self(input, target), torch.ones((), device=input.device))]
+
+    def valid_counts(self, target: torch.Tensor) -> torch.Tensor:
+        """Return the valid count of each term in `masked_terms`, which depend only on the target"""
+        return torch.ones(1, device=target.device)
+
+
+def combine_masked_terms(terms: list[tuple[float, torch.Tensor, torch.Tensor]]) -> torch.Tensor:
+    """Combine (weight, masked error sum, valid count) terms into a loss
+
+    If there are no valid values this returns NaN.
+    """
+    loss = sum(weight * error_sum / count for weight, error_sum, count in terms)
+    return loss / sum(weight for weight, _, _ in terms)
+
+
+def distributed_masked_loss(
+    terms: list[tuple[float, torch.Tensor, torch.Tensor]],
+    global_counts: torch.Tensor,
+    world_size: int,
+) -> torch.Tensor:
+    """Combine the local loss terms on one device using the valid counts summed over all devices
+
+    Each term's local error sum is divided by its global valid count. DDP averages gradients
+    over devices, so the result is scaled by the world size so the averaged gradient is the
+    gradient of the global masked mean, rather than the mean of the per-device masked means.
+
+    Args:
+        terms: The local (weight, masked error sum, valid count) terms
+        global_counts: The valid count of each term summed over all devices
+        world_size: The number of devices
+    """
+    weights = torch.tensor([weight for weight, _, _ in terms], device=global_counts.device)
+    error_sums = torch.stack([error_sum for _, error_sum, _ in terms])
+    per_term = error_sums / global_counts.clamp(min=1).to(error_sums.dtype)
+    return world_size * (weights * per_term).sum() / weights.sum()
+
 class MultiscaleMAE(LossFunction):
     """Multiscale Mean Absolute Error"""
 
-    def __init__(self, scales: list[tuple[int]]=[(1,1,1),(2,4,4)]):
-        """Multiscale Mean Absolute Error"""
-        self.scales = scales
+    def __init__(
+        self,
+        scales: list[tuple[int]] = [(1, 1, 1), (2, 4, 4)],
+        weights: list[float] | None = None,
+        mask_value: float = -1,
+    ):
+        """Multiscale Mean Absolute Error
+
+        The inputs and targets are mean-pooled over the valid (non-masked) pixels in each cell of
+        each scale. The coarse levels are built as an image pyramid, where each level is pooled
+        from the coarsest already-computed level whose scale divides it, rather than from full
+        resolution.
+
+        Args:
+            scales: The (time, height, width) pooling kernel size of each scale
+            weights: The weight of each scale in the loss. Defaults to equal weighting
+            mask_value: The value in the target which marks missing data
+        """
+        if weights is None:
+            weights = [1] * len(scales)
+        assert len(weights) == len(scales)
+
+        self.scales = [tuple(scale) for scale in scales]
+        self.weights = list(weights)
+        self.mask_value = mask_value
+
+        # Order the scales so that each level can be built from a finer one
+        self._order = sorted(range(len(self.scales)), key=lambda i: self.scales[i])
 
     @property
     def name(self) -> str:
         return "multiscale_mae"
 
-    def __call__(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        """Return loss"""
+    def _pyramid(self, input: torch.Tensor, target: torch.Tensor):
+        """Yield the masked means of input and target, and the valid fraction, at each scale
+
+        The values are stored as means of the masked values over each cell rather than sums so
+        they stay well conditioned in half precision. Since the pooling kernels are uniform, the
+        mean over a coarse cell is the mean of the means of the finer cells within it.
+
+        If `input` is None only the valid fractions are calculated.
+
+        Yields:
+            Tuples of (scale index, masked input mean, masked target mean, valid fraction)
+        """
+
+        valid = target != self.mask_value
+
+        # At full resolution the masked target is only needed pooled, so we avoid allocating a
+        # masked copy of it. Masked pixels hold `mask_value`, so its contribution can be removed
+        # after pooling. This is marked by using None as the target level
+        x_level = None if input is None else input * valid
+        levels = [((1, 1, 1), x_level, None, valid.to(target.dtype))]
+
+        for i in self._order:
+            scale = self.scales[i]
 
-        target = target.copy()
-        target[target==-1] = float('nan')
+            # Find the coarsest level which this scale can be built from
+            base_scale, x_mean, y_mean, frac = max(
+                [level for level in levels if all(s % b == 0 for s, b in zip(scale, level[0]))],
+                key=lambda level: math.prod(level[0]),
+            )
+            kernel = [s // b for s, b in zip(scale, base_scale)]
 
-        loss = 0
+            if all(k == 1 for k in kernel):
+                if y_mean is None and input is not None:
+                    # Masked pixels are given zero weight by the valid fraction downstream
+                    y_mean = target
+                yield i, x_mean, y_mean, frac
+                continue
 
-        for scale in self.scales:
-            y_hat_coarse = F.avg_pool3d(input, kernel_size=list(scale))
-            y_coarse = F.avg_pool3d(target, kernel_size=list(scale))
-            loss += torch.nanmean(F.l1_loss(y_hat_coarse, y_coarse, reduction="none"))
+            new_frac = F.avg_pool3d(frac, kernel_size=kernel)
+            if input is not None:
+                x_mean = F.avg_pool3d(x_mean, kernel_size=kernel)
+                if y_mean is None:
+                    y_mean = F.avg_pool3d(target, kernel_size=kernel)
+                    y_mean = y_mean - self.mask_value * (1 - new_frac)
+                else:
+                    y_mean = F.avg_pool3d(y_mean, kernel_size=kernel)
+            frac = new_frac
+
+            levels.append((scale, x_mean, y_mean, frac))
+            yield i, x_mean, y_mean, frac
+
+    def masked_terms(
+        self, input: torch.Tensor, target: torch.Tensor
+    ) -> list[tuple[float, torch.Tensor, torch.Tensor]]:
+        """Return the weight, masked error sum and valid cell count of each scale"""
+
+        terms = []
+        for i, x_mean, y_mean, frac in self._pyramid(input, target):
+            valid_cells = frac > 0
+            error = (x_mean - y_mean).abs() / torch.where(valid_cells, frac, 1)
+            error_sum = torch.where(valid_cells, error, 0).sum()
+            terms.append((self.weights[i], error_sum, valid_cells.sum().to(error_sum.dtype)))
+        return terms
+
+    def valid_counts(self, target: torch.Tensor) -> torch.Tensor:
+        """Return the valid cell count of each scale, in the same order as `masked_terms`"""
+        return torch.stack([(frac > 0).sum() for _, _, _, frac in self._pyramid(None, target)])
+
+    def __call__(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """Return loss"""
 
-        return loss / len(self.scales)
+        # If there are no valid targets this returns NaN, like the other losses
+        return combine_masked_terms(self.masked_terms(input, target))
@@ -193,22 +193,47 @@ class Decoder(nn.Module):
     
 class Mid_Xnet(nn.Module):
     
-    def __init__(self, channel_in, channel_hid, N_T, incep_ker = [3,5,7,11], groups=8):
+    def __init__(
+        self, 
+        channel_in, 
+        channel_hid, 
+        N_T, 
+        incep_ker=[3,5,7,11], 
+        groups=8, 
+        layer_specs=None
+    ):
         super(Mid_Xnet, self).__init__()
 
         self.N_T = N_T
-        enc_layers = [Inception(channel_in, channel_hid//2, channel_hid, incep_ker= incep_ker, groups=groups)]
-        for i in range(1, N_T-1):
-            enc_layers.append(Inception(channel_hid, channel_hid//2, channel_hid, incep_ker= incep_ker, groups=groups))
-        enc_layers.append(Inception(channel_hid, channel_hid//2, channel_hid, incep_ker= incep_ker, groups=groups))
 
-        dec_layers = [Inception(channel_hid, channel_hid//2, channel_hid, incep_ker= incep_ker, groups=groups)]
-        for i in range(1, N_T-1):
-            dec_layers.append(Inception(2*channel_hid, channel_hid//2, channel_hid, incep_ker= incep_ker, groups=groups))
-        dec_layers.append(Inception(2*channel_hid, channel_hid//2, channel_in, incep_ker= incep_ker, groups=groups))
+        # The (input, output) channels of the encoder and then decoder Inception layers
+        layer_channels = (
+            [(channel_in, channel_hid)] 
+            + [(channel_hid, channel_hid)]*(N_T-1)
+            + [(channel_hid, channel_hid)] 
+            + [(2*channel_hid, channel_hid)]*(N_T-2) 
+            + [(2*channel_hid, channel_in)]
+        )
+
+        # Optionally each layer can have its own kernels, hidden channels and groups. e.g. after
+        # pruning
+        if layer_specs is None:
+            layer_specs = [dict(incep_ker=incep_ker, C_hid=channel_hid//2)]*(2*N_T)
+        assert len(layer_specs)==2*N_T
+
+        layers = [
+            Inception(
+                C_in, 
+                spec["C_hid"], 
+                C_out, 
+                incep_ker=spec["incep_ker"], 
+                groups=spec.get("groups", groups),
+            )
+            for (C_in, C_out), spec in zip(layer_channels, layer_specs)
+        ]
 
-        self.enc = nn.Sequential(*enc_layers)
-        self.dec = nn.Sequential(*dec_layers)
+        self.enc = nn.Sequential(*layers[:N_T])
+        self.dec = nn.Sequential(*layers[N_T:])
 
     def forward(self, x):
         B, T, C, H, W = x.shape
@@ -244,18 +269,44 @@ class SimVP(nn.Module):
         N_S=4,
         N_T=8, 
         incep_ker=[3,5,7,11], 
-        groups=8
+        groups=8,
+        mid_layer_specs=None,
     ):
         super(SimVP, self).__init__()
                 
         self.enc = Encoder(num_channels, hid_S, N_S)
-        self.hid = Mid_Xnet(history_len*hid_S, hid_T, N_T, incep_ker, groups)
+        self.hid = Mid_Xnet(history_len*hid_S, hid_T, N_T, incep_ker, groups, mid_layer_specs)
         self.dec = Decoder(hid_S, num_channels, N_S)
         self.spatial_size = spatial_size
-
-
-    def forward(self, x_raw):
+        self.encoder_frozen = False
+        self.decoder_frozen = False
+
+    def freeze_encoder(self, train_decoder=True):
+        """Freeze the encoder, and optionally the decoder, so only the rest are trained"""
+        frozen = [self.enc] if train_decoder else [self.enc, self.dec]
+        for module in frozen:
+            for param in module.parameters():
+                param.requires_grad = False
+        self.encoder_frozen = True
+        self.decoder_frozen = not train_decoder
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        # Keep the frozen parts in eval mode
+        if self.encoder_frozen:
+            self.enc.eval()
+        if self.decoder_frozen:
+            self.dec.eval()
+        return self
+
+    def encode(self, x_raw):
+        """Run the encoder on each input frame
         
+        Returns:
+            embed: The latent of each frame with shape (batch, time, hid_S, height', width')
+            skip: The skip connection of each frame with shape (batch, time, hid_S, height, width)
+        """
         # Pad out to a multiple of downsample factor
         #pad_top = pad_left = 0
         #downsample_factor = (N_S // 2)*2
@@ -269,18 +320,54 @@ class SimVP(nn.Module):
         B, T, C, H, W = x_raw.shape
         x = x_raw.reshape(B*T, C, H, W)
 
-        embed, skip = self.enc(x)
-        _, C_, H_, W_ = embed.shape
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.encoder_frozen):
+            embed, skip = self.enc(x)
+
+        embed = embed.view(B, T, *embed.shape[1:])
+        skip = skip.view(B, T, *skip.shape[1:])
+        return embed, skip
 
-        z = embed.view(B, T, C_, H_, W_)
-        hid = self.hid(z)
+    def encode_skip(self, x_raw):
+        """Run only the first encoder layer on each input frame to get the skip connection
+
+        This is much cheaper than the full encoder, so the skip connection doesn't need to be
+        stored in the latent cache.
+
+        Returns:
+            skip: The skip connection of each frame with shape (batch, time, hid_S, height, width)
+        """
+        x_raw = x_raw.permute(0,2,1,3,4)
+        B, T, C, H, W = x_raw.shape
+        x = x_raw.reshape(B*T, C, H, W)
+
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.encoder_frozen):
+            skip = self.enc.encoder_layers[0](x)
+
+        return skip.view(B, T, *skip.shape[1:])
+
+    def forward_latents(self, embed, skip):
+        """Run the translator and decoder on the encoder outputs"""
+        B, T, C_, H_, W_ = embed.shape
+
+        hid = self.hid(embed)
         hid = hid.reshape(B*T, C_, H_, W_)
 
-        Y = self.dec(hid, skip)
-        Y = Y.reshape(B, T, C, H, W)
+        Y = self.dec(hid, skip.reshape(B*T, *skip.shape[2:]))
+        Y = Y.reshape(B, T, *Y.shape[1:])
         
         Y = Y.permute(0,2,1,3,4)
 
         # Remove padding
         # Y = Y[..., :self.spatial_size[0]-pad_bottom, :self.spatial_size[1]-pad_right]
-        return Y
\ No newline at end of file
+        return Y
+
+    def forward(self, x_raw):
+        # The input can also be a tuple of the precomputed encoder output and the input frames,
+        # from which the skip connection is recomputed
+        if isinstance(x_raw, (tuple, list)):
+            dtype = self.dec.readout.weight.dtype
+            embed, x_raw = [x.to(dtype) for x in x_raw]
+            skip = self.encode_skip(x_raw)
+        else:
+            embed, skip = self.encode(x_raw)
+        return self.forward_latents(embed, skip)
@@ -0,0 +1,218 @@
+"""Train several models in lockstep on a single stream of batches
+
+Comparing model configs normally means running a separate training job for each one, and each job
+loads and decodes the same satellite data. `MultiModelTrainingModule` wraps several
+`TrainingModule` trials and trains them all on each batch from a single datamodule, so the cost
+of loading the data is shared between the trials. Each trial keeps its own optimizer and
+learning rate scheduler, logs its metrics under its own prefix, and is checkpointed to its own
+directory by `TrialCheckpoint` in the same format as a single training run.
+"""
+
+import os
+from glob import glob
+
+import torch
+import lightning.pytorch as pl
+
+from sat_pred.loss import combine_masked_terms, distributed_masked_loss
+from sat_pred.training_module import TrainingModule
+
+
+class MultiModelTrainingModule(pl.LightningModule):
+
+    def __init__(
+        self,
+        trials: dict[str, TrainingModule],
+        accumulate_grad_batches: int = 1,
+        gradient_clip_val: float | None = None,
+    ):
+        """Lightning module which trains several models in lockstep on the same batches
+
+        The trials are optimized manually, so gradient accumulation and clipping are done here
+        and must not be set in the trainer. Lightning counts each optimizer step in the trainer's
+        `global_step`, so this advances by the number of trials on each optimization step.
+        The validation videos of the trials are not uploaded.
+
+        The trial losses are normalised by their valid target counts summed over all devices and
+        summed into a single loss for the backward pass, as in `TrainingModule` with multiple
+        GPUs. So every device runs one backward pass through all of the trials on every step,
+        which DDP requires, even when some devices have no valid targets.
+
+        Args:
+            trials: The training modules to train, keyed by the trial name used to prefix their
+                logged metrics
+            accumulate_grad_batches: The number of batches to accumulate gradients over
+            gradient_clip_val: If set, the gradient norm of each trial is clipped to this value
+        """
+        super().__init__()
+        self.automatic_optimization = False
+
+        self.trials = torch.nn.ModuleDict(trials)
+        self.accumulate_grad_batches = accumulate_grad_batches
+        self.gradient_clip_val = gradient_clip_val
+
+        # The plateau scheduler of each trial and the metric it monitors
+        self._plateau_schedulers = {}
+
+    def configure_optimizers(self):
+        optimizers, schedulers = [], []
+
+        for name, trial in self.trials.items():
+            config = trial.configure_optimizers()
+            if isinstance(config, torch.optim.Optimizer):
+                optimizers.append(config)
+                continue
+
+            [opt], trial_schedulers = config
+            optimizers.append(opt)
+            for sch in trial_schedulers:
+                if isinstance(sch, dict):
+                    self._plateau_schedulers[name] = (sch["scheduler"], f"{name}/{sch['monitor']}")
+                    sch = sch["scheduler"]
+                schedulers.append(sch)
+
+        return optimizers, schedulers
+
+    def training_step(self, batch, batch_idx: int) -> None:
+        """Run a training step of every trial on the batch"""
+        X, y = batch
+        optimizers = self.optimizers()
+        if not isinstance(optimizers, list):
+            optimizers = [optimizers]
+
+        # Sum the valid target counts of each trial over all devices in a single reduction
+        local_counts = [trial._target_valid_counts(y) for trial in self.trials.values()]
+        global_counts = self.trainer.strategy.reduce(torch.cat(local_counts), reduce_op="sum")
+        global_counts = global_counts.split([len(c) for c in local_counts])
+
+        losses = {}
+        train_loss = 0
+        for (name, trial), trial_counts in zip(self.trials.items(), global_counts):
+            y_hat = trial(X)
+            terms = trial._calculate_loss_terms(y, y_hat)
+            trial_losses = {k: combine_masked_terms(v) for k, v in terms.items()}
+
+            losses.update(
+                {f"{name}/{k}/train": v.detach().cpu().item() for k, v in trial_losses.items()}
+            )
+
+            # Unlike the local masked mean, this is zero rather than NaN when there are no valid
+            # targets, so the trial still contributes zero gradients
+            train_loss = train_loss + distributed_masked_loss(
+                terms[trial._target_loss_name], trial_counts, self.trainer.world_size
+            )
+
+        self.log_dict(losses, on_step=True, on_epoch=True)
+        self.manual_backward(train_loss / self.accumulate_grad_batches)
+
+        if (batch_idx + 1) % self.accumulate_grad_batches == 0 or self.trainer.is_last_batch:
+            for opt in optimizers:
+                opt.step()
+                opt.zero_grad()
+
+    def on_before_optimizer_step(self, optimizer: torch.optim.Optimizer) -> None:
+        """Clip the gradients of the trial being stepped
+
+        With mixed precision, lightning unscales the gradients before this hook is called, so
+        the norm is clipped on the true gradients rather than the loss-scaled ones.
+        """
+        if self.gradient_clip_val is not None:
+            self.clip_gradients(
+                optimizer,
+                gradient_clip_val=self.gradient_clip_val,
+                gradient_clip_algorithm="norm",
+            )
+
+    def validation_step(self, batch, batch_idx: int) -> None:
+        """Run a validation step of every trial on the batch"""
+        X, y = batch
+
+        losses = {}
+        for name, trial in self.trials.items():
+            y_hat = trial(X)
+            trial_losses = trial._calculate_common_losses(y, y_hat)
+            trial_losses.update(trial._calculate_val_losses(y, y_hat))
+            losses.update({f"{name}/{k}/val": v.item() for k, v in trial_losses.items()})
+
+        # Occasionally y will be entirely NaN and the losses are NaN. We filter these out
+        losses = {k: v for k, v in losses.items() if v == v}
+        self.log_dict(losses, on_step=False, on_epoch=True)
+
+    def on_validation_end(self) -> None:
+        """Step the plateau schedulers on each trial's validation loss"""
+        if self.trainer.sanity_checking:
+            return
+
+        for scheduler, monitor in self._plateau_schedulers.values():
+            if monitor in self.trainer.callback_metrics:
+                scheduler.step(self.trainer.callback_metrics[monitor])
+
+    def on_validation_epoch_end(self) -> None:
+        # Clear cache at the end of validation
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class TrialCheckpoint(pl.Callback):
+
+    def __init__(self, dirpath: str, mode: str = "min"):
+        """Callback to checkpoint each trial of a MultiModelTrainingModule to its own directory
+
+        After each validation the last state of each trial is saved to `last.ckpt`, and the best
+        state on the trial's target validation loss to `epoch={epoch}-step={step}.ckpt`. Only
+        the best checkpoint is kept, so a trial directory can be loaded with
+        `get_model_from_checkpoints` once its configs are saved there.
+
+        Args:
+            dirpath: The directory to save the trial directories in
+            mode: Whether the best checkpoint has the "min" or "max" validation loss
+        """
+        super().__init__()
+        self.dirpath = dirpath
+        self.mode = mode
+        self.best_scores = {}
+
+    def trial_dir(self, name: str) -> str:
+        return f"{self.dirpath}/{name}"
+
+    def _save(self, trainer: pl.Trainer, trial: TrainingModule, path: str) -> None:
+        checkpoint = {
+            "epoch": trainer.current_epoch,
+            "global_step": trainer.global_step,
+            "state_dict": trial.state_dict(),
+        }
+        torch.save(checkpoint, path)
+
+    def on_validation_end(
+        self, trainer: pl.Trainer, pl_module: MultiModelTrainingModule
+    ) -> None:
+        if trainer.sanity_checking or not trainer.is_global_zero:
+            return
+
+        for name, trial in pl_module.trials.items():
+            trial_dir = self.trial_dir(name)
+            os.makedirs(trial_dir, exist_ok=True)
+            self._save(trainer, trial, f"{trial_dir}/last.ckpt")
+
+            monitor = f"{name}/{trial._target_loss_name}/val"
+            score = trainer.callback_metrics.get(monitor)
+            if score is None:
+                continue
+            score = float(score)
+
+            best = self.best_scores.get(name)
+            if best is None or (score < best if self.mode == "min" else score > best):
+                self.best_scores[name] = score
+                for path in glob(f"{trial_dir}/epoch=*.ckpt"):
+                    os.remove(path)
+                self._save(
+                    trainer,
+                    trial,
+                    f"{trial_dir}/epoch={trainer.current_epoch}-step={trainer.global_step}.ckpt",
+                )
+
+    def state_dict(self) -> dict:
+        return {"best_scores": self.best_scores}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.best_scores = state_dict["best_scores"]
@@ -1,6 +1,11 @@
 import torch
 from sat_pred.loss import LossFunction
 
+
+def trainable_parameters(model):
+    """Return the parameters of the model which are not frozen"""
+    return [p for p in model.parameters() if p.requires_grad]
+
 class AdamW:
     """AdamW optimizer"""
 
@@ -11,7 +16,7 @@ class AdamW:
 
     def __call__(self, model):
         """Return optimizer"""
-        return torch.optim.AdamW(model.parameters(), lr=self.lr, **self.kwargs)
+        return torch.optim.AdamW(trainable_parameters(model), lr=self.lr, **self.kwargs)
 
     
 class AdamWReduceLROnPlateau:
@@ -31,7 +36,7 @@ class AdamWReduceLROnPlateau:
     def __call__(self, model):
 
         opt = torch.optim.AdamW(
-            model.parameters(), lr=self.lr, **self.opt_kwargs
+            trainable_parameters(model), lr=self.lr, **self.opt_kwargs
         )
 
         if isinstance(model.target_loss, str):
@@ -0,0 +1,252 @@
+"""Latency-aware structured pruning of the Inception branches and channels in SimVP"""
+
+import copy
+import time
+
+import torch
+from torch import nn
+
+from sat_pred.models.simvp_model import GroupConv2d, Inception, SimVP
+
+
+def inception_layers(model: SimVP) -> list[Inception]:
+    """Return the Inception layers of the SimVP translator in the order of `mid_layer_specs`"""
+    return list(model.hid.enc) + list(model.hid.dec)
+
+
+def layer_specs(model: SimVP) -> list[dict]:
+    """Return the kernels, hidden channels and groups of each Inception layer"""
+    return [
+        dict(
+            incep_ker=[branch.model[0].kernel_size[0] for branch in layer.layers],
+            C_hid=layer.conv1.out_channels,
+            groups=layer.layers[0].model[0].groups,
+        )
+        for layer in inception_layers(model)
+    ]
+
+
+class CalibrationStats:
+    def __init__(self, model: SimVP):
+        """Accumulate branch contributions and channel activations over calibration batches
+
+        The contribution of each branch is measured as the mean absolute value of its output,
+        relative to the other branches of the same layer. The importance of each hidden channel
+        is the mean absolute value of its activation, weighted by the magnitude of the branch
+        weights which read from it.
+
+        Args:
+            model: The model to calibrate
+        """
+        self.layers = inception_layers(model)
+        self.branch_magnitude = [torch.zeros(len(layer.layers)) for layer in self.layers]
+        self.channel_magnitude = [torch.zeros(layer.conv1.out_channels) for layer in self.layers]
+        self.branch_inputs = [None] * len(self.layers)
+        self._handles = []
+
+        for n, layer in enumerate(self.layers):
+            self._handles.append(layer.conv1.register_forward_hook(self._conv1_hook(n)))
+            for b, branch in enumerate(layer.layers):
+                self._handles.append(branch.register_forward_hook(self._branch_hook(n, b)))
+
+    def _conv1_hook(self, n: int):
+        def hook(module, inputs, output):
+            self.channel_magnitude[n] += output.detach().abs().mean(dim=(0, 2, 3)).cpu()
+        return hook
+
+    def _branch_hook(self, n: int, b: int):
+        def hook(module, inputs, output):
+            self.branch_magnitude[n][b] += output.detach().abs().mean().cpu()
+            if self.branch_inputs[n] is None:
+                # Keep a single input of each layer to measure the branch latencies
+                self.branch_inputs[n] = inputs[0][:1].detach().cpu()
+        return hook
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+
+    def branch_contributions(self) -> list[torch.Tensor]:
+        """The fraction of each layer's output magnitude contributed by each branch"""
+        return [m / m.sum() for m in self.branch_magnitude]
+
+    def channel_importance(self) -> list[torch.Tensor]:
+        importance = []
+        for layer, magnitude in zip(self.layers, self.channel_magnitude):
+            weight_magnitude = 0
+            for branch in layer.layers:
+                conv = branch.model[0]
+                # Sum the weight magnitudes over outputs and kernel positions for each input
+                # position within its group, then map back to the hidden channel index
+                w = conv.weight.detach().abs().cpu()
+                group_size_out = conv.out_channels // conv.groups
+                per_input = torch.stack(
+                    [
+                        w[g*group_size_out:(g+1)*group_size_out].sum(dim=(0, 2, 3))
+                        for g in range(conv.groups)
+                    ]
+                ).flatten()
+                weight_magnitude = weight_magnitude + per_input
+            importance.append(magnitude * weight_magnitude)
+        return importance
+
+
+@torch.no_grad()
+def measure_branch_latency(
+    layer: Inception, x: torch.Tensor, n_repeats: int = 5
+) -> torch.Tensor:
+    """Measure the CPU latency of each branch of an Inception layer in seconds"""
+    latencies = []
+    for branch in layer.layers:
+        branch = copy.deepcopy(branch).cpu().eval()
+        branch(x)
+        t0 = time.perf_counter()
+        for _ in range(n_repeats):
+            branch(x)
+        latencies.append((time.perf_counter() - t0) / n_repeats)
+    return torch.tensor(latencies)
+
+
+def select_branches(
+    contributions: list[torch.Tensor],
+    latencies: list[torch.Tensor],
+    target_latency_fraction: float,
+    min_branches: int = 1,
+) -> list[list[int]]:
+    """Greedily remove the branches with the least contribution per unit latency
+
+    Args:
+        contributions: The contribution of each branch in each layer
+        latencies: The latency of each branch in each layer
+        target_latency_fraction: Branches are removed until the total branch latency is below
+            this fraction of the original
+        min_branches: The minimum number of branches to keep in each layer
+
+    Returns:
+        The indices of the branches to keep in each layer
+    """
+    keep = [list(range(len(c))) for c in contributions]
+    total_latency = sum(lat.sum().item() for lat in latencies)
+    latency = total_latency
+
+    candidates = sorted(
+        [
+            (contributions[n][b].item() / latencies[n][b].item(), n, b)
+            for n in range(len(contributions))
+            for b in range(len(contributions[n]))
+        ]
+    )
+
+    for _, n, b in candidates:
+        if latency <= target_latency_fraction * total_latency:
+            break
+        if len(keep[n]) <= min_branches:
+            continue
+        keep[n].remove(b)
+        latency -= latencies[n][b].item()
+
+    return keep
+
+
+def select_channels(
+    importance: list[torch.Tensor], groups: list[int], keep_ratio: float
+) -> list[torch.Tensor]:
+    """Select the most important hidden channels of each layer
+
+    The same number of channels is kept in each group so the grouped convolutions keep the same
+    number of groups.
+
+    Args:
+        importance: The importance of each hidden channel in each layer
+        groups: The number of groups of the branch convolutions in each layer
+        keep_ratio: The fraction of the hidden channels to keep
+
+    Returns:
+        The sorted indices of the hidden channels to keep in each layer
+    """
+    keep = []
+    for imp, g in zip(importance, groups):
+        group_size = len(imp) // g
+        n_keep = max(1, round(group_size * keep_ratio))
+        per_group = imp.reshape(g, group_size).topk(n_keep, dim=1).indices.sort(dim=1).values
+        keep.append((per_group + torch.arange(g)[:, None] * group_size).flatten())
+    return keep
+
+
+def _prune_layer(
+    old: Inception, new: Inception, keep_branches: list[int], keep_channels: torch.Tensor
+) -> None:
+    """Copy the kept weights of an Inception layer into its pruned replacement"""
+
+    new.conv1.weight.copy_(old.conv1.weight[keep_channels])
+    new.conv1.bias.copy_(old.conv1.bias[keep_channels])
+
+    for new_branch, b in zip(new.layers, keep_branches):
+        old_branch: GroupConv2d = old.layers[b]
+        old_conv, new_conv = old_branch.model[0], new_branch.model[0]
+
+        # Each output group reads from its own block of the hidden channels. Find the positions
+        # within each block which are kept
+        groups = old_conv.groups
+        old_group_size = old_conv.in_channels // groups
+        positions = (keep_channels % old_group_size).reshape(groups, -1)
+        out_group_size = old_conv.out_channels // groups
+
+        weight = torch.cat(
+            [
+                old_conv.weight[g*out_group_size:(g+1)*out_group_size][:, positions[g]]
+                for g in range(groups)
+            ]
+        )
+        new_conv.weight.copy_(weight)
+        new_conv.bias.copy_(old_conv.bias)
+
+        # Copy the GroupNorm parameters
+        new_branch.model[1].load_state_dict(old_branch.model[1].state_dict())
+
+
+@torch.no_grad()
+def prune_simvp(
+    model: SimVP,
+    model_kwargs: dict,
+    keep_branches: list[list[int]],
+    keep_channels: list[torch.Tensor],
+) -> tuple[SimVP, dict]:
+    """Build a smaller SimVP with the selected branches and channels and copy in the weights
+
+    Args:
+        model: The model to prune
+        model_kwargs: The keyword arguments used to construct the model
+        keep_branches: The indices of the branches to keep in each Inception layer
+        keep_channels: The indices of the hidden channels to keep in each Inception layer
+
+    Returns:
+        The pruned model and the keyword arguments to construct it
+    """
+    specs = layer_specs(model)
+    new_specs = [
+        dict(
+            incep_ker=[spec["incep_ker"][b] for b in branches],
+            C_hid=len(channels),
+            groups=spec["groups"],
+        )
+        for spec, branches, channels in zip(specs, keep_branches, keep_channels)
+    ]
+
+    new_kwargs = {**model_kwargs, "mid_layer_specs": new_specs}
+    new_model = SimVP(**{k: v for k, v in new_kwargs.items() if k != "_target_"})
+
+    # The encoder and decoder are unchanged
+    new_model.enc.load_state_dict(model.enc.state_dict())
+    new_model.dec.load_state_dict(model.dec.state_dict())
+
+    for old, new, branches, channels in zip(
+        inception_layers(model), inception_layers(new_model), keep_branches, keep_channels
+    ):
+        _prune_layer(old, new, branches, channels)
+
+    return new_model, new_kwargs
+
+
+def count_parameters(model: nn.Module) -> int:
+    return sum(p.numel() for p in model.parameters())
@@ -0,0 +1,154 @@
+"""Keep a fixed subset of the validation samples resident in memory across epochs
+
+The validation dataloader isn't shuffled and only the first `limit_val_batches` batches are used,
+so every validation epoch reads and decodes the same samples from the zarr. `ResidentDataset`
+stores these samples as float16 the first time they are loaded and serves them from memory on
+later epochs. The store is either shared memory or a memory-mapped file on local disk, so samples
+loaded by the dataloader workers are visible to the workers of later epochs.
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+
+class ResidentDataset(Dataset):
+    def __init__(
+        self,
+        dataset: Dataset,
+        num_samples: int | None = None,
+        max_gb: float = 8.0,
+        mmap_dir: str | None = None,
+    ):
+        """Wrap a satellite dataset so its first samples are kept in memory once loaded
+
+        Samples are indexed by position or by t0 time like the wrapped dataset. Samples outside
+        the resident subset are streamed from the wrapped dataset. Samples requested by t0 time
+        in the main process, e.g. for the validation videos, are also kept in memory.
+
+        Args:
+            dataset: The satellite dataset to wrap
+            num_samples: The number of samples, from the start of the dataset, to keep resident.
+                Defaults to the whole dataset
+            max_gb: The maximum size of the resident store. If the samples don't all fit, only
+                as many as fit are kept resident and the rest are streamed
+            mmap_dir: If set, the samples are stored in memory-mapped files in this directory
+                rather than in shared memory
+        """
+        self.dataset = dataset
+
+        X, y = dataset[0]
+        self.shapes = {"X": X.shape, "y": y.shape}
+        sample_bytes = (X.size + y.size) * np.dtype(np.float16).itemsize
+
+        num_samples = len(dataset) if num_samples is None else min(num_samples, len(dataset))
+        max_samples = int(max_gb * 1e9 // sample_bytes)
+        if num_samples > max_samples:
+            print(
+                f"{num_samples} resident samples would need {num_samples * sample_bytes / 1e9:.1f}"
+                f" GB. Keeping {max_samples} resident and streaming the rest"
+            )
+            num_samples = max_samples
+
+        if mmap_dir is not None:
+            mmap_dir = os.path.expanduser(mmap_dir)
+
+        self.num_samples = num_samples
+        self.mmap_dir = mmap_dir
+
+        if mmap_dir is None:
+            self._store = {
+                k: torch.empty((num_samples, *shape), dtype=torch.float16).share_memory_()
+                for k, shape in self.shapes.items()
+            }
+            self._filled = torch.zeros(num_samples, dtype=torch.bool).share_memory_()
+        else:
+            os.makedirs(mmap_dir, exist_ok=True)
+            for k, shape in self.shapes.items():
+                np.lib.format.open_memmap(
+                    f"{mmap_dir}/{k}.npy", mode="w+", dtype=np.float16, shape=(num_samples, *shape)
+                )
+            np.save(f"{mmap_dir}/filled.npy", np.zeros(num_samples, dtype=bool))
+            # The memory maps are opened lazily so each dataloader worker opens its own
+            self._store = None
+            self._filled = None
+
+        # Samples requested by t0 time outside the resident subset. These are only requested in
+        # the main process so don't need to be shared
+        self._keyed = {}
+
+        if num_samples > 0:
+            self._put(0, X, y)
+
+        print(
+            f"Keeping {num_samples} validation samples resident "
+            f"({num_samples * sample_bytes / 1e9:.1f} GB)"
+        )
+
+    def __getattr__(self, name: str):
+        # Pass through the attributes of the wrapped dataset, e.g. `ds` and `t0_times`
+        if name == "dataset":
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if self.mmap_dir is not None:
+            state["_store"] = None
+            state["_filled"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def _open(self) -> None:
+        if self._store is None:
+            self._store = {
+                k: torch.from_numpy(np.load(f"{self.mmap_dir}/{k}.npy", mmap_mode="r+"))
+                for k in self.shapes
+            }
+            self._filled = torch.from_numpy(np.load(f"{self.mmap_dir}/filled.npy", mmap_mode="r+"))
+
+    def _put(self, idx: int, X: np.ndarray, y: np.ndarray) -> None:
+        self._open()
+        self._store["X"][idx] = torch.from_numpy(X)
+        self._store["y"][idx] = torch.from_numpy(y)
+        # The flag is set last so a partly written sample is never served
+        self._filled[idx] = True
+
+    @property
+    def num_filled(self) -> int:
+        self._open()
+        return int(self._filled.sum())
+
+    def _index(self, key: int | str | datetime | pd.Timestamp) -> int:
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.dataset.t0_times.get_loc(pd.Timestamp(key))
+
+    def __getitem__(self, key: int | str | datetime | pd.Timestamp) -> tuple[np.ndarray, np.ndarray]:
+        self._open()
+        idx = self._index(key)
+
+        if idx < self.num_samples:
+            if not self._filled[idx]:
+                self._put(idx, *self.dataset[idx])
+            # Serve the stored float16 values on the first load too, so the results don't depend
+            # on whether a sample was already resident
+            return (
+                self._store["X"][idx].numpy().astype(np.float32),
+                self._store["y"][idx].numpy().astype(np.float32),
+            )
+
+        if not isinstance(key, (int, np.integer)):
+            if idx not in self._keyed:
+                X, y = self.dataset[idx]
+                self._keyed[idx] = (X.astype(np.float16), y.astype(np.float16))
+            X, y = self._keyed[idx]
+            return X.astype(np.float32), y.astype(np.float32)
+
+        return self.dataset[idx]
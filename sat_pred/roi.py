@@ -0,0 +1,247 @@
+"""Region-of-interest inference which only reads and forecasts the area around a bounding box
+
+Each output pixel of SimVP only depends on the input pixels within its receptive field, apart from
+through the GroupNorm statistics. So to forecast a sub-region we only need to read and run the
+model on the region padded by the receptive field margin. The GroupNorm statistics of the crop
+differ from the full domain, so the cropped forecast closely matches, but is not identical to,
+the full-domain forecast. Use `scripts/roi_inference_report.py` to check the parity and speed-up.
+
+The saving depends on the receptive field being small compared to the domain, which for the
+UK domain of 372 x 614 pixels is only true of the shallower configs:
+
+- `configs/model/simvp.yaml` (N_S=4, N_T=8) has a receptive field of 671 pixels. The margin of
+  335 pixels is larger than the domain, so every crop covers the full domain and there is no
+  saving.
+- `configs/model/distill_simvp.yaml` (N_S=4, N_T=4) has a receptive field of 351 pixels. Crops
+  span the full height of the domain but only part of its width.
+- `configs/model/simvp_v2.yaml` (N_S=2, N_T=4) has a receptive field of 171 pixels, so a 64
+  pixel region only needs a crop of about a quarter of the domain.
+
+`ROIForecaster` warns, or raises, when the padded crop covers the full domain.
+"""
+
+import warnings
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import torch
+import xarray as xr
+
+from sat_pred.models.simvp_model import ConvSC, SimVP
+
+
+def _conv_params(conv_sc: ConvSC) -> tuple[int, int]:
+    conv = conv_sc.model.model[0]
+    return conv.kernel_size[0], conv.stride[0]
+
+
+def simvp_receptive_field(model: SimVP) -> tuple[int, int]:
+    """Calculate the receptive field of SimVP in input pixels
+
+    The receptive field follows the longest path through the model, which is through every layer
+    of the encoder, translator and decoder. Each Inception layer is counted with its largest
+    kernel. The transposed convolutions are counted conservatively as if they had the receptive
+    field of a normal convolution at their input resolution.
+
+    Returns:
+        receptive_field: The width of the receptive field in input pixels
+        downsample_factor: The total stride of the encoder. Crops must be aligned to this so the
+            latent grid of the crop lines up with the latent grid of the full domain
+    """
+    receptive_field = 1
+    jump = 1
+
+    for layer in model.enc.encoder_layers:
+        kernel_size, stride = _conv_params(layer)
+        receptive_field += (kernel_size - 1) * jump
+        jump *= stride
+
+    downsample_factor = jump
+
+    for inception in list(model.hid.enc) + list(model.hid.dec):
+        kernel_size = max(branch.model[0].kernel_size[0] for branch in inception.layers)
+        receptive_field += (kernel_size - 1) * jump
+
+    for layer in model.dec.decoder_layers:
+        kernel_size, stride = _conv_params(layer)
+        receptive_field += (kernel_size - 1) * jump
+        jump //= stride
+
+    return receptive_field, downsample_factor
+
+
+@dataclass
+class ROIWindow:
+    """Index slices of a region of interest and of the padded crop around it"""
+
+    y_crop: slice
+    x_crop: slice
+    y_roi: slice
+    x_roi: slice
+
+    @property
+    def crop_shape(self) -> tuple[int, int]:
+        return self.y_crop.stop - self.y_crop.start, self.x_crop.stop - self.x_crop.start
+
+
+def _index_range(coord: np.ndarray, bounds: tuple[float, float]) -> tuple[int, int]:
+    """Find the first and last index of a coordinate within the bounds"""
+    lower, upper = min(bounds), max(bounds)
+    (indices,) = np.nonzero((coord >= lower) & (coord <= upper))
+    if len(indices) == 0:
+        raise ValueError(f"No grid points within {bounds}")
+    return indices[0], indices[-1] + 1
+
+
+def _padded_slice(start: int, stop: int, margin: int, align: int, size: int) -> slice:
+    """Pad an index range by the margin, aligned to the downsample factor and clipped to the grid"""
+    padded_start = max(0, start - margin) // align * align
+    padded_stop = min(size, -(-(stop + margin) // align) * align)
+    return slice(padded_start, padded_stop)
+
+
+def roi_window(
+    ds: xr.Dataset,
+    x_bounds: tuple[float, float],
+    y_bounds: tuple[float, float],
+    margin: int,
+    align: int = 1,
+) -> ROIWindow:
+    """Find the padded crop needed to forecast a bounding box
+
+    Args:
+        ds: The satellite dataset
+        x_bounds: The bounds of the region in `x_geostationary` coordinates
+        y_bounds: The bounds of the region in `y_geostationary` coordinates
+        margin: The number of pixels to pad the region by on each side
+        align: The crop start is aligned to a multiple of this from the edge of the full grid
+    """
+    y0, y1 = _index_range(ds.y_geostationary.values, y_bounds)
+    x0, x1 = _index_range(ds.x_geostationary.values, x_bounds)
+
+    y_crop = _padded_slice(y0, y1, margin, align, len(ds.y_geostationary))
+    x_crop = _padded_slice(x0, x1, margin, align, len(ds.x_geostationary))
+
+    return ROIWindow(
+        y_crop=y_crop,
+        x_crop=x_crop,
+        y_roi=slice(y0 - y_crop.start, y1 - y_crop.start),
+        x_roi=slice(x0 - x_crop.start, x1 - x_crop.start),
+    )
+
+
+class ROIForecaster:
+    def __init__(
+        self,
+        model: SimVP,
+        ds: xr.Dataset,
+        history_mins: int,
+        nan_to_num: bool = False,
+        extra_margin: int = 0,
+        device: torch.device | str = "cpu",
+        full_domain_action: str = "warn",
+    ):
+        """Forecast a region of interest by running SimVP on a padded crop around it
+
+        Only the zarr chunks which overlap the padded crop are read.
+
+        Args:
+            model: The SimVP model
+            ds: The satellite dataset, already filtered to the model's sample frequency
+            history_mins: How many minutes of history the model uses as input
+            nan_to_num: Whether to convert NaNs to -1
+            extra_margin: Extra pixels to pad the crop by beyond the receptive field. Increasing
+                this reduces the difference from the full-domain forecast caused by GroupNorm
+            device: The device to run the model on
+            full_domain_action: What to do when the padded crop covers the full domain, so there
+                is no saving over a full-domain forecast. "warn" or "raise"
+        """
+        if full_domain_action not in ["warn", "raise"]:
+            raise ValueError(f"Unknown full_domain_action: {full_domain_action}")
+
+        self.model = model.to(device).eval()
+        self.ds = ds
+        self.history_mins = history_mins
+        self.nan_to_num = nan_to_num
+        self.device = device
+        self.full_domain_action = full_domain_action
+
+        receptive_field, self.downsample_factor = simvp_receptive_field(model)
+        self.margin = receptive_field // 2 + extra_margin
+
+        self.domain_shape = len(ds.y_geostationary), len(ds.x_geostationary)
+        if all(2 * self.margin + 1 >= size for size in self.domain_shape):
+            self._full_domain(
+                f"The receptive field of the model is {receptive_field} pixels, so the margin of "
+                f"{self.margin} pixels makes the crop of any region cover the full "
+                f"{self.domain_shape[0]} x {self.domain_shape[1]} domain"
+            )
+
+    def _full_domain(self, message: str) -> None:
+        message += ". Region-of-interest inference gives no saving over a full-domain forecast"
+        if self.full_domain_action == "raise":
+            raise ValueError(message)
+        warnings.warn(message)
+
+    def window(self, x_bounds: tuple[float, float], y_bounds: tuple[float, float]) -> ROIWindow:
+        window = roi_window(self.ds, x_bounds, y_bounds, self.margin, self.downsample_factor)
+        if window.crop_shape == self.domain_shape:
+            self._full_domain("The padded crop of the region covers the full domain")
+        return window
+
+    def load_input(self, t0: datetime, window: ROIWindow | None = None) -> np.ndarray:
+        """Load the input frames, within the window if given
+
+        Returns:
+            Array with shape (channel, time, height, width)
+        """
+        ds_input = self.ds.sel(time=slice(t0 - timedelta(minutes=self.history_mins), t0))
+        if window is not None:
+            ds_input = ds_input.isel(y_geostationary=window.y_crop, x_geostationary=window.x_crop)
+
+        ds_input = ds_input.transpose("variable", "time", "y_geostationary", "x_geostationary")
+        X = ds_input.data.values
+
+        if self.nan_to_num:
+            X = np.nan_to_num(X, nan=-1)
+
+        return X.astype(np.float32)
+
+    @torch.no_grad()
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Run the model on a single input sample and clip the output"""
+        y_hat = self.model(torch.as_tensor(X, device=self.device)[None])
+        return y_hat[0].clip(0, 1).cpu().numpy()
+
+    def __call__(
+        self,
+        t0: datetime,
+        x_bounds: tuple[float, float],
+        y_bounds: tuple[float, float],
+    ) -> xr.DataArray:
+        """Forecast the region within the bounding box from the given init time
+
+        Args:
+            t0: The init time of the forecast
+            x_bounds: The bounds of the region in `x_geostationary` coordinates
+            y_bounds: The bounds of the region in `y_geostationary` coordinates
+        """
+        window = self.window(x_bounds, y_bounds)
+        y_hat = self.predict(self.load_input(t0, window))
+        y_hat = y_hat[..., window.y_roi, window.x_roi]
+
+        ds_crop = self.ds.isel(y_geostationary=window.y_crop, x_geostationary=window.x_crop)
+
+        return xr.DataArray(
+            y_hat,
+            dims=["variable", "step", "y_geostationary", "x_geostationary"],
+            coords={
+                "variable": self.ds.variable,
+                "step": pd.timedelta_range("15min", periods=y_hat.shape[1], freq="15min"),
+                "y_geostationary": ds_crop.y_geostationary[window.y_roi],
+                "x_geostationary": ds_crop.x_geostationary[window.x_roi],
+            },
+            attrs={"init_time": str(pd.Timestamp(t0))},
+        )
@@ -0,0 +1,150 @@
+"""CPU thread, dataloader worker and core pinning settings for the entry points
+
+On shared CPU hosts the torch intra-op threads of the main process and the dataloader workers
+compete for the same cores. A `RuntimeConfig` records how many of each to use, and optionally
+which cores each should be pinned to, so they don't oversubscribe the host. The configs are
+found for a host and checkpoint with `scripts/tune_workers.py` and saved as YAML, which the
+backtest, validation and training entry points can load.
+"""
+
+import os
+from dataclasses import asdict, dataclass, field
+
+import torch
+import yaml
+
+
+def available_cores() -> list[int]:
+    """The cores this process is allowed to run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def assign_cores(
+    torch_threads: int, num_workers: int, cores: list[int] | None = None
+) -> tuple[list[int], list[list[int]]]:
+    """Split the cores between the main process and the dataloader workers
+
+    The main process is given one core for each of its torch threads. The remaining cores are
+    split evenly between the workers. If there aren't enough cores left, the workers share them.
+
+    Args:
+        torch_threads: The number of torch threads of the main process
+        num_workers: The number of dataloader workers
+        cores: The cores to split. Defaults to the cores available to this process
+
+    Returns:
+        The cores of the main process, and the cores of each worker
+    """
+    cores = available_cores() if cores is None else list(cores)
+    # Leave at least one core for the workers
+    reserved = 1 if num_workers > 0 else 0
+    main_cores = cores[:max(1, min(torch_threads, len(cores) - reserved))]
+    worker_pool = cores[len(main_cores):] or cores
+
+    if num_workers <= len(worker_pool):
+        per_worker = len(worker_pool) // max(num_workers, 1)
+        worker_cores = [
+            worker_pool[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)
+        ]
+    else:
+        worker_cores = [[worker_pool[i % len(worker_pool)]] for i in range(num_workers)]
+    return main_cores, worker_cores
+
+
+def _pin(cores: list[int] | None) -> None:
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+class PinWorker:
+    def __init__(self, worker_cores: list[list[int]]):
+        """Dataloader `worker_init_fn` which pins each worker to its cores
+
+        This is a class rather than a closure so it can be pickled for spawned workers.
+
+        Args:
+            worker_cores: The cores of each worker
+        """
+        self.worker_cores = worker_cores
+
+    def __call__(self, worker_id: int) -> None:
+        _pin(self.worker_cores[worker_id % len(self.worker_cores)])
+
+
+@dataclass
+class RuntimeConfig:
+    """Thread, worker and batch settings for running a model on a host
+
+    Attributes:
+        torch_threads: The number of torch intra-op threads of the main process
+        num_workers: The number of dataloader workers
+        prefetch_factor: The number of batches loaded in advance by each worker
+        batch_size: The inference batch size
+        pin_cores: Whether to pin the main process and each worker to their own cores
+        main_cores: The cores of the main process when pinning
+        worker_cores: The cores of each worker when pinning
+        throughput: The samples per second measured by the tuner, for reference
+        metadata: The host and checkpoint the config was tuned on, for reference
+    """
+
+    torch_threads: int
+    num_workers: int
+    prefetch_factor: int | None = None
+    batch_size: int = 1
+    pin_cores: bool = False
+    main_cores: list[int] | None = None
+    worker_cores: list[list[int]] | None = None
+    throughput: float | None = None
+    metadata: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.pin_cores and self.main_cores is None:
+            self.main_cores, self.worker_cores = assign_cores(
+                self.torch_threads, self.num_workers
+            )
+
+    def apply(self, pin: bool = True) -> None:
+        """Set the torch threads of this process and pin it to its cores
+
+        Dataloader workers inherit the cores of the process which starts them, so this process
+        should only be pinned if the workers are re-pinned with `dataloader_kwargs()`.
+
+        Args:
+            pin: Whether to pin this process if the config uses pinning
+        """
+        torch.set_num_threads(self.torch_threads)
+        if self.pin_cores and pin:
+            _pin(self.main_cores)
+
+    def dataloader_kwargs(self) -> dict:
+        """The keyword arguments for a DataLoader, excluding the batch size"""
+        return dict(
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+            worker_init_fn=PinWorker(self.worker_cores) if self.pin_cores else None,
+        )
+
+    def save(self, path: str) -> None:
+        """Save the config as YAML"""
+        with open(path, "w") as f:
+            yaml.safe_dump(asdict(self), f, sort_keys=False)
+
+
+def load_runtime_config(path: str) -> RuntimeConfig:
+    """Load a runtime config saved by `scripts/tune_workers.py`
+
+    The saved cores are only used if they are all available to this process. Otherwise they are
+    reassigned from the available cores.
+    """
+    with open(os.path.expanduser(path)) as f:
+        config = yaml.safe_load(f)
+
+    saved_cores = set(config.get("main_cores") or [])
+    for cores in config.get("worker_cores") or []:
+        saved_cores.update(cores)
+    if not saved_cores.issubset(available_cores()):
+        config["main_cores"] = config["worker_cores"] = None
+
+    return RuntimeConfig(**config)
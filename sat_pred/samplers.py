@@ -0,0 +1,235 @@
+"""Samplers for the training dataloaders"""
+
+import math
+from collections.abc import Iterator
+
+import numpy as np
+import pandas as pd
+import torch.distributed as dist
+import xarray as xr
+from torch.utils.data import Sampler
+
+
+class BalancedDistributedSampler(Sampler[int]):
+    def __init__(
+        self,
+        num_samples: int,
+        sample_weights: np.ndarray | None = None,
+        num_replicas: int | None = None,
+        rank: int | None = None,
+        seed: int = 0,
+        balance_window: int = 64,
+    ):
+        """Sampler which splits samples between devices and keeps the devices balanced
+
+        All devices draw the same shuffled order and take interleaved elements of it, so every
+        device gets the same number of samples and so runs the same number of steps. If sample
+        weights (e.g. the fraction of valid target pixels) are given, the shuffled order is sorted
+        by weight within windows so the samples processed together on each step have similar
+        weights. This avoids one device having a full batch of targets whilst another has a
+        nearly empty one.
+
+        Args:
+            num_samples: The number of samples in the dataset
+            sample_weights: Optional weight of each sample used to balance the devices
+            num_replicas: The number of devices. Defaults to the distributed world size
+            rank: The rank of this device. Defaults to the distributed rank
+            seed: The random seed. This must be the same on all devices
+            balance_window: The number of steps over which samples are sorted by weight. Larger
+                windows give better balance but less random batches
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+
+        self.num_samples = num_samples
+        self.sample_weights = sample_weights
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.balance_window = balance_window
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch so each epoch uses a different order"""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return math.ceil(self.num_samples / self.num_replicas)
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(self.num_samples)
+
+        # Pad so every device gets the same number of samples
+        total_size = len(self) * self.num_replicas
+        indices = np.concatenate([indices, indices[:total_size - len(indices)]])
+
+        if self.sample_weights is not None:
+            # Sort within each window so consecutive groups of `num_replicas` samples, which are
+            # processed on the same step, have similar weights. The windows are sorted in
+            # alternating directions so the step-to-step order stays mixed
+            window = self.balance_window * self.num_replicas
+            for n, start in enumerate(range(0, total_size, window)):
+                block = indices[start:start + window]
+                order = np.argsort(self.sample_weights[block], kind="stable")
+                indices[start:start + window] = block[order if n % 2 == 0 else order[::-1]]
+
+            # Shuffle the order of the steps within each window
+            steps = indices.reshape(-1, self.num_replicas)
+            for start in range(0, len(steps), self.balance_window):
+                rng.shuffle(steps[start:start + self.balance_window])
+            indices = steps.reshape(-1)
+
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+
+def time_chunk_ids(ds: xr.Dataset, times: pd.DatetimeIndex) -> np.ndarray:
+    """Find the zarr time chunk which each of the given times is stored in
+
+    Chunks are numbered consecutively through the concatenated stores.
+    """
+    data = ds.data
+    time_axis = data.dims.index("time")
+    if data.chunks is not None:
+        chunk_lengths = data.chunks[time_axis]
+    else:
+        chunk_size = data.encoding.get("chunks", data.shape)[time_axis]
+        chunk_lengths = [chunk_size] * math.ceil(data.shape[time_axis] / chunk_size)
+
+    positions = ds.get_index("time").get_indexer(times)
+    return np.searchsorted(np.cumsum(chunk_lengths), positions, side="right")
+
+
+class ChunkBlockShuffleSampler(Sampler[int]):
+    def __init__(
+        self,
+        chunk_ids: np.ndarray,
+        block_chunks: int = 1,
+        batch_size: int = 1,
+        num_workers: int = 0,
+        num_replicas: int | None = None,
+        rank: int | None = None,
+        seed: int = 0,
+    ):
+        """Sampler which shuffles blocks of samples aligned to the zarr time chunks
+
+        The samples are grouped into blocks of `block_chunks` consecutive zarr time chunks. The
+        order of the blocks is shuffled and the samples are shuffled within each block. Each
+        dataloader worker is given its own stream of blocks, so the consecutive samples a worker
+        loads come from the same chunks and can be served from its chunk cache. Larger blocks
+        give less random batches but fewer chunk reads.
+
+        The dataloader gives batch `i` to worker `i % num_workers`, so the streams are
+        interleaved batch by batch to match. When training on multiple devices the streams are
+        split between the devices, and this requires `use_distributed_sampler: false` in the
+        trainer.
+
+        Args:
+            chunk_ids: The zarr time chunk of the t0 time of each sample
+            block_chunks: The number of consecutive time chunks in each block
+            batch_size: The dataloader batch size
+            num_workers: The number of dataloader workers
+            num_replicas: The number of devices. Defaults to the distributed world size
+            rank: The rank of this device. Defaults to the distributed rank
+            seed: The random seed. This must be the same on all devices
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+
+        block_ids = (np.asarray(chunk_ids) - np.min(chunk_ids)) // block_chunks
+        # The t0 times are sorted so each block is a contiguous range of samples
+        self.blocks = np.split(np.arange(len(block_ids)), np.nonzero(np.diff(block_ids))[0] + 1)
+
+        self.num_samples = len(block_ids)
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch so each epoch uses a different order"""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return math.ceil(self.num_samples / self.num_replicas)
+
+    def _streams(self, rng: np.random.Generator) -> list[np.ndarray]:
+        """Deal the shuffled blocks into a stream for each worker on each device"""
+        num_streams = self.num_replicas * self.num_workers
+        streams = [[] for _ in range(num_streams)]
+        lengths = np.zeros(num_streams, dtype=int)
+
+        for block_num in rng.permutation(len(self.blocks)):
+            block = self.blocks[block_num].copy()
+            rng.shuffle(block)
+            # Add to the shortest stream so the streams stay a similar length
+            n = int(np.argmin(lengths))
+            streams[n].append(block)
+            lengths[n] += len(block)
+
+        return [np.concatenate(s) if s else np.array([], dtype=int) for s in streams]
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        streams = self._streams(rng)
+        streams = streams[self.rank * self.num_workers:(self.rank + 1) * self.num_workers]
+
+        # Take a batch from each worker's stream in turn. Once a stream runs out its turns are
+        # taken from the other streams
+        positions = [0] * len(streams)
+        indices = []
+        batch_num = 0
+        while len(indices) < len(self) and any(
+            p < len(s) for p, s in zip(positions, streams)
+        ):
+            n = batch_num % len(streams)
+            while positions[n] >= len(streams[n]):
+                n = (n + 1) % len(streams)
+            indices.extend(streams[n][positions[n]:positions[n] + self.batch_size])
+            positions[n] += self.batch_size
+            batch_num += 1
+
+        # Pad so every device gets the same number of samples
+        indices = np.array(indices[:len(self)], dtype=int)
+        if len(indices) < len(self):
+            indices = np.resize(indices, len(self))
+
+        return iter(indices.tolist())
+
+
+class RecordingSampler(Sampler[int]):
+    def __init__(self, sampler: Sampler[int]):
+        """Sampler which records the indices drawn from another sampler in the current epoch
+
+        The batches are returned by the dataloader in the order they are sampled, so batch `i`
+        of the epoch holds the samples at positions `i * batch_size` to `(i + 1) * batch_size`
+        of the recorded indices. This lets the samples of a batch be found in the main process.
+
+        Args:
+            sampler: The sampler to draw the indices from
+        """
+        self.sampler = sampler
+        self.indices = []
+
+    def set_epoch(self, epoch: int) -> None:
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+    def __iter__(self) -> Iterator[int]:
+        self.indices = []
+        for idx in self.sampler:
+            self.indices.append(idx)
+            yield idx
+
+    def batch_indices(self, batch_idx: int, batch_size: int) -> list[int]:
+        """The dataset indices of a batch of the current epoch"""
+        return self.indices[batch_idx * batch_size:(batch_idx + 1) * batch_size]
@@ -23,8 +23,10 @@ import rich.syntax
 import rich.tree
 from lightning.pytorch.utilities import rank_zero_only
 
+from sat_pred.checkpointing import InferenceBundle
 from sat_pred.load_model_from_checkpoint import get_model_from_checkpoints
 from sat_pred.loss import LossFunction
+from sat_pred.runtime import load_runtime_config
 
 # TODO: is this line needed?
 torch.set_default_dtype(torch.float32)
@@ -84,6 +86,27 @@ def print_config(
 
     rich.print(tree)
 
+
+def apply_runtime_config(config: DictConfig) -> None:
+    """Use the torch threads and dataloader workers of a tuned runtime config
+
+    The runtime configs are found by scripts/tune_workers.py. The batch size is a training
+    hyperparameter so it isn't changed, and the datamodule builds the dataloaders so the workers
+    aren't pinned to cores.
+
+    Args:
+        config (DictConfig): Configuration composed by Hydra. Updated in place.
+    """
+    if config.get("runtime_config") is None:
+        return
+
+    runtime = load_runtime_config(config.runtime_config)
+    runtime.apply(pin=False)
+    config.datamodule.num_workers = runtime.num_workers
+    config.datamodule.prefetch_factor = runtime.dataloader_kwargs()["prefetch_factor"]
+    if runtime.num_workers == 0:
+        config.datamodule.persistent_workers = False
+
 @rank_zero_only
 
 
@@ -100,10 +123,16 @@ def train(config: DictConfig):
     # Set seed for random number generators in pytorch, numpy and python.random
     if "seed" in config:
         seed_everything(config.seed, workers=True)
+
+    apply_runtime_config(config)
     
 
     if config.model.model.get("from_pretrained", False):
 
+        # Optionally only fine-tune the parts of the model after the encoder
+        freeze_encoder = config.model.model.get("freeze_encoder", False)
+        train_decoder = config.model.model.get("train_decoder", True)
+
         # Load the model from the checkpoint
         torch_model, model_config, data_config = get_model_from_checkpoints(
             config.model.model.checkpoint_dir, 
@@ -119,12 +148,16 @@ def train(config: DictConfig):
         # Replace the untrained model with the loaded model
         model.model = torch_model
 
+        if freeze_encoder:
+            model.model.freeze_encoder(train_decoder=train_decoder)
+
 
     else:
         # Instantiate the model
         model: LightningModule = hydra.utils.instantiate(config.model)
 
-    model.multi_gpu = len(config.trainer.devices) > 1
+    devices = config.trainer.devices
+    model.multi_gpu = (devices if isinstance(devices, int) else len(devices)) > 1
 
     # Instantiate the loggers
     loggers: list[Logger] = []
@@ -140,6 +173,14 @@ def train(config: DictConfig):
             if "_target_" in cb_conf:
                 callbacks.append(hydra.utils.instantiate(cb_conf))
 
+    # Save the configs in the inference bundle written alongside the best checkpoint
+    for callback in callbacks:
+        if isinstance(callback, InferenceBundle):
+            callback.set_bundle_configs(
+                OmegaConf.to_container(config.model, resolve=True),
+                OmegaConf.to_container(config.datamodule, resolve=True),
+            )
+
     # Align the wandb id with the checkpoint path
     # - only works if wandb logger and model checkpoint used
     use_wandb_logger = False
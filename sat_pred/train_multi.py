@@ -0,0 +1,100 @@
+"""Train several models in lockstep on the same batches using the multi.yaml config."""
+
+if __name__ == "__main__":
+    import torch.multiprocessing as mp
+    mp.set_start_method("spawn", force=True)
+
+import os
+import hydra
+from lightning.pytorch import Callback, LightningDataModule, Trainer, seed_everything
+from lightning.pytorch.loggers import Logger
+from lightning.pytorch.loggers.wandb import WandbLogger
+from omegaconf import DictConfig, OmegaConf
+
+from sat_pred.multi_model import MultiModelTrainingModule, TrialCheckpoint
+from sat_pred.train import apply_runtime_config, print_config
+
+
+@hydra.main(config_path="../configs/", config_name="multi.yaml", version_base="1.2")
+def train_multi(config: DictConfig):
+    """Train each of the trial models in lockstep on batches from a single datamodule.
+
+    Args:
+        config (DictConfig): Configuration composed by Hydra.
+    """
+
+    print_config(
+        config, fields=("trainer", "trials", "datamodule", "callbacks", "logger", "seed")
+    )
+
+    # Set seed for random number generators in pytorch, numpy and python.random
+    if "seed" in config:
+        seed_everything(config.seed, workers=True)
+
+    apply_runtime_config(config)
+
+    # Instantiate the trial models
+    trials = {
+        name: hydra.utils.instantiate(trial_config)
+        for name, trial_config in config.trials.items()
+    }
+    model = MultiModelTrainingModule(
+        trials,
+        accumulate_grad_batches=config.accumulate_grad_batches,
+        gradient_clip_val=config.gradient_clip_val,
+    )
+
+    # Instantiate the loggers
+    loggers: list[Logger] = []
+    if "logger" in config:
+        for _, lg_conf in config.logger.items():
+            if "_target_" in lg_conf:
+                loggers.append(hydra.utils.instantiate(lg_conf))
+
+    # Instantiate callbacks
+    callbacks: list[Callback] = []
+    if "callbacks" in config:
+        for _, cb_conf in config.callbacks.items():
+            if "_target_" in cb_conf:
+                callbacks.append(hydra.utils.instantiate(cb_conf))
+
+    for callback in callbacks:
+        if isinstance(callback, TrialCheckpoint):
+            # Align the checkpoint path with the wandb id if using the wandb logger
+            for logger in loggers:
+                if isinstance(logger, WandbLogger):
+                    # Need to call the .experiment property to initialise the logger
+                    logger.experiment
+                    if logger.version is not None:
+                        callback.dirpath = "/".join(
+                            callback.dirpath.split("/")[:-1] + [logger.version]
+                        )
+                    break
+
+            # Save each trial's model config and the data config so each trial directory can be
+            # loaded like a single training run
+            for name, trial_config in config.trials.items():
+                trial_dir = callback.trial_dir(name)
+                os.makedirs(trial_dir, exist_ok=True)
+                OmegaConf.save(trial_config, f"{trial_dir}/model_config.yaml")
+                OmegaConf.save(config.datamodule, f"{trial_dir}/data_config.yaml")
+
+    # Instantiate the datamodule
+    datamodule: LightningDataModule = hydra.utils.instantiate(config.datamodule, _convert_='all')
+
+    datamodule.zarr_path = list(datamodule.zarr_path)
+
+    # Instantiate the trainer
+    trainer: Trainer = hydra.utils.instantiate(
+        config.trainer,
+        logger=loggers,
+        _convert_="partial",
+        callbacks=callbacks,
+    )
+
+    # Train the models
+    trainer.fit(model=model, datamodule=datamodule)
+
+
+if __name__ == "__main__":
+    train_multi()
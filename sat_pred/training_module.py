@@ -7,11 +7,14 @@ import torch.nn.functional as F
 from torch.utils.data import default_collate
 import lightning.pytorch as pl
 
-import wandb
-
 from sat_pred.ssim import SSIM3D
 from sat_pred.optimizers import AdamWReduceLROnPlateau
-from sat_pred.loss import LossFunction
+from sat_pred.loss import LossFunction, combine_masked_terms, distributed_masked_loss
+from sat_pred.compilation import compile_model, enable_compile_cache, mark_batch_dynamic
+from sat_pred.distillation import TeacherOutputCache, distillation_loss, predict_with_cache
+from sat_pred.load_model import get_model_from_checkpoints
+from sat_pred.importance import ImportanceSampler
+from sat_pred.samplers import RecordingSampler
 
     
 class MetricAccumulator:
@@ -46,21 +49,6 @@ class MetricAccumulator:
         return mean_metrics
 
 
-def check_nan_and_finite(X: torch.Tensor, y: torch.Tensor, y_hat: torch.Tensor) -> None:
-    """Function to check for NaNs and infs in tensors. Used only for debugging"""
-    if X is not None:
-        assert not np.isnan(X.cpu().numpy()).any(), "NaNs in X"
-        assert np.isfinite(X.cpu().numpy()).all(), "infs in X"
-    
-    if y is not None:
-        assert not np.isnan(y.cpu().numpy()).any(), "NaNs in y"
-        assert np.isfinite(y.cpu().numpy()).all(), "infs in y"
-
-    if y_hat is not None:
-        assert not np.isnan(y_hat.detach().cpu().numpy()).any(), "NaNs in y_hat"
-        assert np.isfinite(y_hat.detach().cpu().numpy()).all(), "infs in y_hat"
-
-
 def upload_video(
     y: torch.Tensor, 
     y_hat: torch.Tensor, 
@@ -77,6 +65,9 @@ def upload_video(
         channel_nums: The channel numbers to log
         fps: The frames per second of the video
     """
+    # wandb is slow to import and is only needed for the videos
+    import wandb
+
     y = y.cpu().numpy()
     y_hat = y_hat.cpu().numpy()
 
@@ -104,6 +95,13 @@ class TrainingModule(pl.LightningModule):
         video_plot_t0_times: list[str] = None,
         video_crop_plots=None,
         multi_gpu: bool = False,
+        compile: bool = False,
+        compile_cache_dir: str | None = None,
+        compile_kwargs: dict | None = None,
+        teacher: dict | None = None,
+        distillation_alpha: float = 0.5,
+        teacher_cache_dir: str | None = None,
+        teacher_cache_max_gb: float = 100,
     ):
         """Lightning module to wrap model, optimizer, and training routine
 
@@ -111,6 +109,20 @@ class TrainingModule(pl.LightningModule):
             model: The model to train
             target_loss: The loss to minimize. One of "MAE", "MSE", "SSIM"
             optimizer: The optimizer to use. Defaults to AdamWReduceLROnPlateau().
+            video_plot_t0_times: The validation t0 times to upload prediction videos of
+            video_crop_plots: The validation t0 times and crops to upload close-up videos of
+            multi_gpu: Whether training is running on multiple GPUs
+            compile: Whether to compile the model and the loss calculation with torch.compile
+            compile_cache_dir: Directory to persist the compile cache to, so that restarted runs
+                don't pay the full compile cost again
+            compile_kwargs: Keyword arguments passed to torch.compile
+            teacher: If set, the model is trained by distillation from this teacher. A dictionary
+                with the `checkpoint_dir` of the teacher and optionally `val_best`
+            distillation_alpha: The weight of the loss against the teacher predictions. The loss
+                against the true targets is weighted by 1 - distillation_alpha
+            teacher_cache_dir: If set, the teacher predictions are cached to this directory so the
+                teacher is only run once per training sample
+            teacher_cache_max_gb: The maximum size of the teacher prediction cache
         """
         super().__init__()
         
@@ -128,6 +140,113 @@ class TrainingModule(pl.LightningModule):
         self.video_crop_plots = video_crop_plots
         self.multi_gpu = multi_gpu
 
+        self.teacher_config = teacher
+        self.distillation_alpha = distillation_alpha
+        self.teacher_cache_dir = teacher_cache_dir
+        self.teacher_cache_max_gb = teacher_cache_max_gb
+        # The teacher is kept out of the module's children so it isn't saved in checkpoints or
+        # trained. It is loaded in setup() so that loading this model for inference doesn't
+        # load the teacher too
+        self._teacher = {}
+
+        # Set at the start of each epoch if the training dataloader uses importance sampling
+        self._importance_sampler = None
+
+        self.compile = compile
+        if compile:
+            compile_kwargs = compile_kwargs or {}
+            if compile_cache_dir is not None:
+                enable_compile_cache(compile_cache_dir)
+            compile_model(self.model, **compile_kwargs)
+            self._calculate_loss_terms = torch.compile(
+                self._calculate_loss_terms, **compile_kwargs
+            )
+
+    def setup(self, stage: str) -> None:
+        """Load the teacher model if training by distillation"""
+        if stage == "fit" and self.teacher_config is not None and not self._teacher:
+            teacher, _, _ = get_model_from_checkpoints(
+                self.teacher_config["checkpoint_dir"],
+                val_best=self.teacher_config.get("val_best", True),
+            )
+            teacher.requires_grad_(False)
+            self._teacher["model"] = teacher.eval()
+
+            if self.teacher_cache_dir is not None:
+                self._teacher["cache"] = TeacherOutputCache(
+                    self.teacher_cache_dir, max_gb=self.teacher_cache_max_gb
+                )
+
+    def on_train_epoch_start(self) -> None:
+        """Find the importance sampler of the training dataloader, if it uses one"""
+        sampler = getattr(self.trainer.train_dataloader, "sampler", None)
+        if isinstance(sampler, RecordingSampler):
+            sampler = sampler.sampler
+        if not isinstance(sampler, ImportanceSampler):
+            sampler = None
+
+        if sampler is not None and self._teacher:
+            raise ValueError("Importance sampling can't be used with distillation")
+        self._importance_sampler = sampler
+
+    def on_train_epoch_end(self) -> None:
+        if self._importance_sampler is not None:
+            summary = self._importance_sampler.summary()
+            self.log_dict({f"importance/{k}": v for k, v in summary.items()}, on_epoch=True)
+
+    def _teacher_predict(self, X: torch.Tensor) -> torch.Tensor:
+        """Run the teacher model, or fetch its cached predictions"""
+        teacher = self._teacher["model"].to(self.device)
+        return predict_with_cache(teacher, X, self._teacher.get("cache"))
+
+    def forward(self, X: torch.Tensor | tuple[torch.Tensor, ...]) -> torch.Tensor:
+        """Run the model"""
+        if self.compile:
+            # Avoid recompiling for the last partial batch and the video plot batches
+            for x in (X if isinstance(X, (tuple, list)) else [X]):
+                mark_batch_dynamic(x)
+        return self.model(X)
+
+    @property
+    def _target_loss_name(self) -> str:
+        if isinstance(self.target_loss, LossFunction):
+            return self.target_loss.name
+        else:
+            return self.target_loss
+
+    def _calculate_loss_terms(
+            self, 
+            y: torch.Tensor, 
+            y_hat: torch.Tensor
+    ) -> dict[str, list[tuple[float, torch.Tensor, torch.Tensor]]]:
+        """Calculate losses common to train and val as (weight, masked sum, valid count) terms
+        
+        Args:
+            y: The true future satellite sequence
+            y_hat: The predicted future satellite sequence
+        """
+        
+        # Masked means are calculated from sums over the valid pixels, rather than by boolean
+        # indexing, so the shapes are static and this can be compiled. This also lets us reduce
+        # the losses correctly across devices
+        valid = y!=-1
+        num_valid = valid.sum()
+
+        mse_sum = (F.mse_loss(y_hat, y, reduction="none")*valid).sum()
+        mae_sum = (F.l1_loss(y_hat, y, reduction="none")*valid).sum()
+        ssim_sum = ((1-self.ssim_func(y_hat, y))*valid).sum() # need to maximise SSIM
+
+        terms = {
+                "MSE": [(1.0, mse_sum, num_valid)],
+                "MAE": [(1.0, mae_sum, num_valid)],
+                "SSIM": [(1.0, ssim_sum, num_valid)],
+        }
+
+        if isinstance(self.target_loss, LossFunction):
+            terms[self.target_loss.name] = self.target_loss.masked_terms(y_hat, y)
+
+        return terms
+
     def _calculate_common_losses(
             self, 
             y: torch.Tensor, 
@@ -139,25 +258,103 @@ class TrainingModule(pl.LightningModule):
             y: The true future satellite sequence
             y_hat: The predicted future satellite sequence
         """
-        
-        losses = {}
-        
-        mask = y==-1
+        terms = self._calculate_loss_terms(y, y_hat)
+        return {k: combine_masked_terms(v) for k, v in terms.items()}
 
-        mse_loss = F.mse_loss(y_hat, y, reduction="none")[~mask].mean()
-        mae_loss = F.l1_loss(y_hat, y, reduction="none")[~mask].mean()
-        ssim_loss = (1-self.ssim_func(y_hat, y))[~mask].mean() # need to maximise SSIM
+    def _per_sample_target_terms(
+            self,
+            y: torch.Tensor,
+            y_hat: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Calculate the error sum and valid count of each term of the target loss for each sample
 
-        losses = {
-                "MSE": mse_loss,
-                "MAE": mae_loss,
-                "SSIM": ssim_loss,
-        }
+        Args:
+            y: The true future satellite sequence
+            y_hat: The predicted future satellite sequence
 
+        Returns:
+            error_sums: The error sums with shape (batch, term)
+            counts: The valid counts with shape (batch, term)
+            term_weights: The weight of each term
+        """
         if isinstance(self.target_loss, LossFunction):
-            losses[self.target_loss.name] = self.target_loss(y_hat, y)
+            sample_terms = [
+                self.target_loss.masked_terms(y_hat[i:i+1], y[i:i+1]) for i in range(len(y))
+            ]
+            error_sums = torch.stack(
+                [torch.stack([e.float() for _, e, _ in terms]) for terms in sample_terms]
+            )
+            counts = torch.stack(
+                [torch.stack([c.float() for _, _, c in terms]) for terms in sample_terms]
+            )
+            term_weights = torch.tensor(
+                [weight for weight, _, _ in sample_terms[0]], device=error_sums.device
+            )
+            return error_sums, counts, term_weights
 
-        return losses
+        valid = y!=-1
+        if self.target_loss == "MAE":
+            error = (y_hat - y).abs()
+        elif self.target_loss == "MSE":
+            error = (y_hat - y)**2
+        else:
+            error = 1 - self.ssim_func(y_hat, y)
+
+        dims = tuple(range(1, y.ndim))
+        error_sums = (error*valid).sum(dim=dims, dtype=torch.float32)
+        counts = valid.sum(dim=dims).float()
+        term_weights = torch.ones(1, device=error_sums.device)
+        return error_sums[:, None], counts[:, None], term_weights
+
+    def _importance_weighted_terms(
+            self,
+            y: torch.Tensor,
+            y_hat: torch.Tensor,
+            batch_idx: int
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Calculate the terms of the target loss weighted by the inverse sampling probabilities
+
+        The unweighted target loss is the mean over all the valid pixels of the batch, so samples
+        with more valid pixels count for more. To keep the same objective, each term of the loss
+        is the ratio of the importance weighted error sums to the importance weighted valid
+        counts
+
+            sum_i w_i e_i / sum_i w_i n_i
+
+        where w_i = 1/(N p_i) corrects for drawing the samples with probability p_i rather than
+        1/N. This is a consistent estimate of the pixel-weighted loss under uniform sampling, and
+        with uniform sampling it is exactly the unweighted loss. The numerator and denominator are
+        returned separately so the counts can be summed over devices. The pixel-averaged loss of
+        each sample is passed back to the sampler to update its loss estimates.
+
+        Returns:
+            weighted_errors: The importance weighted error sum of each term
+            weighted_counts: The importance weighted valid count of each term
+            term_weights: The weight of each term, normalised to sum to one
+        """
+        sampler = self._importance_sampler
+        batch_size = self.trainer.train_dataloader.batch_size
+        indices, weights = sampler.batch_weights(batch_idx, batch_size)
+
+        error_sums, counts, term_weights = self._per_sample_target_terms(y, y_hat)
+        term_weights = term_weights / term_weights.sum()
+
+        # Samples with no valid targets have zero loss, with finite gradients
+        sample_losses = (error_sums / counts.clamp(min=1) * term_weights).sum(dim=1)
+        sampler.update(indices, sample_losses.detach().cpu().numpy(), weights)
+
+        weights = torch.as_tensor(weights, dtype=error_sums.dtype, device=error_sums.device)
+        weighted_errors = (weights[:, None] * error_sums).sum(dim=0)
+        weighted_counts = (weights[:, None] * counts).sum(dim=0)
+        return weighted_errors, weighted_counts, term_weights
+
+    def _target_valid_counts(self, y: torch.Tensor) -> torch.Tensor:
+        """Calculate the valid count of each term of the target loss. These only depend on y"""
+        if isinstance(self.target_loss, LossFunction):
+            counts = self.target_loss.valid_counts(y)
+        else:
+            counts = (y!=-1).sum().reshape(1)
+        return counts.double()
 
     def _calculate_val_losses(
             self, 
@@ -198,37 +395,100 @@ class TrainingModule(pl.LightningModule):
         """Run training step"""
         
         X, y = batch
+
+        if self.multi_gpu:
+            # Sum the valid target counts over all devices before the forward pass. Batches which
+            # have no valid targets on any device are skipped on all devices together, unless
+            # there is a teacher to train against
+            global_counts = self.trainer.strategy.reduce(
+                self._target_valid_counts(y), reduce_op="sum"
+            )
+            no_targets = bool((global_counts==0).all())
+            if no_targets and not self._teacher:
+                print("\n\nNo valid training targets on any device\n\n")
+                return None
         
-        y_hat = self.model(X)
+        y_hat = self(X)
+
+        if self._teacher:
+            y_teacher = self._teacher_predict(X)
         del X
 
-        losses = self._calculate_common_losses(y, y_hat)
-        losses = {f"{k}/train": v for k, v in losses.items()}
+        terms = self._calculate_loss_terms(y, y_hat)
+        losses = {f"{k}/train": combine_masked_terms(v) for k, v in terms.items()}
+
+        if self._teacher:
+            distill_loss = distillation_loss(y_hat, y_teacher, self.target_loss)
+            losses["distillation/train"] = distill_loss
+
+        if self._importance_sampler is not None:
+            weighted_errors, weighted_counts, term_weights = self._importance_weighted_terms(
+                y, y_hat, batch_idx
+            )
+            weighted_loss = (
+                term_weights * weighted_errors / weighted_counts.clamp(min=1e-12)
+            ).sum()
+            losses[f"{self._target_loss_name}_weighted/train"] = weighted_loss
 
         self._training_accumulate_log({k: v.detach().cpu().item() for k, v in losses.items()})
 
-        if isinstance(self.target_loss, LossFunction):
-            train_loss = losses[f"{self.target_loss.name}/train"]
+        if self.multi_gpu:
+            # Normalise by the valid count over all devices so the gradient is that of the global
+            # masked mean. Devices with no valid targets contribute zero gradient
+            train_loss = distributed_masked_loss(
+                terms[self._target_loss_name], global_counts, self.trainer.world_size
+            )
         else:
-            train_loss = losses[f"{self.target_loss}/train"]
+            train_loss = losses[f"{self._target_loss_name}/train"]
+
+        if self._importance_sampler is not None:
+            if self.multi_gpu:
+                # As in `distributed_masked_loss`, normalise by the weighted valid counts summed
+                # over all devices and scale by the world size, so the gradient averaged by DDP is
+                # that of the global weighted loss. Batches with no valid targets on any device
+                # have already been skipped
+                global_weighted_counts = self.trainer.strategy.reduce(
+                    weighted_counts.detach().clone(), reduce_op="sum"
+                )
+                return self.trainer.world_size * (
+                    term_weights * weighted_errors / global_weighted_counts.clamp(min=1e-12)
+                ).sum()
+
+            # The weighted loss is zero rather than NaN when there are no valid targets, so the
+            # unweighted loss is used to skip these batches
+            if torch.isnan(train_loss).item():
+                return None
+            return weighted_loss
+
+        if self._teacher:
+            # The teacher predictions are dense, so if there are no valid targets we can still
+            # train against the teacher. With multiple devices the masked loss is zero rather
+            # than NaN, so the global counts are checked, which keeps the devices in step
+            if self.multi_gpu:
+                teacher_only = no_targets
+            else:
+                teacher_only = torch.isnan(train_loss).item()
+            if teacher_only:
+                return distill_loss
+            a = self.distillation_alpha
+            return a * distill_loss + (1 - a) * train_loss
+
+        if self.multi_gpu:
+            return train_loss
                 
         # Occasionally y will be entirely NaN and we have no training targets. So the train loss
         # will also be NaN.
         if torch.isnan(train_loss).item():
             print("\n\nTraining loss is nan\n\n")
-            if self.multi_gpu:
-                # For multi-GPU we need to return some kind of loss
-                return F.l1_loss(y_hat*0, y_hat*0)
-            else:
-                # For single GPU we return None so lightning skips this train step
-                return None
+            # We return None so lightning skips this train step
+            return None
         else:
             return train_loss
     
     def validation_step(self, batch: dict, batch_idx: int):
         """Run validation step"""
         X, y = batch
-        y_hat = self.model(X)
+        y_hat = self(X)
         del X
     
         losses = self._calculate_common_losses(y, y_hat)
@@ -260,7 +520,7 @@ class TrainingModule(pl.LightningModule):
             y = y.to(self.device)
             
             with torch.no_grad():
-                y_hat = self.model(X)
+                y_hat = self(X)
 
             assert val_dataset.nan_to_num, val_dataset.nan_to_num
                                 
@@ -278,7 +538,7 @@ class TrainingModule(pl.LightningModule):
             y = y.to(self.device)
 
             with torch.no_grad():
-                y_hat = self.model(X)
+                y_hat = self(X)
 
             for n in range(len(self.video_crop_plots)):
 
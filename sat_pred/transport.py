@@ -0,0 +1,329 @@
+"""Compact shared-memory transport of training batches from the dataloader workers
+
+By default each sample is returned from the dataset as float32 numpy arrays. These are pickled to
+send them from the worker to the main process, and then copied again when they are collated into
+a batch. With the transport, the batches are collated inside the workers directly into a ring of
+preallocated shared-memory slots, encoded as float16 or as uint8 with a per-channel scale and
+offset. Only the slot index is sent through the worker queue. The main process copies the slot
+into a pinned staging buffer and frees it, and the batch is only upcast to float32 once it is on
+the compute device.
+
+Batches which are loaded but never staged, e.g. those prefetched past the end of an epoch limited
+by `limit_train_batches`, free their slot when they are discarded in the main process. When new
+workers are started `TransportDataLoader` frees all the slots, since no batches are in flight.
+
+The uint8 encoding maps each channel of each sample linearly from its minimum to maximum valid
+value onto 0-254. 255 marks missing values (NaN or -1).
+"""
+
+import os
+import time
+import uuid
+import warnings
+import weakref
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, get_worker_info
+
+
+ENCODING_DTYPES = {"float16": torch.float16, "uint8": torch.uint8}
+
+_MISSING_UINT8 = 255
+
+# The rings created in this process, so discarded batches can free their slots
+_RINGS = weakref.WeakValueDictionary()
+
+
+@dataclass
+class EncodedBatch:
+    """The location of an encoded batch in a shared slot ring
+
+    If the batch is discarded in the main process without being staged, its slot is freed.
+    """
+
+    ring_name: str
+    ring_id: str
+    slot: int
+    generation: int
+    size: int
+    collate_time: float
+    released: bool = False
+
+    def release(self) -> None:
+        """Free the slot of the batch, if this is the process which created the ring"""
+        ring = _RINGS.get(self.ring_id)
+        if self.released or ring is None or ring.owner_pid != os.getpid():
+            return
+        ring.release(self.slot, self.generation)
+        self.released = True
+
+    def __del__(self):
+        self.release()
+
+
+@dataclass
+class StagedBatch:
+    """An encoded batch copied out of its slot, ready to be moved to the compute device"""
+
+    X: torch.Tensor
+    y: torch.Tensor
+    X_scale: torch.Tensor | None
+    y_scale: torch.Tensor | None
+    missing_value: float
+
+    def decode(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """Upcast the batch to float32"""
+        return (
+            _decode(self.X, self.X_scale, self.missing_value),
+            _decode(self.y, self.y_scale, self.missing_value),
+        )
+
+
+def _decode(x: torch.Tensor, scale: torch.Tensor | None, missing_value: float) -> torch.Tensor:
+    if scale is None:
+        return x.float()
+    # The scale has shape (batch, channel, 2) and x has shape (batch, channel, time, y, x)
+    out = x.float() * scale[..., 0, None, None, None] + scale[..., 1, None, None, None]
+    return torch.where(x == _MISSING_UINT8, missing_value, out)
+
+
+def encode_uint8(x: np.ndarray, out: torch.Tensor, scale_out: torch.Tensor) -> None:
+    """Encode a (channel, ...) array as uint8 with a scale and offset for each channel"""
+    x = x.reshape(x.shape[0], -1)
+    missing = np.isnan(x) | (x == -1)
+    x_valid = np.where(missing, np.nan, x)
+
+    with warnings.catch_warnings():
+        # Channels with no valid values raise an all-NaN warning
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lo = np.nan_to_num(np.nanmin(x_valid, axis=1, initial=np.inf), posinf=0)
+        hi = np.nan_to_num(np.nanmax(x_valid, axis=1, initial=-np.inf), neginf=0)
+
+    scale = np.maximum(hi - lo, 1e-12) / (_MISSING_UINT8 - 1)
+    q = np.rint((np.nan_to_num(x_valid) - lo[:, None]) / scale[:, None])
+    q = np.where(missing, _MISSING_UINT8, np.clip(q, 0, _MISSING_UINT8 - 1))
+
+    out.view(out.shape[0], -1).copy_(torch.from_numpy(q.astype(np.uint8)))
+    scale_out[:, 0] = torch.from_numpy(scale.astype(np.float32))
+    scale_out[:, 1] = torch.from_numpy(lo.astype(np.float32))
+
+
+def decode_uint8(q: np.ndarray, scale: np.ndarray, missing_value: float = -1) -> np.ndarray:
+    """Decode a (channel, ...) uint8 array encoded with `encode_uint8` to float32"""
+    flat = q.reshape(q.shape[0], -1)
+    out = flat * scale[:, :1].astype(np.float32) + scale[:, 1:].astype(np.float32)
+    out = np.where(flat == _MISSING_UINT8, np.float32(missing_value), out)
+    return out.reshape(q.shape)
+
+
+class SharedSlotRing:
+    def __init__(
+        self,
+        name: str,
+        shapes: dict[str, tuple[int, ...]],
+        batch_size: int,
+        num_workers: int,
+        slots_per_worker: int,
+        encoding: str = "float16",
+        acquire_timeout: float = 120.0,
+    ):
+        """A ring of preallocated shared-memory slots which batches are collated into
+
+        Each worker cycles through its own slots. A worker waits for a slot to be released by the
+        main process before reusing it. Each worker only has a few batches in flight, so a long
+        wait means a slot was never released and an error is raised rather than hanging.
+
+        `reset()` frees all the slots and starts a new generation, so batches from before the
+        reset which are discarded later don't free slots which have since been reused.
+
+        Args:
+            name: The name of the ring, used to match batches to their ring
+            shapes: The shape of each sample array, keyed by "X" and "y"
+            batch_size: The maximum batch size
+            num_workers: The number of dataloader workers
+            slots_per_worker: The number of slots for each worker. This must be larger than the
+                number of batches each worker prefetches
+            encoding: The encoding of the batches. One of "float16" or "uint8"
+            acquire_timeout: The maximum time in seconds to wait for a slot to be released
+        """
+        if encoding not in ENCODING_DTYPES:
+            raise ValueError(f"Unknown encoding: {encoding}")
+
+        num_slots = max(1, num_workers) * slots_per_worker
+
+        self.name = name
+        self.id = uuid.uuid4().hex
+        self.owner_pid = os.getpid()
+        self.encoding = encoding
+        self.slots_per_worker = slots_per_worker
+        self.acquire_timeout = acquire_timeout
+        self.buffers = {
+            k: torch.empty(
+                (num_slots, batch_size, *shape), dtype=ENCODING_DTYPES[encoding]
+            ).share_memory_()
+            for k, shape in shapes.items()
+        }
+        if encoding == "uint8":
+            self.scales = {
+                k: torch.empty((num_slots, batch_size, shape[0], 2)).share_memory_()
+                for k, shape in shapes.items()
+            }
+        else:
+            self.scales = None
+
+        self.busy = torch.zeros(num_slots, dtype=torch.int32).share_memory_()
+        self.generation = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._counter = 0
+
+        _RINGS[self.id] = self
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.numel() * b.element_size() for b in self.buffers.values())
+
+    def acquire(self) -> tuple[int, int]:
+        """Wait for the next slot of this worker to be free and claim it
+
+        Returns:
+            The slot and the generation it was claimed in
+        """
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        slot = worker_id * self.slots_per_worker + self._counter % self.slots_per_worker
+        self._counter += 1
+
+        start = time.perf_counter()
+        while self.busy[slot].item():
+            if time.perf_counter() - start > self.acquire_timeout:
+                raise RuntimeError(
+                    f"Waited {self.acquire_timeout}s for slot {slot} of the {self.name} shared "
+                    "memory transport to be released. A batch from this slot was never staged "
+                    "or discarded in the main process"
+                )
+            time.sleep(0.0005)
+        self.busy[slot] = 1
+        return slot, int(self.generation.item())
+
+    def release(self, slot: int, generation: int) -> None:
+        """Free a slot, unless the ring has been reset since it was claimed"""
+        if generation == self.generation.item():
+            self.busy[slot] = 0
+
+    def reset(self) -> None:
+        """Free all the slots. This must only be called when no workers are running"""
+        self.generation += 1
+        self.busy.zero_()
+
+    def write(self, slot: int, i: int, name: str, x: np.ndarray) -> None:
+        """Encode a sample array into a slot"""
+        if self.encoding == "uint8":
+            encode_uint8(x, self.buffers[name][slot, i], self.scales[name][slot, i])
+        else:
+            self.buffers[name][slot, i].copy_(torch.from_numpy(x))
+
+
+class SlotCollate:
+    def __init__(self, ring: SharedSlotRing):
+        """Collate function which collates samples into a shared slot ring inside the worker
+
+        Args:
+            ring: The ring to collate the batches into
+        """
+        self.ring = ring
+
+    def __call__(self, samples: list[tuple[np.ndarray, np.ndarray]]) -> EncodedBatch:
+        start = time.perf_counter()
+        slot, generation = self.ring.acquire()
+        for i, (X, y) in enumerate(samples):
+            self.ring.write(slot, i, "X", X)
+            self.ring.write(slot, i, "y", y)
+        return EncodedBatch(
+            ring_name=self.ring.name,
+            ring_id=self.ring.id,
+            slot=slot,
+            generation=generation,
+            size=len(samples),
+            collate_time=time.perf_counter() - start,
+        )
+
+
+class TransportStager:
+    def __init__(self, ring: SharedSlotRing, missing_value: float = -1, pin_memory: bool = True):
+        """Copies encoded batches out of the ring into pinned staging buffers in the main process
+
+        Two staging buffers are used alternately so a buffer isn't overwritten while its previous
+        contents may still be being copied to the device.
+
+        Args:
+            ring: The ring the batches are collated into
+            missing_value: The value which missing uint8 values are decoded to
+            pin_memory: Whether to use pinned staging buffers. Only used if CUDA is available
+        """
+        self.ring = ring
+        self.missing_value = missing_value
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._staging = None
+        self._count = 0
+
+    def _staging_buffers(self) -> list[dict[str, torch.Tensor]]:
+        if self._staging is None:
+            tensors = {k: v[0] for k, v in self.ring.buffers.items()}
+            if self.ring.scales is not None:
+                tensors.update({f"{k}_scale": v[0] for k, v in self.ring.scales.items()})
+            self._staging = [
+                {
+                    k: torch.empty_like(v, pin_memory=self.pin_memory)
+                    for k, v in tensors.items()
+                }
+                for _ in range(2)
+            ]
+        return self._staging
+
+    def stage(self, batch: EncodedBatch) -> StagedBatch:
+        staging = self._staging_buffers()[self._count % 2]
+        self._count += 1
+
+        out = {}
+        for k, buffer in self.ring.buffers.items():
+            out[k] = staging[k][:batch.size]
+            out[k].copy_(buffer[batch.slot, :batch.size])
+            if self.ring.scales is not None:
+                out[f"{k}_scale"] = staging[f"{k}_scale"][:batch.size]
+                out[f"{k}_scale"].copy_(self.ring.scales[k][batch.slot, :batch.size])
+
+        batch.release()
+
+        return StagedBatch(
+            X=out["X"],
+            y=out["y"],
+            X_scale=out.get("X_scale"),
+            y_scale=out.get("y_scale"),
+            missing_value=self.missing_value,
+        )
+
+
+class TransportDataLoader(DataLoader):
+    """DataLoader which frees the slots of its shared slot ring when new workers are started
+
+    When workers are started no batches are in flight, so all the slots can be freed. This covers
+    slots of batches which never reached the main process, e.g. those still queued when
+    non-persistent workers are shut down. With persistent workers, the batches queued at the end
+    of an epoch are discarded in the main process at the start of the next, which frees them.
+    The collate function must be a `SlotCollate`.
+    """
+
+    def __iter__(self):
+        persistent = self.persistent_workers and self.num_workers > 0
+        if not persistent or self._iterator is None:
+            # Make sure the previous workers have stopped writing to the ring before freeing it
+            previous = getattr(self, "_previous_iterator", None)
+            if previous is not None and hasattr(previous, "_shutdown_workers"):
+                previous._shutdown_workers()
+            self.collate_fn.ring.reset()
+
+        iterator = super().__iter__()
+        if not persistent:
+            self._previous_iterator = iterator
+        return iterator
@@ -15,12 +15,19 @@ from tqdm import tqdm
 import os
 from numcodecs import Blosc
 
-from cloudcasting.dataset import load_satellite_zarrs, find_valid_t0_times
 from sat_pred.load_model import get_model_from_checkpoints
+from sat_pred.compilation import compile_model
+from sat_pred.ensemble import EnsembleModel
+from sat_pred.coverage import filter_t0_times, load_coverage_index
+from sat_pred.dataset_index import DEFAULT_INDEX_CACHE_DIR, IndexedDatasetMixin
+from sat_pred.runtime import load_runtime_config
 
 
+# This can be a list of checkpoint directories to run them as an ensemble
 checkpoint = "/home/jamesfulton/repos/sat_pred/checkpoints/ob9v9128"
 save_dir = "/mnt/disks/sat_preds/simvp_preds"
+# The torch threads, dataloader workers and batch size tuned by scripts/tune_workers.py
+runtime_config = None
 compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
 
 
@@ -29,12 +36,50 @@ DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class MLModel:
 
-    def __init__(self, checkpoint_dir_path: str) -> None:
+    def __init__(
+        self,
+        checkpoint_dir_path: str | list[str],
+        compile: bool = False,
+        compile_cache_dir: str | None = "~/.cache/sat_pred/torch_compile",
+        vectorize_ensemble: bool = True,
+    ) -> None:
+        """Wrapper to run a model, or an ensemble of models, on numpy inputs
 
-        
-        model, model_config, data_config = get_model_from_checkpoints(checkpoint)
+        Args:
+            checkpoint_dir_path: The checkpoint directory of the model. If a list of directories
+                is given the models are run as an ensemble. They must share the same architecture
+                and data config
+            compile: Whether to compile the model
+            compile_cache_dir: Directory to persist the compile caches to
+            vectorize_ensemble: Whether to run the ensemble members in one vectorised call
+        """
+
+        self.is_ensemble = isinstance(checkpoint_dir_path, list | tuple)
+
+        if self.is_ensemble:
+            checkpoint_dir_path = list(checkpoint_dir_path)
+            members = [get_model_from_checkpoints(path) for path in checkpoint_dir_path]
+            _, model_config, data_config = members[0]
+
+            for path, (_, member_model_config, member_data_config) in zip(
+                checkpoint_dir_path[1:], members[1:]
+            ):
+                if member_model_config != model_config:
+                    raise ValueError(f"The model config of {path} differs from the first member")
+                if member_data_config != data_config:
+                    raise ValueError(f"The data config of {path} differs from the first member")
+
+            model = EnsembleModel([m for m, _, _ in members], vectorize=vectorize_ensemble)
+            del members
+        else:
+            model, model_config, data_config = get_model_from_checkpoints(checkpoint_dir_path)
 
         self.model = model.to(DEVICE)
+
+        if compile:
+            # Mark the batch dimension as dynamic up-front since the last batch is often partial
+            compile_model(self.model, cache_dir=compile_cache_dir, dynamic=True)
+
         self.history_mins = (model_config["model"]['history_len'] - 1) * 15
         self.model_config = model_config
         self.data_config = data_config
@@ -43,6 +88,7 @@ class MLModel:
 
     def __call__(self, X):
         # The input X is a numpy array with shape (batch_size, channels, time, height, width)
+        # For an ensemble the output has an extra leading dimension for the members
         X = torch.Tensor(X).to(DEVICE)
         
         with torch.no_grad():
@@ -71,7 +117,7 @@ def backtest_collate_fn(
 
 DataIndex = str | datetime | pd.Timestamp | int
 
-class BacktestSatelliteDataset(Dataset):
+class BacktestSatelliteDataset(IndexedDatasetMixin, Dataset):
     def __init__(
         self,
         zarr_path: list[str] | str,
@@ -80,6 +126,9 @@ class BacktestSatelliteDataset(Dataset):
         history_mins: int,
         sample_freq_mins: int,
         nan_to_num: bool = False,
+        coverage_index_path: str | None = None,
+        min_coverage: float = 0.0,
+        index_cache_dir: str | None = DEFAULT_INDEX_CACHE_DIR,
     ):
         """A torch Dataset for loading past and future satellite data
 
@@ -90,36 +139,48 @@ class BacktestSatelliteDataset(Dataset):
             history_mins: How many minutes of history will be used as input features
             sample_freq_mins: The sample frequency to use for the satellite data
             nan_to_num: Whether to convert NaNs to -1.
+            coverage_index_path: Path to a coverage index built with
+                `scripts/build_coverage_index.py`. If set, samples whose input frames have too
+                little valid data are skipped
+            min_coverage: The minimum mean valid fraction of the input frames for a sample to be
+                kept
+            index_cache_dir: The directory of the dataset index cache. The satellite data is
+                reopened lazily in each dataloader worker rather than pickled. If None the index
+                is built without caching
         """
 
-        # Load the sat zarr file or list of files and slice the data to the given period
-        self.ds = load_satellite_zarrs(zarr_path).sel(time=slice(start_time, end_time))
-
-        # Convert the satellite data to the given time frequency by selection
-        mask = np.mod(self.ds.time.dt.minute, 15) == 0
-        self.ds = self.ds.sel(time=mask)
-
-        # Find the valid t0 times for the available data. This avoids trying to take samples where
-        # there would be a missing timestamp in the sat data required for the sample
-        self.t0_times = self._find_t0_times(
-            pd.DatetimeIndex(self.ds.time), history_mins, sample_freq_mins
+        # Load the time index of the sat data at the given frequency and find the valid t0 times.
+        # This avoids trying to take samples where there would be a missing timestamp in the sat
+        # data required for the sample
+        self._init_index(
+            zarr_path,
+            start_time,
+            end_time,
+            history_mins,
+            forecast_mins=0,
+            sample_freq_mins=sample_freq_mins,
+            index_cache_dir=index_cache_dir,
         )
 
         # Only do 30 minute intervals
         self.t0_times = self.t0_times[self.t0_times.minute%30==0]
 
+        # Skip samples without enough valid input data
+        if coverage_index_path is not None:
+            self.t0_times, report = filter_t0_times(
+                self.t0_times,
+                load_coverage_index(coverage_index_path),
+                min_coverage=min_coverage,
+                start_mins=-history_mins,
+                end_mins=0,
+                sample_freq_mins=sample_freq_mins,
+            )
+            print(report)
+
         self.history_mins = history_mins
         self.sample_freq_mins = sample_freq_mins
         self.nan_to_num = nan_to_num
 
-    @staticmethod
-    def _find_t0_times(
-        date_range: pd.DatetimeIndex, 
-        history_mins: int, 
-        sample_freq_mins: int
-    ) -> pd.DatetimeIndex:
-        return find_valid_t0_times(date_range, history_mins, 0, sample_freq_mins)
-
     def __len__(self):
         return len(self.t0_times)
 
@@ -154,13 +215,65 @@ class BacktestSatelliteDataset(Dataset):
 
 
 
+def _ensemble_data_vars(y_hat: np.ndarray, ensemble_output: str) -> dict[str, np.ndarray]:
+    """Reduce the ensemble member predictions to the arrays to save
+
+    The member axis is moved to after the init time axis.
+    """
+    data_vars = {}
+    if ensemble_output in ["members", "both"]:
+        data_vars["sat_pred_members"] = np.moveaxis(y_hat, 0, 1)
+    if ensemble_output in ["mean_std", "both"]:
+        data_vars["sat_pred"] = y_hat.mean(axis=0)
+        data_vars["sat_pred_std"] = y_hat.std(axis=0)
+    return data_vars
+
+
+def _overview_group(level: int) -> str:
+    return f"overview_{level}"
+
+
+def _multiscales_attrs(overview_levels: list[int]) -> list[dict]:
+    """The attributes which describe the pyramid of overview levels"""
+    return [
+        {
+            "datasets": [
+                {"path": ".", "coarsen_factor": 1},
+                *[
+                    {"path": _overview_group(level), "coarsen_factor": level}
+                    for level in overview_levels
+                ],
+            ],
+            "type": "mean",
+        }
+    ]
+
+
+def _coarsen_levels(ds: xr.Dataset, overview_levels: list[int]) -> dict[int, xr.Dataset]:
+    """Mean-pool the forecast to each of the overview levels
+
+    The edges are padded where the grid isn't divisible by the level, and the padding is excluded
+    from the means.
+    """
+    levels = {1: ds}
+    for level in overview_levels:
+        levels[level] = ds.coarsen(
+            y_geostationary=level, x_geostationary=level, boundary="pad"
+        ).mean()
+    return levels
+
+
 def run_backtest(
     model: MLModel,
     dataset: BacktestSatelliteDataset,
     batch_size: int = 1,
     num_workers: int = 0,
+    prefetch_factor: int | None = None,
+    worker_init_fn=None,
     batch_limit: int | None = None,
-    agg_batches: int = 1
+    agg_batches: int = 1,
+    ensemble_output: str = "mean_std",
+    overview_levels: list[int] | None = None,
 ) -> None:
     """Calculate the scoreboard metrics for the given model on the validation dataset.
 
@@ -169,15 +282,32 @@ def run_backtest(
         valid_dataset (ValidationSatelliteDataset): The validation dataset to score the model on.
         batch_size (int, optional): Defaults to 1.
         num_workers (int, optional): Defaults to 0.
+        prefetch_factor (int | None, optional): Defaults to None. The number of batches loaded
+            in advance by each worker.
+        worker_init_fn (optional): Defaults to None. Called in each worker on startup, e.g. to
+            pin it to its cores.
         batch_limit (int | None, optional): Defaults to None. Stop after this many batches.
             For testing purposes only.
+        ensemble_output (str, optional): Defaults to "mean_std". What to save when the model is
+            an ensemble. "members" saves each member's prediction as `sat_pred_members`,
+            "mean_std" saves the ensemble mean as `sat_pred` and the spread as `sat_pred_std`,
+            and "both" saves all of these.
+        overview_levels (list[int] | None, optional): Defaults to None. If set, mean-pooled
+            overviews coarsened by each of these factors, e.g. [2, 4, 8], are saved as groups
+            alongside the full resolution forecast. The root of each store is given `multiscales`
+            attributes listing the levels so viewers can read the right level for their zoom.
 
     """
 
+    if ensemble_output not in ["members", "mean_std", "both"]:
+        raise ValueError(f"Unknown ensemble output: {ensemble_output}")
+
     backtest_dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
         num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        worker_init_fn=worker_init_fn,
         shuffle=False,
         collate_fn=backtest_collate_fn,
         drop_last=False,
@@ -186,58 +316,82 @@ def run_backtest(
     # we probably want to accumulate metrics here instead of taking the mean of means!
     loop_steps = len(backtest_dataloader) if batch_limit is None else batch_limit
 
-    da_y_hats = []
+    overview_levels = overview_levels or []
+    ds_y_hats = {level: [] for level in [1, *overview_levels]}
     save_batch_num = 0
 
     attrs_dict = {k:v for k,v in dataset.ds.attrs.items()}
     attrs_dict["model_checkpoint"] = model.checkpoint_dir_path
+    if len(overview_levels) > 0:
+        attrs_dict["multiscales"] = _multiscales_attrs(overview_levels)
+
+    dims = ["init_time", "variable", "step", "y_geostationary", "x_geostationary"]
+    chunks = {
+        "init_time": 1, 
+        "variable":-1,
+        "step":-1, 
+        "y_geostationary": 100, 
+        "x_geostationary": 100,
+    }
 
     for i, (X, t) in tqdm(enumerate(backtest_dataloader), total=loop_steps):
         
         y_hat = model(X)
         init_times = pd.DatetimeIndex(t)
-        steps = pd.timedelta_range("15min", periods=y_hat.shape[2], freq="15min")
-
-        da_y_hat = xr.DataArray(
-            y_hat, 
-            dims=["init_time", "variable", "step", "y_geostationary", "x_geostationary"], 
-            coords={
-                "init_time": init_times,
-                "variable": dataset.ds.variable,
-                "step": steps,
-                "y_geostationary": dataset.ds.y_geostationary,
-                "x_geostationary": dataset.ds.x_geostationary,
-            }
-        ).chunk(
-            {
-                "init_time": 1, 
-                "variable":-1,
-                "step":-1, 
-                "y_geostationary": 100, 
-                "x_geostationary": 100,
-            }
-        )
+        steps = pd.timedelta_range("15min", periods=y_hat.shape[-3], freq="15min")
+
+        coords = {
+            "init_time": init_times,
+            "variable": dataset.ds.variable,
+            "step": steps,
+            "y_geostationary": dataset.ds.y_geostationary,
+            "x_geostationary": dataset.ds.x_geostationary,
+        }
+
+        if model.is_ensemble:
+            data_vars = {}
+            for name, values in _ensemble_data_vars(y_hat, ensemble_output).items():
+                if name=="sat_pred_members":
+                    data_vars[name] = (dims[:1] + ["ensemble_member"] + dims[1:], values)
+                else:
+                    data_vars[name] = (dims, values)
+            coords["ensemble_member"] = np.arange(y_hat.shape[0])
+        else:
+            data_vars = {"sat_pred": (dims, y_hat)}
+
+        ds_y_hat = xr.Dataset(data_vars, coords=coords)
+
+        if model.is_ensemble:
+            level_chunks = {**chunks, "ensemble_member": -1}
+        else:
+            level_chunks = chunks
 
-        da_y_hats.append(da_y_hat)
+        # The overviews are coarsened from the in-memory forecast before it is chunked
+        for level, ds_level in _coarsen_levels(ds_y_hat, overview_levels).items():
+            if level > 1:
+                # The overviews are small enough to store each init time in a single chunk
+                level_chunks = {**level_chunks, "y_geostationary": -1, "x_geostationary": -1}
+            ds_y_hats[level].append(ds_level.chunk(level_chunks))
 
-        del da_y_hat
+        del ds_y_hat
         
-        if len(da_y_hats)==agg_batches or i==loop_steps-1:
+        if len(ds_y_hats[1])==agg_batches or i==loop_steps-1:
 
-            da_y_hats = xr.concat(da_y_hats, dim="init_time")
+            for level, ds_level in ds_y_hats.items():
 
-            da_y_hats.attrs = attrs_dict
+                ds_level = xr.concat(ds_level, dim="init_time")
 
-            da_y_hats = da_y_hats.to_dataset(name="sat_pred")
-            
-            da_y_hats.to_zarr(
-                f"{save_dir}/part_{save_batch_num}.zarr", 
-                mode="w",
-                encoding={var: {'compressor': compressor} for var in da_y_hats.data_vars},
-            )
+                ds_level.attrs = attrs_dict if level == 1 else {"coarsen_factor": level}
+
+                ds_level.to_zarr(
+                    f"{save_dir}/part_{save_batch_num}.zarr", 
+                    group=None if level == 1 else _overview_group(level),
+                    mode="w" if level == 1 else "a",
+                    encoding={var: {'compressor': compressor} for var in ds_level.data_vars},
+                )
             
             save_batch_num += 1
-            da_y_hats = []
+            ds_y_hats = {level: [] for level in ds_y_hats}
             
 
         if batch_limit is not None and i == batch_limit:
@@ -249,6 +403,13 @@ if __name__=="__main__":
 
     os.makedirs(save_dir, exist_ok=False)
 
+    if runtime_config is not None:
+        runtime = load_runtime_config(runtime_config)
+        runtime.apply()
+        dataloader_kwargs = dict(batch_size=runtime.batch_size, **runtime.dataloader_kwargs())
+    else:
+        dataloader_kwargs = dict(batch_size=4, num_workers=12)
+
     model = MLModel(checkpoint)
 
     dataset = BacktestSatelliteDataset(
@@ -269,8 +430,7 @@ if __name__=="__main__":
     run_backtest(
         model=model,
         dataset=dataset,
-        batch_size=4,
-        num_workers=12,
+        **dataloader_kwargs,
         batch_limit=None,
         agg_batches=8,
     )
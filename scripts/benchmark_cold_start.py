@@ -0,0 +1,136 @@
+"""Benchmark the cold start of loading a model through the training module and the inference path
+
+Each measurement runs in a fresh Python process. The import time of each entry point is measured
+with `python -X importtime`, and the slowest imported packages are listed. The time to first
+forecast is measured from launching the process to it finishing its first prediction on a random
+input, along with the peak memory of the process.
+
+use:
+python scripts/benchmark_cold_start.py path/to/checkpoint_dir
+"""
+
+import json
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import typer
+
+
+ENTRY_POINTS = {
+    "training_module": "import sat_pred.training_module",
+    "inference": "import sat_pred.inference",
+}
+
+_FIRST_FORECAST = """
+{load}
+import json
+import resource
+import torch
+X = torch.rand(1, {num_channels}, {history_len}, {height}, {width})
+with torch.no_grad():
+    model(X)
+print(json.dumps({{"max_rss_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6}}))
+"""
+
+_LOADERS = {
+    # The old path, instantiating the Lightning wrapper to get the model
+    "training_module": """
+import hydra
+import torch
+from glob import glob
+from pyaml_env import parse_config
+model_config = parse_config("{checkpoint_dir}/model_config.yaml")
+module = hydra.utils.instantiate(model_config)
+path = glob("{checkpoint_dir}/epoch*.ckpt")[0]
+module.load_state_dict(torch.load(path, map_location="cpu")["state_dict"])
+model = module.model.eval()
+""",
+    "inference": """
+from sat_pred.inference import load_model
+model, _, _ = load_model("{checkpoint_dir}")
+""",
+}
+
+
+def _import_times(statement: str, top: int) -> tuple[float, list[tuple[str, float]]]:
+    """Run an import with -X importtime and return the total and the slowest top-level packages"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time: self [us] | cumulative | imported package"
+    package_times = defaultdict(float)
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        package_times[name.split(".")[0]] += int(self_us) / 1e6
+        if len(indent) == 1:
+            total += int(cumulative_us) / 1e6
+
+    slowest = sorted(package_times.items(), key=lambda x: -x[1])[:top]
+    return total, slowest
+
+
+def _first_forecast(loader: str, checkpoint_dir: str, shape: dict[str, int]) -> dict[str, float]:
+    """Time a fresh process from start to its first forecast"""
+    code = _FIRST_FORECAST.format(
+        load=loader.format(checkpoint_dir=checkpoint_dir), **shape
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    elapsed = time.perf_counter() - start
+    return {"time": elapsed, **json.loads(result.stdout.strip().splitlines()[-1])}
+
+
+def benchmark_cold_start(
+    checkpoint_dir_path: str,
+    num_channels: int = 11,
+    history_len: int = 12,
+    height: int = 372,
+    width: int = 614,
+    top: int = 8,
+):
+    """Compare the import time and time to first forecast of the two model loading paths
+
+    Args:
+        checkpoint_dir_path: A checkpoint directory with a model_config.yaml and epoch checkpoint
+        num_channels: The number of input channels of the random input
+        history_len: The number of input frames of the random input
+        height: The height of the random input
+        width: The width of the random input
+        top: The number of slowest imported packages to list
+    """
+    shape = dict(num_channels=num_channels, history_len=history_len, height=height, width=width)
+
+    print(
+        f"{'entry point':<16} {'import (s)':>11} {'first forecast (s)':>19} "
+        f"{'peak RSS (GB)':>14}"
+    )
+    slowest = {}
+    for name, statement in ENTRY_POINTS.items():
+        import_time, slowest[name] = _import_times(statement, top)
+        forecast = _first_forecast(_LOADERS[name], checkpoint_dir_path, shape)
+        print(
+            f"{name:<16} {import_time:>11.2f} {forecast['time']:>19.2f} "
+            f"{forecast['max_rss_gb']:>14.2f}"
+        )
+
+    for name, packages in slowest.items():
+        print(f"\nSlowest imports of {name}:")
+        for package, seconds in packages:
+            print(f"  {package:<24} {seconds:>6.2f} s")
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_cold_start)
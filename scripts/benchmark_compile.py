@@ -0,0 +1,89 @@
+"""Compare eager vs torch.compile training step time on CPU for the SimVP model configs
+
+use:
+python scripts/benchmark_compile.py --height=128 --width=128 --batch-size=2
+"""
+
+import time
+from glob import glob
+
+import hydra
+import torch
+import typer
+from omegaconf import OmegaConf
+
+from sat_pred.training_module import TrainingModule
+
+
+def time_steps(module: TrainingModule, X: torch.Tensor, y: torch.Tensor, n_steps: int):
+    """Return the time of the first step and the mean time of the following steps in seconds"""
+
+    optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+
+    def step():
+        optimizer.zero_grad()
+        y_hat = module(X)
+        loss = module._calculate_common_losses(y, y_hat)["MAE"]
+        loss.backward()
+        optimizer.step()
+
+    t0 = time.perf_counter()
+    step()
+    first_step = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    return first_step, (time.perf_counter() - t0) / n_steps
+
+
+def benchmark_compile(
+    height: int = 128,
+    width: int = 128,
+    batch_size: int = 2,
+    n_steps: int = 5,
+    compile_cache_dir: str = "~/.cache/sat_pred/torch_compile",
+):
+    """Time eager and compiled training steps for each SimVP config in configs/model/
+
+    Args:
+        height: The height of the input images
+        width: The width of the input images
+        batch_size: The batch size
+        n_steps: The number of steps to time after the first step
+        compile_cache_dir: Directory to persist the compile cache to. Run this script twice to see
+            the effect of a warm cache on the first compiled step
+    """
+
+    torch.manual_seed(0)
+
+    config_paths = sorted(glob("configs/model/simvp*.yaml"))
+
+    print(f"{'config':<16}{'mode':<10}{'first step (s)':>16}{'step (s)':>12}")
+
+    for config_path in config_paths:
+        model_config = OmegaConf.load(config_path).model
+
+        C = model_config.num_channels
+        X = torch.rand(batch_size, C, model_config.history_len, height, width)
+        y = torch.rand(batch_size, C, model_config.forecast_len, height, width)
+
+        results = {}
+        for compile in [False, True]:
+            torch.manual_seed(0)
+            module = TrainingModule(
+                model=hydra.utils.instantiate(model_config),
+                compile=compile,
+                compile_cache_dir=compile_cache_dir if compile else None,
+            )
+            results[compile] = time_steps(module, X, y, n_steps)
+
+            mode = "compiled" if compile else "eager"
+            first_step, step = results[compile]
+            print(f"{config_path.split('/')[-1]:<16}{mode:<10}{first_step:>16.2f}{step:>12.3f}")
+
+        print(f"{'':<16}speedup: {results[False][1] / results[True][1]:.2f}x")
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_compile)
@@ -0,0 +1,92 @@
+"""Benchmark the dataset and dataloader worker startup with and without the dataset index cache
+
+For each setup this times constructing the dataset, and the time from creating a spawn dataloader
+iterator to receiving the first batch.
+
+use:
+python scripts/benchmark_dataset_startup.py --num-workers=8
+"""
+
+try:
+    import torch.multiprocessing as mp
+
+    mp.set_start_method("spawn", force=True)
+except RuntimeError:
+    pass
+
+import shutil
+import tempfile
+import time
+
+import typer
+from cloudcasting.dataset import SatelliteDataset
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+
+from sat_pred.dataset import IndexedSatelliteDataset
+
+
+def _time_startup(make_dataset, num_workers: int, batch_size: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    dataset = make_dataset()
+    init_time = time.perf_counter() - start
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False
+    )
+    start = time.perf_counter()
+    next(iter(dataloader))
+    first_batch_time = time.perf_counter() - start
+
+    return init_time, first_batch_time
+
+
+def benchmark_dataset_startup(
+    data_config_path: str = "configs/datamodule/default.yaml",
+    num_workers: int = 8,
+    batch_size: int = 1,
+):
+    """Time the dataset construction and first batch with and without the index cache
+
+    Args:
+        data_config_path: The datamodule config with the data paths and sample options
+        num_workers: The number of dataloader workers
+        batch_size: The batch size
+    """
+    config = OmegaConf.to_container(OmegaConf.load(data_config_path))
+
+    dataset_kwargs = dict(
+        zarr_path=config["zarr_path"],
+        start_time=config["train_period"][0],
+        end_time=config["train_period"][1],
+        history_mins=config["history_mins"],
+        forecast_mins=config["forecast_mins"],
+        sample_freq_mins=config["sample_freq_mins"],
+        nan_to_num=config["nan_to_num"],
+    )
+
+    cache_dir = tempfile.mkdtemp()
+
+    setups = {
+        "SatelliteDataset": lambda: SatelliteDataset(**dataset_kwargs),
+        "index cache (cold)": lambda: IndexedSatelliteDataset(
+            **dataset_kwargs, index_cache_dir=cache_dir
+        ),
+        "index cache (warm)": lambda: IndexedSatelliteDataset(
+            **dataset_kwargs, index_cache_dir=cache_dir
+        ),
+    }
+
+    results = {}
+    for name, make_dataset in setups.items():
+        results[name] = _time_startup(make_dataset, num_workers, batch_size)
+
+    shutil.rmtree(cache_dir)
+
+    print(f"\n{'setup':<20} {'dataset init (s)':>18} {'first batch (s)':>16}")
+    for name, (init_time, first_batch_time) in results.items():
+        print(f"{name:<20} {init_time:>18.2f} {first_batch_time:>16.2f}")
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_dataset_startup)
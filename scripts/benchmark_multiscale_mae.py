@@ -0,0 +1,94 @@
+"""Benchmark the pyramid-based MultiscaleMAE against the previous NaN-sentinel implementation
+
+use:
+python scripts/benchmark_multiscale_mae.py
+"""
+
+import time
+
+import torch
+from torch.nn import functional as F
+
+from sat_pred.loss import MultiscaleMAE
+
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# The scales used in configs/model/finetune_msmae_simvp.yaml
+SCALES = [(1, 1, 1), (1, 4, 4), (2, 8, 8), (3, 16, 16)]
+
+
+def nan_multiscale_mae(input: torch.Tensor, target: torch.Tensor, scales) -> torch.Tensor:
+    """The previous implementation, with the `target.copy()` bug fixed"""
+    target = target.clone()
+    target[target == -1] = float("nan")
+
+    loss = 0
+    for scale in scales:
+        y_hat_coarse = F.avg_pool3d(input, kernel_size=list(scale))
+        y_coarse = F.avg_pool3d(target, kernel_size=list(scale))
+        loss += torch.nanmean(F.l1_loss(y_hat_coarse, y_coarse, reduction="none"))
+
+    return loss / len(scales)
+
+
+def time_loss(loss_func, y_hat, y, n_repeats: int = 10) -> tuple[float, float]:
+    """Return the mean time of forward+backward in ms and the peak memory in MB"""
+
+    # Warm up
+    loss_func(y_hat, y).backward()
+
+    if DEVICE.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+
+    t0 = time.perf_counter()
+    for _ in range(n_repeats):
+        y_hat.grad = None
+        loss_func(y_hat, y).backward()
+    if DEVICE.type == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = (torch.cuda.max_memory_allocated() - base_memory) / 1e6
+    else:
+        peak_memory = float("nan")
+
+    return (time.perf_counter() - t0) / n_repeats * 1000, peak_memory
+
+
+if __name__ == "__main__":
+
+    torch.manual_seed(0)
+
+    # A typical training batch shape (batch, channel, time, height, width)
+    shape = (2, 11, 12, 279, 386)
+    y_hat = torch.rand(shape, device=DEVICE, requires_grad=True)
+    y = torch.rand(shape, device=DEVICE)
+
+    # Mask out a large block of missing data and some scattered missing pixels
+    y[:, :, :, :100, :150] = -1
+    y[torch.rand(shape, device=DEVICE) < 0.01] = -1
+
+    pyramid_mae = MultiscaleMAE(scales=SCALES)
+
+    for name, loss_func in [
+        ("nan-sentinel", lambda a, b: nan_multiscale_mae(a, b, SCALES)),
+        ("pyramid", pyramid_mae),
+    ]:
+        ms, mb = time_loss(loss_func, y_hat, y)
+        print(f"{name:>14}: {ms:8.1f} ms/iter (fwd+bwd), peak extra memory {mb:8.1f} MB")
+
+    # Without missing data the two implementations should agree
+    y_full = torch.rand(shape, device=DEVICE)
+    with torch.no_grad():
+        diff = (nan_multiscale_mae(y_hat, y_full, SCALES) - pyramid_mae(y_hat, y_full)).abs()
+    print(f"Absolute difference with no missing data: {diff.item():.2e}")
+
+    # With scattered missing data the NaN-sentinel version discards every coarse cell which
+    # contains a single missing pixel
+    with torch.no_grad():
+        nan_coarse = F.avg_pool3d(torch.where(y == -1, float("nan"), y), kernel_size=SCALES[-1])
+    print(
+        f"Fraction of coarsest cells discarded by the NaN-sentinel version: "
+        f"{nan_coarse.isnan().float().mean().item():.1%}"
+    )
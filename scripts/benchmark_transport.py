@@ -0,0 +1,109 @@
+"""Benchmark the shared-memory batch transport against the default dataloader collation
+
+For each transport this reports the bytes moved per sample, the time spent collating each batch
+in the workers, the time to stage each batch in the main process and the overall batch rate.
+
+use:
+python scripts/benchmark_transport.py --num-workers=8 --num-batches=50
+"""
+
+try:
+    import torch.multiprocessing as mp
+
+    mp.set_start_method("spawn", force=True)
+except RuntimeError:
+    pass
+
+import time
+
+import numpy as np
+import typer
+from omegaconf import OmegaConf
+from torch.utils.data import default_collate
+
+from sat_pred.dataset import SatPredDataModule
+from sat_pred.transport import EncodedBatch
+
+
+class TimedCollate:
+    """The default collate function, also returning how long it took"""
+
+    def __call__(self, samples):
+        start = time.perf_counter()
+        batch = default_collate(samples)
+        return batch, time.perf_counter() - start
+
+
+def _run(datamodule: SatPredDataModule, num_batches: int) -> dict[str, float]:
+    dataloader = datamodule.train_dataloader()
+    if datamodule.transport is None:
+        dataloader.collate_fn = TimedCollate()
+
+    collate_times, stage_times, sample_bytes = [], [], []
+    iterator = iter(dataloader)
+
+    # Don't include the worker startup
+    next(iterator)
+
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        batch = next(iterator)
+
+        stage_start = time.perf_counter()
+        if isinstance(batch, EncodedBatch):
+            collate_times.append(batch.collate_time)
+            staged = datamodule.on_before_batch_transfer(batch, 0)
+            X, y = staged.X, staged.y
+            nbytes = sum(
+                t.numel() * t.element_size()
+                for t in [staged.X, staged.y, staged.X_scale, staged.y_scale]
+                if t is not None
+            )
+        else:
+            (X, y), collate_time = batch
+            collate_times.append(collate_time)
+            nbytes = X.numel() * X.element_size() + y.numel() * y.element_size()
+        stage_times.append(time.perf_counter() - stage_start)
+        sample_bytes.append(nbytes / len(X))
+
+    total_time = time.perf_counter() - start
+
+    return {
+        "MB/sample": np.mean(sample_bytes) / 1e6,
+        "collate (ms)": 1e3 * np.mean(collate_times),
+        "stage (ms)": 1e3 * np.mean(stage_times),
+        "batches/s": num_batches / total_time,
+    }
+
+
+def benchmark_transport(
+    data_config_path: str = "configs/datamodule/default.yaml",
+    num_workers: int = 8,
+    batch_size: int = 2,
+    num_batches: int = 50,
+):
+    """Compare the default collation with the float16 and uint8 shared-memory transports
+
+    Args:
+        data_config_path: The datamodule config with the data paths and sample options
+        num_workers: The number of dataloader workers
+        batch_size: The batch size
+        num_batches: The number of batches to time for each transport
+    """
+    config = OmegaConf.to_container(OmegaConf.load(data_config_path))
+    config = {k: v for k, v in config.items() if k not in ["_target_", "defaults"]}
+    config.update(num_workers=num_workers, batch_size=batch_size, persistent_workers=False)
+
+    results = {}
+    for transport in [None, "float16", "uint8"]:
+        datamodule = SatPredDataModule(**{**config, "transport": transport})
+        results[transport or "default"] = _run(datamodule, num_batches)
+
+    metrics = list(results["default"])
+    print(f"\n{'transport':<10}" + "".join(f"{m:>14}" for m in metrics))
+    for name, result in results.items():
+        print(f"{name:<10}" + "".join(f"{result[m]:>14.2f}" for m in metrics))
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_transport)
@@ -0,0 +1,62 @@
+"""Scan the satellite zarrs once and save a low-resolution index of the cloud structure
+
+The index stores the mean and mean square of one channel in coarse cells of the grid at each
+timestamp. It can be passed to `SatPredDataModule` as `crop_cloud_index_path` so cloud weighted
+crops are scored without reading any extra satellite data. See `sat_pred/cloud_cells.py`.
+
+use:
+python scripts/build_cloud_cell_index.py cloud_cells \
+    /mnt/disks/sat_data/sat_data_all/2008_training_nonhrv.zarr \
+    /mnt/disks/sat_data/sat_data_all/2009_training_nonhrv.zarr \
+    --channel=8 --cell-size=32 --stride=4
+"""
+
+import numpy as np
+import typer
+import xarray as xr
+from tqdm import tqdm
+from cloudcasting.dataset import load_satellite_zarrs
+
+from sat_pred.cloud_cells import compute_cloud_cells, save_cloud_cell_index
+
+
+def build_cloud_cell_index(
+    output_path: str,
+    zarr_paths: list[str],
+    channel: int = 8,
+    cell_size: int = 32,
+    stride: int = 4,
+):
+    """Build the cloud cell index and report its size
+
+    Args:
+        output_path: The directory to save the index to
+        zarr_paths: The satellite zarrs to index
+        channel: The channel index to use
+        cell_size: The width of the cells in pixels
+        stride: The spacing in pixels of the grid of pixels used within each cell
+    """
+
+    # Index each zarr separately to keep the task graph small
+    cells = xr.concat(
+        [
+            compute_cloud_cells(
+                load_satellite_zarrs(path), channel=channel, cell_size=cell_size, stride=stride
+            )
+            for path in tqdm(zarr_paths)
+        ],
+        dim="time",
+        combine_attrs="override",
+    ).sortby("time")
+    _, unique = np.unique(cells.time.values, return_index=True)
+    cells = cells.isel(time=unique)
+
+    save_cloud_cell_index(cells, output_path)
+    print(
+        f"Saved {cells.sizes['y_cell']} x {cells.sizes['x_cell']} cells of {cells.sizes['time']} "
+        f"timestamps to {output_path} ({cells.nbytes / 1e6:.1f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(build_cloud_cell_index)
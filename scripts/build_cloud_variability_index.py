@@ -0,0 +1,55 @@
+"""Scan the satellite zarrs once and save a cheap cloud variability score at each timestamp
+
+The score is the mean absolute change of one channel since the previous timestamp on a strided
+grid of pixels. The saved index can be passed to `SatPredDataModule` as
+`importance_prior_path`, so importance sampling favours samples with changing cloud before it
+has estimated their losses.
+
+use:
+python scripts/build_cloud_variability_index.py cloud_variability.parquet \
+    /mnt/disks/sat_data/sat_data_all/2008_training_nonhrv.zarr \
+    /mnt/disks/sat_data/sat_data_all/2009_training_nonhrv.zarr \
+    --channel=8 --stride=8
+"""
+
+import pandas as pd
+import typer
+from tqdm import tqdm
+from cloudcasting.dataset import load_satellite_zarrs
+
+from sat_pred.importance import compute_cloud_variability, save_variability_index
+
+
+def build_cloud_variability_index(
+    output_path: str,
+    zarr_paths: list[str],
+    channel: int = 8,
+    stride: int = 8,
+):
+    """Build the cloud variability index and report its distribution
+
+    Args:
+        output_path: The parquet file to save the index to
+        zarr_paths: The satellite zarrs to index
+        channel: The channel index to use
+        stride: The spacing in pixels of the grid to use
+    """
+
+    # Index each zarr separately to keep the task graph small
+    variability = pd.concat(
+        [
+            compute_cloud_variability(load_satellite_zarrs(path), channel=channel, stride=stride)
+            for path in tqdm(zarr_paths)
+        ]
+    ).sort_index()
+    variability = variability[~variability.index.duplicated()]
+
+    save_variability_index(variability, output_path)
+    print(f"Saved cloud variability of {len(variability)} timestamps to {output_path}")
+
+    quantiles = variability.quantile([0.1, 0.5, 0.9, 0.99])
+    print("Quantiles: " + ", ".join(f"{q:.0%}={v:.4f}" for q, v in quantiles.items()))
+
+
+if __name__ == "__main__":
+    typer.run(build_cloud_variability_index)
@@ -0,0 +1,64 @@
+"""Scan the satellite zarrs once and save the fraction of valid pixels at each timestamp
+
+The saved index can be passed to `SatPredDataModule` and `BacktestSatelliteDataset` to skip
+samples with little or no valid data before they are loaded.
+
+use:
+python scripts/build_coverage_index.py coverage.parquet \
+    /mnt/disks/sat_data/sat_data_all/2008_training_nonhrv.zarr \
+    /mnt/disks/sat_data/sat_data_all/2009_training_nonhrv.zarr \
+    --history-mins=165 --forecast-mins=180 --min-coverage=0.1
+"""
+
+import pandas as pd
+import typer
+from tqdm import tqdm
+from cloudcasting.dataset import find_valid_t0_times, load_satellite_zarrs
+
+from sat_pred.coverage import compute_coverage, filter_t0_times, save_coverage_index
+
+
+def build_coverage_index(
+    output_path: str,
+    zarr_paths: list[str],
+    history_mins: int = 165,
+    forecast_mins: int = 180,
+    sample_freq_mins: int = 15,
+    min_coverage: float = 0.0,
+):
+    """Build the coverage index and report how many training samples it would skip
+
+    Args:
+        output_path: The parquet file to save the index to
+        zarr_paths: The satellite zarrs to index
+        history_mins: The history length used to report the number of skipped samples
+        forecast_mins: The forecast length used to report the number of skipped samples
+        sample_freq_mins: The sample frequency used to report the number of skipped samples
+        min_coverage: The coverage threshold used to report the number of skipped samples
+    """
+
+    # Index each zarr separately to keep the task graph small
+    coverage = pd.concat(
+        [compute_coverage(load_satellite_zarrs(path)) for path in tqdm(zarr_paths)]
+    ).sort_index()
+    coverage = coverage[~coverage.index.duplicated()]
+
+    save_coverage_index(coverage, output_path)
+    print(f"Saved coverage of {len(coverage)} timestamps to {output_path}")
+
+    # Report what this would skip for training samples
+    all_times = coverage.index[coverage.index.minute % sample_freq_mins == 0]
+    t0_times = find_valid_t0_times(all_times, history_mins, forecast_mins, sample_freq_mins)
+    _, report = filter_t0_times(
+        t0_times,
+        coverage,
+        min_coverage=min_coverage,
+        start_mins=sample_freq_mins,
+        end_mins=forecast_mins,
+        sample_freq_mins=sample_freq_mins,
+    )
+    print(report)
+
+
+if __name__ == "__main__":
+    typer.run(build_coverage_index)
@@ -0,0 +1,124 @@
+"""Precompute the frozen SimVP encoder outputs for the training set and save them to disk
+
+The cache can then be used to fine-tune the rest of the model without decoding the satellite zarrs
+or running the encoder on each step. See `configs/model/finetune_latent_simvp.yaml`. The size of
+the cache is reported relative to the raw float32 samples and to the satellite zarrs on disk.
+
+use:
+python scripts/cache_encoder_latents.py /path/to/checkpoints/ob9v9128 /mnt/disks/latent_cache \
+    --batch-size=4 --num-workers=8
+"""
+
+import os
+
+import numpy as np
+import torch
+import typer
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from sat_pred.dataset import SatPredDataModule
+from sat_pred.latent_cache import LatentCacheWriter
+from sat_pred.load_model import get_model_from_checkpoints
+
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _store_bytes(path: str) -> int:
+    """The size of a zarr store on disk"""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def cache_encoder_latents(
+    checkpoint_dir_path: str,
+    cache_dir: str,
+    val_best: bool = True,
+    batch_size: int = 4,
+    num_workers: int = 8,
+    max_samples: int | None = None,
+    coverage_index_path: str | None = None,
+    min_coverage: float = 0.0,
+    seed: int = 0,
+):
+    """Run the encoder of a trained SimVP over the training set and cache the outputs
+
+    Args:
+        checkpoint_dir_path: The checkpoint directory of the model whose encoder will be frozen
+        cache_dir: The directory to save the cache to
+        val_best: Whether to use the best validation checkpoint, else the last checkpoint
+        batch_size: The batch size used to run the encoder
+        num_workers: The number of dataloader workers
+        max_samples: If set, a random subset of this many training samples is cached
+        coverage_index_path: Optional coverage index used to skip samples with few valid targets
+        min_coverage: The minimum target coverage of the cached samples
+        seed: The random seed used to select the subset of samples
+    """
+
+    model, _, data_config = get_model_from_checkpoints(checkpoint_dir_path, val_best=val_best)
+    model = model.to(DEVICE).eval()
+
+    datamodule_kwargs = {k: v for k, v in data_config.items() if k != "_target_"}
+    datamodule_kwargs.update(
+        coverage_index_path=coverage_index_path,
+        min_coverage=min_coverage,
+        crop_size=None,
+        latent_cache_dir=None,
+    )
+    datamodule = SatPredDataModule(**datamodule_kwargs)
+    dataset = datamodule._make_train_dataset()
+    t0_times = dataset.t0_times
+
+    if max_samples is not None and max_samples < len(dataset):
+        indices = np.sort(np.random.default_rng(seed).choice(len(dataset), max_samples, False))
+        dataset = Subset(dataset, indices)
+        t0_times = t0_times[indices]
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False
+    )
+
+    writer = None
+    index = 0
+
+    raw_bytes = 0
+
+    for X, y in tqdm(dataloader):
+        # The skip connection is recomputed from the cached inputs during training
+        with torch.no_grad():
+            embed, _ = model.encode(X.to(DEVICE))
+
+        if writer is None:
+            writer = LatentCacheWriter(
+                cache_dir,
+                t0_times,
+                shapes={"embed": embed.shape[1:], "X": X.shape[1:], "y": y.shape[1:]},
+                metadata={"checkpoint_dir_path": checkpoint_dir_path, "val_best": val_best},
+            )
+
+        writer.write(index, embed=embed, X=X, y=y)
+        index += len(X)
+        raw_bytes += 4 * (X[0].numel() + y[0].numel()) * len(X)
+
+    cache_bytes = writer.nbytes
+    writer.close()
+
+    zarr_paths = data_config["zarr_path"]
+    source_bytes = sum(
+        _store_bytes(path) for path in ([zarr_paths] if isinstance(zarr_paths, str) else zarr_paths)
+    )
+
+    print(
+        f"Cached {index} samples ({cache_bytes / 1e9:.1f} GB) to {cache_dir}. This is "
+        f"{cache_bytes / raw_bytes:.1%} of the raw float32 samples ({raw_bytes / 1e9:.1f} GB) and "
+        f"{cache_bytes / source_bytes:.1%} of the satellite zarrs ({source_bytes / 1e9:.1f} GB), "
+        "which may cover a longer period than the training set"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(cache_encoder_latents)
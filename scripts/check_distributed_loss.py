@@ -0,0 +1,119 @@
+"""Check that the distributed training loss gives the same gradients as single-process training
+
+This runs on CPU with the gloo backend and multiple processes. Each process takes a shard of the
+same batch, where the shards have very different numbers of valid target pixels (one is fully
+masked). The gradients from the all-reduced masked loss are compared to the gradients of the
+masked loss over the whole batch in a single process. The old approach of averaging the
+per-device masked means is also shown for comparison.
+
+use:
+python scripts/check_distributed_loss.py --world-size=2 --target-loss=MAE
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import typer
+from torch.nn.parallel import DistributedDataParallel
+
+from sat_pred.loss import MultiscaleMAE, combine_masked_terms, distributed_masked_loss
+from sat_pred.models.simvp_model import SimVP
+from sat_pred.training_module import TrainingModule
+
+
+def make_module(target_loss: str) -> TrainingModule:
+    torch.manual_seed(0)
+    model = SimVP(num_channels=3, history_len=4, forecast_len=4, hid_S=8, hid_T=32, N_S=2, N_T=2)
+    if target_loss == "multiscale_mae":
+        target_loss = MultiscaleMAE(scales=[(1, 1, 1), (2, 4, 4)])
+    return TrainingModule(model=model, target_loss=target_loss)
+
+
+def make_batch(world_size: int, samples_per_device: int = 2):
+    """Make a batch where each device's shard has a different fraction of valid targets"""
+    torch.manual_seed(1)
+    n = world_size * samples_per_device
+    X = torch.rand(n, 3, 4, 32, 32)
+    y = torch.rand(n, 3, 4, 32, 32)
+
+    for rank in range(world_size):
+        shard = slice(rank * samples_per_device, (rank + 1) * samples_per_device)
+        if rank == world_size - 1:
+            # The last device has no valid targets at all
+            y[shard] = -1
+        else:
+            # Mask an increasing fraction of the targets on each device
+            y[shard][torch.rand_like(y[shard]) < rank / world_size] = -1
+    return X, y
+
+
+def gradients(module: TrainingModule) -> torch.Tensor:
+    return torch.cat([p.grad.flatten() for p in module.model.parameters() if p.grad is not None])
+
+
+def run_rank(rank: int, world_size: int, target_loss: str, results: dict) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29517"
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    X, y = make_batch(world_size)
+    shard = slice(rank * len(X) // world_size, (rank + 1) * len(X) // world_size)
+    X, y = X[shard], y[shard]
+
+    for mode in ["all_reduced", "mean_of_means"]:
+        module = make_module(target_loss)
+        ddp_model = DistributedDataParallel(module.model)
+
+        global_counts = module._target_valid_counts(y)
+        dist.all_reduce(global_counts)
+
+        terms = module._calculate_loss_terms(y, ddp_model(X))[module._target_loss_name]
+
+        if mode == "all_reduced":
+            loss = distributed_masked_loss(terms, global_counts, world_size)
+        else:
+            # The previous approach, where NaN losses were replaced with a zero loss
+            loss = combine_masked_terms(terms)
+            if torch.isnan(loss):
+                loss = terms[0][1] * 0
+
+        loss.backward()
+
+        if rank == 0:
+            results[mode] = gradients(module)
+
+    dist.destroy_process_group()
+
+
+def check_distributed_loss(world_size: int = 2, target_loss: str = "MAE"):
+    """Compare distributed and single-process gradients
+
+    Args:
+        world_size: The number of processes to run
+        target_loss: One of "MAE", "MSE", "SSIM" or "multiscale_mae"
+    """
+
+    # Reference gradients from the whole batch in one process
+    module = make_module(target_loss)
+    X, y = make_batch(world_size)
+    terms = module._calculate_loss_terms(y, module(X))[module._target_loss_name]
+    combine_masked_terms(terms).backward()
+    reference = gradients(module)
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(run_rank, args=(world_size, target_loss, results), nprocs=world_size)
+        results = dict(results)
+
+    for mode, grads in results.items():
+        rel_error = ((grads - reference).norm() / reference.norm()).item()
+        print(f"{mode:>14}: relative gradient error vs single process = {rel_error:.2e}")
+
+    assert torch.allclose(results["all_reduced"], reference, rtol=1e-4, atol=1e-6)
+    print("All-reduced distributed loss matches the single-process gradients")
+
+
+if __name__ == "__main__":
+    typer.run(check_distributed_loss)
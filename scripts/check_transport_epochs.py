@@ -0,0 +1,123 @@
+"""Check that the shared-memory transport doesn't hang or corrupt batches over truncated epochs
+
+Epochs are cut short after a few batches, like with `limit_train_batches` and
+`num_sanity_val_steps`, which leaves prefetched batches that are never staged. Without freeing
+their slots the workers would eventually wait forever for them. Each sample of a synthetic
+dataset is filled with its index, so a slot overwritten while its batch was still queued is
+detected. Both persistent and non-persistent workers are checked.
+
+use:
+python scripts/check_transport_epochs.py --num-workers=4 --num-epochs=20
+"""
+
+try:
+    import torch.multiprocessing as mp
+
+    mp.set_start_method("spawn", force=True)
+except RuntimeError:
+    pass
+
+import time
+
+import numpy as np
+import typer
+from torch.utils.data import Dataset
+
+from sat_pred.transport import SharedSlotRing, SlotCollate, TransportDataLoader, TransportStager
+
+
+class IndexDataset(Dataset):
+    """Samples filled with their index"""
+
+    def __init__(self, num_samples: int, shape: tuple[int, ...]):
+        self.num_samples = num_samples
+        self.shape = shape
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __getitem__(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        x = np.full(self.shape, idx, dtype=np.float32)
+        return x, x
+
+
+def _check(
+    persistent_workers: bool,
+    num_workers: int,
+    batch_size: int,
+    prefetch_factor: int,
+    num_epochs: int,
+    batches_per_epoch: int,
+    timeout: float,
+) -> None:
+    dataset = IndexDataset(num_samples=batch_size * 4 * batches_per_epoch, shape=(2, 3, 8, 8))
+    ring = SharedSlotRing(
+        "check",
+        shapes={"X": dataset.shape, "y": dataset.shape},
+        batch_size=batch_size,
+        num_workers=num_workers,
+        slots_per_worker=prefetch_factor + 2,
+        encoding="float16",
+        acquire_timeout=timeout,
+    )
+    stager = TransportStager(ring)
+    dataloader = TransportDataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=SlotCollate(ring),
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+    )
+
+    start = time.perf_counter()
+    for _ in range(num_epochs):
+        for i, batch in enumerate(dataloader):
+            staged = stager.stage(batch)
+            expected = np.arange(i * batch_size, (i + 1) * batch_size)
+            found = staged.X[:, 0, 0, 0, 0].float().numpy()
+            if not np.array_equal(found, expected):
+                raise AssertionError(f"Batch {i} holds samples {found}, expected {expected}")
+            # Stop early, leaving prefetched batches which are never staged
+            if i + 1 == batches_per_epoch:
+                break
+
+    print(
+        f"persistent_workers={persistent_workers}: {num_epochs} truncated epochs passed in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+
+
+def check_transport_epochs(
+    num_workers: int = 4,
+    batch_size: int = 2,
+    prefetch_factor: int = 2,
+    num_epochs: int = 20,
+    batches_per_epoch: int = 3,
+    timeout: float = 30.0,
+):
+    """Run truncated epochs through the transport with persistent and non-persistent workers
+
+    Args:
+        num_workers: The number of dataloader workers
+        batch_size: The batch size
+        prefetch_factor: The number of batches loaded in advance by each worker
+        num_epochs: The number of epochs to run
+        batches_per_epoch: The number of batches staged before each epoch is cut short
+        timeout: The time in seconds a worker waits for a slot before raising
+    """
+    for persistent_workers in [True, False]:
+        _check(
+            persistent_workers,
+            num_workers,
+            batch_size,
+            prefetch_factor,
+            num_epochs,
+            batches_per_epoch,
+            timeout,
+        )
+
+
+if __name__ == "__main__":
+    typer.run(check_transport_epochs)
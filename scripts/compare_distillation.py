@@ -0,0 +1,93 @@
+"""Compare the accuracy and CPU latency of a distilled student model against its teacher
+
+use:
+python scripts/compare_distillation.py /path/to/checkpoints/student /path/to/checkpoints/teacher \
+    --num-samples=50
+"""
+
+import time
+
+import numpy as np
+import torch
+import typer
+from cloudcasting.dataset import SatelliteDataset
+
+from sat_pred.load_model import get_model_from_checkpoints
+
+
+def masked_mae(y_hat: torch.Tensor, y: torch.Tensor) -> float:
+    valid = y != -1
+    return ((y_hat - y).abs() * valid).sum().item() / max(valid.sum().item(), 1)
+
+
+def compare_distillation(
+    student_checkpoint_dir: str,
+    teacher_checkpoint_dir: str,
+    num_samples: int = 50,
+    batch_size: int = 1,
+    num_threads: int | None = None,
+    seed: int = 0,
+):
+    """Report the MAE and CPU latency of the student and teacher on validation samples
+
+    Args:
+        student_checkpoint_dir: The checkpoint directory of the student model
+        teacher_checkpoint_dir: The checkpoint directory of the teacher model
+        num_samples: The number of random validation samples to evaluate on
+        batch_size: The batch size used to measure latency
+        num_threads: The number of torch threads to use. Defaults to the torch default
+        seed: The random seed used to select the validation samples
+    """
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    student, _, data_config = get_model_from_checkpoints(student_checkpoint_dir)
+    teacher, _, _ = get_model_from_checkpoints(teacher_checkpoint_dir)
+    models = {"student": student.eval(), "teacher": teacher.eval()}
+
+    dataset = SatelliteDataset(
+        zarr_path=data_config["zarr_path"],
+        start_time=data_config["val_period"][0],
+        end_time=data_config["val_period"][1],
+        history_mins=data_config["history_mins"],
+        forecast_mins=data_config["forecast_mins"],
+        sample_freq_mins=data_config["sample_freq_mins"],
+        nan_to_num=data_config["nan_to_num"],
+    )
+
+    indices = np.random.default_rng(seed).choice(len(dataset), num_samples, replace=False)
+
+    maes = {name: [] for name in models}
+    student_vs_teacher = []
+
+    with torch.no_grad():
+        for idx in indices:
+            X, y = [torch.as_tensor(a)[None] for a in dataset[int(idx)]]
+            y_hats = {name: model(X).clip(0, 1) for name, model in models.items()}
+            for name, y_hat in y_hats.items():
+                maes[name].append(masked_mae(y_hat, y))
+            student_vs_teacher.append((y_hats["student"] - y_hats["teacher"]).abs().mean().item())
+
+        # Latency on a fixed batch, after a warm-up run
+        X_batch = torch.as_tensor(np.stack([dataset[int(i)][0] for i in indices[:batch_size]]))
+        latencies = {}
+        for name, model in models.items():
+            model(X_batch)
+            t0 = time.perf_counter()
+            for _ in range(3):
+                model(X_batch)
+            latencies[name] = (time.perf_counter() - t0) / 3 / batch_size
+
+    print(f"{'model':<10}{'params (M)':>12}{'MAE':>10}{'CPU s/sample':>16}")
+    for name, model in models.items():
+        num_params = sum(p.numel() for p in model.parameters()) / 1e6
+        print(f"{name:<10}{num_params:>12.2f}{np.mean(maes[name]):>10.4f}{latencies[name]:>16.3f}")
+
+    print(f"\nStudent vs teacher MAE: {np.mean(student_vs_teacher):.4f}")
+    print(f"Student speedup: {latencies['teacher'] / latencies['student']:.2f}x")
+    print(f"Student MAE change: {np.mean(maes['student']) / np.mean(maes['teacher']) - 1:+.1%}")
+
+
+if __name__ == "__main__":
+    typer.run(compare_distillation)
@@ -0,0 +1,125 @@
+"""Compare the time to reach a target validation loss with uniform and importance sampling
+
+Each sampling mode is trained with `sat_pred/train.py` using the same config and seed, logging to
+CSV. The validation loss curves are then compared against wall time and optimizer steps. By
+default the target is the loosest of the best validation losses of the runs, so every run
+reaches it.
+
+Any extra hydra overrides are passed to every run, e.g. to shorten the runs.
+
+use:
+python scripts/compare_importance_sampling.py --max-epochs=10 \
+    --prior-path=cloud_variability.parquet \
+    --override=trainer.limit_train_batches=2000 --override=trainer.limit_val_batches=100
+"""
+
+import os
+import subprocess
+import sys
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import typer
+
+
+def _train(name: str, overrides: list[str], save_dir: str) -> None:
+    """Run a training job logging to CSV"""
+    command = [
+        sys.executable,
+        "sat_pred/train.py",
+        "datamodule=sat_pred",
+        "logger=csv",
+        f"logger.csv.save_dir={save_dir}",
+        f"model_name={name}",
+        "+callbacks.elapsed_time._target_=sat_pred.callbacks.ElapsedTimeLogger",
+        *overrides,
+    ]
+    print(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def _load_curve(name: str, save_dir: str, metric: str) -> pd.DataFrame:
+    """Load the validation loss of the latest run against its wall time and step"""
+    versions = sorted(
+        glob(f"{save_dir}/{name}/version_*"), key=lambda p: int(p.rsplit("_", 1)[1])
+    )
+    if not versions:
+        raise FileNotFoundError(f"No CSV logs found for {name} in {save_dir}")
+
+    metrics = pd.read_csv(f"{versions[-1]}/metrics.csv")
+    # Metrics logged at the same step can be written to separate rows
+    metrics = metrics.groupby("step").first().reset_index()
+    curve = metrics[["step", "elapsed_mins", metric]].dropna()
+    return curve.sort_values("step").reset_index(drop=True)
+
+
+def _time_to_target(curve: pd.DataFrame, metric: str, target: float) -> tuple[float, float]:
+    """The wall time and step of the first validation at or below the target"""
+    reached = curve[curve[metric] <= target]
+    if len(reached) == 0:
+        return np.nan, np.nan
+    return reached["elapsed_mins"].iloc[0], reached["step"].iloc[0]
+
+
+def compare_importance_sampling(
+    max_epochs: int = 10,
+    target: float | None = None,
+    metric: str = "MAE/val",
+    prior_path: str | None = None,
+    save_dir: str = "csv_logs/importance_sampling",
+    name_prefix: str = "sampling",
+    train: bool = True,
+    override: list[str] | None = None,
+):
+    """Train with each sampling mode and report the time and steps to reach the target loss
+
+    Args:
+        max_epochs: The number of epochs to train each run for
+        target: The validation loss to reach. Defaults to the loosest of the best validation
+            losses of the runs
+        metric: The logged validation metric to compare
+        prior_path: If set, a cloud variability index built with
+            `scripts/build_cloud_variability_index.py`. An extra importance sampling run which
+            uses it as the prior is added
+        save_dir: The directory to save the CSV logs to
+        name_prefix: The prefix of the run names
+        train: Whether to train the runs. If False, the logs of previous runs are compared
+        override: Hydra overrides passed to every run
+    """
+    save_dir = os.path.abspath(save_dir)
+    common = [f"trainer.max_epochs={max_epochs}", *(override or [])]
+
+    runs = {
+        "uniform": ["datamodule.importance_sampling=false"],
+        "importance": ["datamodule.importance_sampling=true"],
+    }
+    if prior_path is not None:
+        runs["importance_prior"] = [
+            "datamodule.importance_sampling=true",
+            f"datamodule.importance_prior_path={os.path.abspath(prior_path)}",
+        ]
+
+    curves = {}
+    for mode, overrides in runs.items():
+        name = f"{name_prefix}_{mode}"
+        if train:
+            _train(name, common + overrides, save_dir)
+        curves[mode] = _load_curve(name, save_dir, metric)
+
+    if target is None:
+        target = max(curve[metric].min() for curve in curves.values())
+
+    print(f"\nTarget {metric}: {target:.5f}")
+    print(f"{'sampling':<18}{'best':>10}{'minutes':>10}{'steps':>10}{'speedup':>10}")
+    uniform_mins, _ = _time_to_target(curves["uniform"], metric, target)
+    for mode, curve in curves.items():
+        mins, step = _time_to_target(curve, metric, target)
+        print(
+            f"{mode:<18}{curve[metric].min():>10.5f}{mins:>10.1f}{step:>10.0f}"
+            f"{uniform_mins / mins:>9.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(compare_importance_sampling)
@@ -0,0 +1,31 @@
+"""Add consolidated metadata to satellite zarr stores
+
+Opening a store with consolidated metadata only reads a single metadata file, which speeds up
+building the datasets and starting the dataloader workers. Training never writes to the data
+stores, so this should be run once on any stores which don't have it, by a user who can write to
+them.
+
+use:
+python scripts/consolidate_zarr_metadata.py \
+    /mnt/disks/sat_data/sat_data_all/2008_training_nonhrv.zarr \
+    /mnt/disks/sat_data/sat_data_all/2009_training_nonhrv.zarr
+"""
+
+import typer
+
+from sat_pred.dataset_index import consolidate_zarr_metadata
+
+
+def consolidate_stores(zarr_paths: list[str]):
+    """Consolidate the metadata of the zarr stores which don't have consolidated metadata
+
+    Args:
+        zarr_paths: The satellite zarrs to consolidate
+    """
+    consolidated = consolidate_zarr_metadata(zarr_paths)
+    for path in zarr_paths:
+        print(f"{path}: {'consolidated' if path in consolidated else 'already consolidated'}")
+
+
+if __name__ == "__main__":
+    typer.run(consolidate_stores)
@@ -0,0 +1,251 @@
+"""Profile the cost of a model config before training it
+
+For a config in configs/model/ this reports the parameter count, the forward and backward FLOPs,
+the activation memory of a training step and, unless the model is built on the meta device, the
+CPU latency of each module. Per-layer results are reported down to the given module depth. The
+results are printed as a table and can be saved as JSON to compare configs and track them over
+time.
+
+On the meta device no real computation is done, so any config can be profiled quickly at the full
+input size. The activation memory is then estimated from the tensors saved for the backward pass.
+On CUDA the peak memory is measured.
+
+use:
+python scripts/profile_model_cost.py configs/model/simvp.yaml --device=meta --output-json=simvp.json
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import typer
+import yaml
+from torch.utils.flop_counter import FlopCounterMode
+
+from sat_pred.inference import instantiate
+
+
+def _build_model(config_path: str, height: int, width: int) -> tuple[torch.nn.Module, dict]:
+    """Build the model of a training config, sized for the given input height and width"""
+    with open(config_path) as f:
+        model_config = yaml.safe_load(f)["model"]
+
+    if model_config.get("from_pretrained", False):
+        raise ValueError(f"{config_path} loads a pretrained model and can't be profiled")
+
+    # The Earthformer is built for a fixed input size
+    for key in ["input_shape", "target_shape"]:
+        if key in model_config:
+            model_config[key][1:3] = [height, width]
+
+    return instantiate(model_config), model_config
+
+
+def _input_shape(model_config: dict, batch_size: int, height: int, width: int) -> tuple:
+    if "input_shape" in model_config:
+        history_len, _, _, num_channels = model_config["input_shape"]
+    else:
+        history_len, num_channels = model_config["history_len"], model_config["num_channels"]
+    return (batch_size, num_channels, history_len, height, width)
+
+
+def _layers(model: torch.nn.Module, depth: int) -> dict[str, torch.nn.Module]:
+    """The modules down to the given depth, named like the FLOP counter names them"""
+    root = type(model).__name__
+    layers = {root: model}
+    for name, module in model.named_modules():
+        if name and name.count(".") < depth:
+            layers[f"{root}.{name}"] = module
+    return layers
+
+
+def _nbytes(t: torch.Tensor) -> int:
+    return t.numel() * t.element_size()
+
+
+@contextmanager
+def _count_saved_tensors(model: torch.nn.Module, counts: dict[str, int]):
+    """Count the bytes of the activations saved for the backward pass"""
+    param_ids = {id(p) for p in model.parameters()}
+    seen = set()
+
+    def pack(t: torch.Tensor) -> torch.Tensor:
+        if id(t) not in param_ids:
+            # Tensors sharing storage are only counted once, except on the meta device where
+            # storage can't be compared
+            key = None if t.is_meta else (t.untyped_storage().data_ptr(), t.storage_offset())
+            if key is None or key not in seen:
+                seen.add(key)
+                counts["saved"] += _nbytes(t)
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        yield
+
+
+def _memory(model: torch.nn.Module, X: torch.Tensor) -> dict[str, float]:
+    """Measure or estimate the peak memory of the forward and backward passes in GB"""
+    param_bytes = sum(_nbytes(p) for p in model.parameters())
+    counts = defaultdict(int)
+    cuda = X.device.type == "cuda"
+
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    with _count_saved_tensors(model, counts):
+        y_hat = model(X)
+
+    if cuda:
+        forward_peak = torch.cuda.max_memory_allocated()
+
+    y_hat.float().mean().backward()
+
+    if cuda:
+        backward_peak = torch.cuda.max_memory_allocated()
+    else:
+        # The saved activations and output are held until the backward pass, which then adds the
+        # parameter gradients
+        forward_peak = param_bytes + _nbytes(X) + counts["saved"] + _nbytes(y_hat)
+        backward_peak = forward_peak + param_bytes
+
+    model.zero_grad(set_to_none=True)
+    return {
+        "saved_activations_gb": counts["saved"] / 1e9,
+        "forward_peak_gb": forward_peak / 1e9,
+        "backward_peak_gb": backward_peak / 1e9,
+        "measured": cuda,
+    }
+
+
+def _flops(model: torch.nn.Module, X: torch.Tensor) -> tuple[dict[str, int], int]:
+    """Count the forward FLOPs of each module and the total FLOPs of the backward pass"""
+    with FlopCounterMode(display=False) as counter:
+        y_hat = model(X)
+    forward = {name: sum(ops.values()) for name, ops in counter.get_flop_counts().items()}
+
+    with FlopCounterMode(display=False) as counter:
+        y_hat.float().mean().backward()
+    model.zero_grad(set_to_none=True)
+
+    return forward, counter.get_total_flops()
+
+
+def _latency(
+    model: torch.nn.Module, X: torch.Tensor, layers: dict[str, torch.nn.Module], n_runs: int
+) -> dict[str, float]:
+    """Measure the median forward time of each module in ms using forward hooks"""
+    times = defaultdict(list)
+    run_times = defaultdict(float)
+    starts = {}
+    handles = []
+
+    for name, module in layers.items():
+        def pre_hook(module, args, name=name):
+            starts[name] = time.perf_counter()
+
+        def hook(module, args, output, name=name):
+            run_times[name] += time.perf_counter() - starts[name]
+
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(hook))
+
+    with torch.no_grad():
+        # Warm up
+        model(X)
+        for _ in range(n_runs):
+            run_times.clear()
+            model(X)
+            for name, t in run_times.items():
+                times[name].append(t)
+
+    for handle in handles:
+        handle.remove()
+
+    return {name: 1e3 * float(np.median(t)) for name, t in times.items()}
+
+
+def profile_model_cost(
+    config_path: str,
+    device: str = "meta",
+    batch_size: int = 1,
+    height: int = 372,
+    width: int = 614,
+    depth: int = 2,
+    n_runs: int = 5,
+    output_json: str | None = None,
+):
+    """Report the parameters, FLOPs, activation memory and per-module latency of a model config
+
+    Args:
+        config_path: The model config, e.g. configs/model/simvp.yaml
+        device: The device to build the model on. One of "meta", "cpu" or "cuda". The latency is
+            only measured on "cpu"
+        batch_size: The batch size
+        height: The height of the input images
+        width: The width of the input images
+        depth: The module depth to report per-layer results down to
+        n_runs: The number of forward passes to time the module latencies over
+        output_json: If set, the results are saved to this JSON file
+    """
+    with torch.device(device):
+        model, model_config = _build_model(config_path, height, width)
+        X = torch.rand(_input_shape(model_config, batch_size, height, width))
+
+    layers = _layers(model, depth)
+
+    forward_flops, backward_flops = _flops(model, X)
+    memory = _memory(model, X)
+    latency = _latency(model.eval(), X, layers, n_runs) if device == "cpu" else {}
+
+    per_layer = [
+        {
+            "name": name,
+            "params": sum(p.numel() for p in module.parameters()),
+            "forward_flops": forward_flops.get(name, 0),
+            "latency_ms": latency.get(name),
+        }
+        for name, module in layers.items()
+    ]
+
+    results = {
+        "config": config_path,
+        "device": device,
+        "input_shape": list(X.shape),
+        "params": sum(p.numel() for p in model.parameters()),
+        "forward_flops": forward_flops.get("Global", 0),
+        "backward_flops": backward_flops,
+        **memory,
+        "layers": per_layer,
+    }
+
+    print(f"\n{'layer':<48}{'params (M)':>12}{'GFLOPs':>12}{'latency (ms)':>14}")
+    for layer in per_layer:
+        latency_ms = "" if layer["latency_ms"] is None else f"{layer['latency_ms']:.2f}"
+        print(
+            f"{layer['name']:<48}{layer['params'] / 1e6:>12.2f}"
+            f"{layer['forward_flops'] / 1e9:>12.2f}{latency_ms:>14}"
+        )
+
+    memory_source = "measured" if memory["measured"] else "estimated"
+    print(
+        f"\ninput {tuple(X.shape)}: {results['params'] / 1e6:.2f} M params, "
+        f"{results['forward_flops'] / 1e9:.1f} GFLOPs forward, "
+        f"{results['backward_flops'] / 1e9:.1f} GFLOPs backward"
+    )
+    print(
+        f"{memory_source} memory: {memory['saved_activations_gb']:.2f} GB saved activations, "
+        f"{memory['forward_peak_gb']:.2f} GB forward peak, "
+        f"{memory['backward_peak_gb']:.2f} GB backward peak"
+    )
+
+    if output_json is not None:
+        with open(output_json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    typer.run(profile_model_cost)
@@ -0,0 +1,201 @@
+"""Prune the Inception branches and hidden channels of a trained SimVP to reduce its latency
+
+A calibration pass over validation samples measures how much each Inception branch contributes to
+its layer's output and how important each hidden channel is. The CPU latency of each branch is
+measured on the calibration inputs. The branches with the least contribution per unit latency are
+removed until the target latency is reached, and the least important hidden channels are removed
+from each layer. The smaller model is rebuilt with the matching weights, optionally fine-tuned for
+a few steps, and saved as a checkpoint directory which can be loaded like any other.
+
+use:
+python scripts/prune_simvp.py /path/to/checkpoints/ob9v9128 /path/to/checkpoints/ob9v9128_pruned \
+    --target-latency-fraction=0.6 --channel-keep-ratio=0.75 --finetune-steps=2000
+"""
+
+import os
+import time
+
+import hydra
+import lightning.pytorch as pl
+import numpy as np
+import torch
+import typer
+import yaml
+from cloudcasting.dataset import SatelliteDataset
+from pyaml_env import parse_config
+
+from sat_pred.dataset import SatPredDataModule
+from sat_pred.load_model import get_model_from_checkpoints
+from sat_pred.pruning import (
+    CalibrationStats,
+    count_parameters,
+    layer_specs,
+    measure_branch_latency,
+    prune_simvp,
+    select_branches,
+    select_channels,
+)
+
+
+def masked_mae(y_hat: torch.Tensor, y: torch.Tensor) -> float:
+    valid = y != -1
+    return ((y_hat - y).abs() * valid).sum().item() / max(valid.sum().item(), 1)
+
+
+def model_latency(model: torch.nn.Module, X: torch.Tensor, n_repeats: int = 3) -> float:
+    with torch.no_grad():
+        model(X)
+        t0 = time.perf_counter()
+        for _ in range(n_repeats):
+            model(X)
+    return (time.perf_counter() - t0) / n_repeats
+
+
+def prune_simvp_checkpoint(
+    checkpoint_dir_path: str,
+    save_dir: str,
+    val_best: bool = True,
+    target_latency_fraction: float = 0.6,
+    channel_keep_ratio: float = 1.0,
+    num_calibration_samples: int = 32,
+    num_eval_samples: int = 32,
+    finetune_steps: int = 0,
+    finetune_batch_size: int | None = None,
+    num_threads: int | None = None,
+    seed: int = 0,
+):
+    """Prune a trained SimVP model and save it as a new checkpoint directory
+
+    Args:
+        checkpoint_dir_path: The checkpoint directory of the model to prune
+        save_dir: The directory to save the pruned model checkpoint to
+        val_best: Whether to use the best validation checkpoint, else the last checkpoint
+        target_latency_fraction: Branches are removed until the total CPU latency of the Inception
+            branches is below this fraction of the original
+        channel_keep_ratio: The fraction of the hidden channels to keep in each Inception layer
+        num_calibration_samples: The number of validation samples used to measure the importance
+            of the branches and channels
+        num_eval_samples: The number of validation samples used to compare the original and pruned
+            models. These are different from the calibration samples
+        finetune_steps: If greater than zero, the pruned model is fine-tuned for this many steps
+        finetune_batch_size: The batch size used for fine-tuning. Defaults to the batch size in
+            the data config
+        num_threads: The number of torch threads to use. Defaults to the torch default
+        seed: The random seed used to select the validation samples
+    """
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model, model_kwargs, data_config = get_model_from_checkpoints(checkpoint_dir_path, val_best)
+    model = model.eval()
+
+    dataset = SatelliteDataset(
+        zarr_path=data_config["zarr_path"],
+        start_time=data_config["val_period"][0],
+        end_time=data_config["val_period"][1],
+        history_mins=data_config["history_mins"],
+        forecast_mins=data_config["forecast_mins"],
+        sample_freq_mins=data_config["sample_freq_mins"],
+        nan_to_num=data_config["nan_to_num"],
+    )
+
+    indices = np.random.default_rng(seed).choice(
+        len(dataset), num_calibration_samples + num_eval_samples, replace=False
+    )
+    calibration_indices = indices[:num_calibration_samples]
+    eval_indices = indices[num_calibration_samples:]
+
+    def load_sample(idx):
+        return [torch.as_tensor(a)[None] for a in dataset[int(idx)]]
+
+    # Calibration pass
+    stats = CalibrationStats(model)
+    with torch.no_grad():
+        for idx in calibration_indices:
+            X, _ = load_sample(idx)
+            model(X)
+    stats.remove()
+
+    latencies = [
+        measure_branch_latency(layer, x) for layer, x in zip(stats.layers, stats.branch_inputs)
+    ]
+
+    keep_branches = select_branches(
+        stats.branch_contributions(), latencies, target_latency_fraction
+    )
+    keep_channels = select_channels(
+        stats.channel_importance(),
+        [spec["groups"] for spec in layer_specs(model)],
+        channel_keep_ratio,
+    )
+
+    pruned_model, pruned_kwargs = prune_simvp(model, model_kwargs, keep_branches, keep_channels)
+    pruned_model = pruned_model.eval()
+
+    for n, (spec, new_spec) in enumerate(zip(layer_specs(model), pruned_kwargs["mid_layer_specs"])):
+        print(
+            f"Layer {n}: kernels {spec['incep_ker']} -> {new_spec['incep_ker']}, "
+            f"hidden channels {spec['C_hid']} -> {new_spec['C_hid']}"
+        )
+
+    # Build the lightning wrapper of the pruned model from the original config
+    model_config = parse_config(f"{checkpoint_dir_path}/model_config.yaml")
+    model_config["model"] = pruned_kwargs
+    lightning_wrapped_model = hydra.utils.instantiate(model_config)
+    lightning_wrapped_model.model.load_state_dict(pruned_model.state_dict())
+
+    if finetune_steps > 0:
+        datamodule_kwargs = {k: v for k, v in data_config.items() if k != "_target_"}
+        if finetune_batch_size is not None:
+            datamodule_kwargs["batch_size"] = finetune_batch_size
+        datamodule = SatPredDataModule(**datamodule_kwargs)
+
+        trainer = pl.Trainer(
+            max_steps=finetune_steps,
+            limit_val_batches=0,
+            logger=False,
+            enable_checkpointing=False,
+        )
+        trainer.fit(lightning_wrapped_model, datamodule=datamodule)
+        pruned_model = lightning_wrapped_model.model.cpu().eval()
+
+    # Compare the original and pruned models on samples not used for calibration
+    maes = {"original": [], "pruned": []}
+    with torch.no_grad():
+        for idx in eval_indices:
+            X, y = load_sample(idx)
+            maes["original"].append(masked_mae(model(X).clip(0, 1), y))
+            maes["pruned"].append(masked_mae(pruned_model(X).clip(0, 1), y))
+
+    X, _ = load_sample(eval_indices[0])
+    latencies = {"original": model_latency(model, X), "pruned": model_latency(pruned_model, X)}
+    n_params = {"original": count_parameters(model), "pruned": count_parameters(pruned_model)}
+
+    print(f"{'model':<10} {'MAE':>8} {'CPU latency (s)':>16} {'parameters':>12}")
+    for name in maes:
+        print(
+            f"{name:<10} {np.mean(maes[name]):>8.4f} {latencies[name]:>16.3f} "
+            f"{n_params[name]:>12,}"
+        )
+
+    # Save in the same layout as the training checkpoints so the model can be loaded with
+    # `get_model_from_checkpoints()`
+    os.makedirs(save_dir, exist_ok=True)
+    with open(f"{save_dir}/model_config.yaml", "w") as f:
+        yaml.dump(model_config, f, default_flow_style=False)
+    with open(f"{save_dir}/data_config.yaml", "w") as f:
+        yaml.dump(data_config, f, default_flow_style=False)
+
+    state_dict = {k: v.cpu() for k, v in lightning_wrapped_model.state_dict().items()}
+    torch.save(
+        {"state_dict": state_dict},
+        f"{save_dir}/epoch=0-step={finetune_steps}.ckpt"
+    )
+    torch.save({"state_dict": state_dict}, f"{save_dir}/last.ckpt")
+
+    print(f"Saved pruned model to {save_dir}")
+
+
+if __name__ == "__main__":
+    typer.run(prune_simvp_checkpoint)
@@ -0,0 +1,243 @@
+"""Rechunk a backtest forecast archive into a layout optimised for time series queries
+
+`scripts/backtest.py` writes forecasts in chunks of one init time and 100x100 pixels, which is
+good for plotting maps but means reading a time series at a single pixel touches every chunk in
+the archive. This script rewrites the archive with chunks which span many init times and only a
+few pixels.
+
+A direct copy would read each source chunk once for every target chunk it overlaps, so the copy
+is done in two stages, each of which reads its input only once and stays within a memory budget:
+
+1. Blocks of init times are read over the full grid and written to a local intermediate store
+   chunked as (block of init times, small spatial tiles).
+2. For each target block of init times, groups of spatial tiles are read from the intermediate
+   store and written to the target store.
+
+Progress is saved after each block, so an interrupted run can be resumed by running the same
+command again.
+
+use:
+python scripts/rechunk_backtest.py "/mnt/disks/sat_preds/simvp_preds/part_*.zarr" \
+    /mnt/disks/sat_preds/simvp_preds_timeseries.zarr --tmp-dir=/mnt/local_ssd/rechunk \
+    --max-mem-gb=4
+"""
+
+import json
+import math
+import os
+import shutil
+import time
+
+import typer
+import xarray as xr
+import zarr
+from tqdm import tqdm
+
+from sat_pred.archive import open_backtest_archive
+
+
+SPATIAL_DIMS = ["y_geostationary", "x_geostationary"]
+
+
+def _bytes_per_sample(ds: xr.Dataset) -> int:
+    """The bytes of all data variables per init time and pixel"""
+    total = 0
+    for da in ds.data_vars.values():
+        other_sizes = [n for d, n in da.sizes.items() if d not in ["init_time", *SPATIAL_DIMS]]
+        total += da.dtype.itemsize * math.prod(other_sizes)
+    return total
+
+
+def _drop_chunk_encoding(ds: xr.Dataset) -> xr.Dataset:
+    """Remove the source chunk encoding so it doesn't conflict with the new chunks"""
+    ds = ds.copy()
+    for v in ds.variables:
+        ds[v].encoding.pop("chunks", None)
+        ds[v].encoding.pop("preferred_chunks", None)
+    return ds
+
+
+def _create_store(ds: xr.Dataset, path: str, chunks: dict[str, int]) -> None:
+    """Create an empty store with the dataset's coordinates and the given chunks"""
+    ds = _drop_chunk_encoding(ds)
+    chunks = {d: n for d, n in chunks.items() if d in ds.dims}
+    ds.chunk(chunks).to_zarr(path, mode="w", compute=False)
+
+
+def _write_region(ds: xr.Dataset, path: str, region: dict[str, slice]) -> None:
+    """Write a block of data into an existing store"""
+    # Variables which don't share any dimension with the region were written on creation
+    ds = ds.drop_vars([v for v in ds.variables if not set(ds[v].dims) & set(region)])
+    _drop_chunk_encoding(ds).to_zarr(path, region=region)
+
+
+class Progress:
+    def __init__(self, path: str, config: dict):
+        """Record of which blocks have been written, saved after each block
+
+        Args:
+            path: Path to the progress json file
+            config: The rechunking options. A saved progress file is only resumed from if it was
+                created with the same options
+        """
+        self.path = path
+        state = None
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state["config"] != config:
+                raise ValueError(
+                    f"The progress file {path} was created with different options. Remove it "
+                    "to start again"
+                )
+        self.state = state or {"config": config, "created": [], "stage1": [], "stage2": []}
+
+    def done(self, stage: str, key: str) -> bool:
+        return key in self.state[stage]
+
+    def mark(self, stage: str, key: str) -> None:
+        self.state[stage].append(key)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+def _time_pixel_query(path: str | list[str], variable: str) -> float:
+    """Time reading the full time series at the centre pixel of a store"""
+    start = time.perf_counter()
+    ds = open_backtest_archive(path)
+    da = ds[variable].isel(
+        y_geostationary=ds.sizes["y_geostationary"] // 2,
+        x_geostationary=ds.sizes["x_geostationary"] // 2,
+    )
+    da.values
+    return time.perf_counter() - start
+
+
+def rechunk_backtest(
+    source_path: str,
+    target_path: str,
+    tmp_dir: str = "/tmp/rechunk_backtest",
+    init_time_chunk: int = 2048,
+    spatial_chunk: int = 4,
+    max_mem_gb: float = 2.0,
+    keep_intermediate: bool = False,
+    benchmark: bool = True,
+):
+    """Rechunk a backtest archive for fast time series queries
+
+    Args:
+        source_path: Path to the forecast zarr store, or a glob of `part_*.zarr` stores
+        target_path: Path to write the rechunked store to
+        tmp_dir: Local directory for the intermediate store and progress file
+        init_time_chunk: The number of init times in each target chunk
+        spatial_chunk: The height and width in pixels of each target chunk
+        max_mem_gb: The memory budget for the data loaded at any one time
+        keep_intermediate: Whether to keep the intermediate store once finished
+        benchmark: Whether to time a single pixel time series query on the source and target
+    """
+
+    ds = open_backtest_archive(source_path)
+    n_init = ds.sizes["init_time"]
+    height, width = ds.sizes["y_geostationary"], ds.sizes["x_geostationary"]
+    max_bytes = max_mem_gb * 1e9
+    bytes_per_sample = _bytes_per_sample(ds)
+
+    init_time_chunk = min(init_time_chunk, n_init)
+    target_chunk_bytes = init_time_chunk * spatial_chunk**2 * bytes_per_sample
+    if target_chunk_bytes > max_bytes:
+        raise ValueError(
+            f"A single target chunk is {target_chunk_bytes / 1e9:.2f} GB, which is larger than "
+            "the memory budget. Reduce the chunk sizes or increase the budget"
+        )
+
+    # Stage 1 reads blocks of init times over the full grid. The block size is chosen to divide
+    # the target chunk so stage 2 reads whole intermediate chunks
+    block_bytes = bytes_per_sample * height * width
+    stage1_block = int(max(1, min(init_time_chunk, max_bytes // block_bytes)))
+    while init_time_chunk % stage1_block != 0:
+        stage1_block -= 1
+
+    # Stage 2 reads square groups of target chunks for one block of init times
+    group_tiles = max(1, math.isqrt(int(max_bytes // target_chunk_bytes)))
+    group_pixels = group_tiles * spatial_chunk
+
+    target_chunks = {
+        "init_time": init_time_chunk,
+        "y_geostationary": spatial_chunk,
+        "x_geostationary": spatial_chunk,
+        **{d: -1 for d in ds.dims if d not in ["init_time", *SPATIAL_DIMS]},
+    }
+    intermediate_chunks = {**target_chunks, "init_time": stage1_block}
+
+    print(
+        f"Rechunking {n_init} init times in blocks of {stage1_block} (stage 1) and "
+        f"{init_time_chunk} init times x {group_pixels} pixels (stage 2)"
+    )
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    intermediate_path = f"{tmp_dir}/intermediate.zarr"
+    progress = Progress(
+        f"{tmp_dir}/progress.json",
+        config={
+            "source_path": source_path,
+            "target_path": target_path,
+            "target_chunks": target_chunks,
+            "intermediate_chunks": intermediate_chunks,
+            "group_pixels": group_pixels,
+        },
+    )
+
+    if not progress.done("created", "stores"):
+        _create_store(ds, intermediate_path, intermediate_chunks)
+        _create_store(ds, target_path, target_chunks)
+        progress.mark("created", "stores")
+
+    # Stage 1: source -> intermediate
+    for start in tqdm(range(0, n_init, stage1_block), desc="Stage 1"):
+        if progress.done("stage1", str(start)):
+            continue
+        region = {"init_time": slice(start, min(start + stage1_block, n_init))}
+        _write_region(ds.isel(region).load(), intermediate_path, region)
+        progress.mark("stage1", str(start))
+
+    # Stage 2: intermediate -> target
+    ds_intermediate = xr.open_zarr(intermediate_path)
+    tasks = [
+        (start, y0, x0)
+        for start in range(0, n_init, init_time_chunk)
+        for y0 in range(0, height, group_pixels)
+        for x0 in range(0, width, group_pixels)
+    ]
+    for start, y0, x0 in tqdm(tasks, desc="Stage 2"):
+        key = f"{start}_{y0}_{x0}"
+        if progress.done("stage2", key):
+            continue
+        region = {
+            "init_time": slice(start, min(start + init_time_chunk, n_init)),
+            "y_geostationary": slice(y0, min(y0 + group_pixels, height)),
+            "x_geostationary": slice(x0, min(x0 + group_pixels, width)),
+        }
+        _write_region(ds_intermediate.isel(region).load(), target_path, region)
+        progress.mark("stage2", key)
+
+    zarr.consolidate_metadata(target_path)
+
+    if not keep_intermediate:
+        shutil.rmtree(intermediate_path)
+
+    print(f"Rechunked archive written to {target_path}")
+
+    if benchmark:
+        variable = list(ds.data_vars)[0]
+        source_time = _time_pixel_query(source_path, variable)
+        target_time = _time_pixel_query([target_path], variable)
+        print(
+            f"Single pixel time series query: source {source_time:.2f} s, "
+            f"target {target_time:.3f} s ({source_time / target_time:.0f}x faster)"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(rechunk_backtest)
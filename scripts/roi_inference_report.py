@@ -0,0 +1,138 @@
+"""Check region-of-interest inference against full-domain inference and report the speed-up
+
+For random init times and regions, the forecast from `ROIForecaster` is compared to the same
+region cut out of the full-domain forecast. The script exits with an error if the largest
+difference is above the tolerance.
+
+Only models with a receptive field which is small compared to the domain benefit, e.g.
+`configs/model/simvp_v2.yaml`. With the deeper `configs/model/simvp.yaml` the padded crop covers
+the full domain, so there is no speed-up. See `sat_pred/roi.py` for the receptive field of each
+config.
+
+use:
+python scripts/roi_inference_report.py /path/to/checkpoints/ob9v9128 --roi-size=64 --num-samples=10
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import typer
+from cloudcasting.dataset import load_satellite_zarrs
+
+from sat_pred.load_model import get_model_from_checkpoints
+from sat_pred.roi import ROIForecaster, simvp_receptive_field
+
+
+def roi_inference_report(
+    checkpoint_dir_path: str,
+    zarr_path: str | None = None,
+    roi_size: int = 64,
+    num_samples: int = 10,
+    extra_margin: int = 0,
+    tolerance: float = 0.02,
+    device: str = "cpu",
+    seed: int = 0,
+):
+    """Compare region-of-interest inference to full-domain inference
+
+    Args:
+        checkpoint_dir_path: The checkpoint directory of the SimVP model
+        zarr_path: The satellite data to use. Defaults to the validation data in the data config
+        roi_size: The width and height of the random regions in pixels
+        num_samples: The number of random (init time, region) pairs to compare
+        extra_margin: Extra pixels to pad the crop by beyond the receptive field
+        tolerance: The maximum allowed absolute difference between the two forecasts
+        device: The device to run the model on
+        seed: The random seed used to select the init times and regions
+    """
+
+    model, _, data_config = get_model_from_checkpoints(checkpoint_dir_path)
+
+    if zarr_path is None:
+        ds = load_satellite_zarrs(data_config["zarr_path"]).sel(
+            time=slice(*data_config["val_period"])
+        )
+    else:
+        ds = load_satellite_zarrs(zarr_path)
+    ds = ds.sel(time=np.mod(ds.time.dt.minute, data_config["sample_freq_mins"]) == 0)
+
+    forecaster = ROIForecaster(
+        model,
+        ds,
+        history_mins=data_config["history_mins"],
+        nan_to_num=data_config["nan_to_num"],
+        extra_margin=extra_margin,
+        device=device,
+    )
+
+    receptive_field, downsample_factor = simvp_receptive_field(model)
+    print(
+        f"Receptive field: {receptive_field} pixels, downsample factor: {downsample_factor}, "
+        f"margin: {forecaster.margin} pixels"
+    )
+    crop_size = roi_size + 2 * forecaster.margin
+    if all(crop_size >= size for size in forecaster.domain_shape):
+        print(
+            f"The padded crop of a {roi_size} pixel region covers the full "
+            f"{forecaster.domain_shape[0]} x {forecaster.domain_shape[1]} domain, so no speed-up "
+            "is expected from this model"
+        )
+
+    rng = np.random.default_rng(seed)
+    times = pd.DatetimeIndex(ds.time.values)
+    t0s = times[times >= times[0] + pd.Timedelta(minutes=data_config["history_mins"])]
+
+    ny, nx = len(ds.y_geostationary), len(ds.x_geostationary)
+    results = []
+
+    for _ in range(num_samples):
+        t0 = t0s[rng.integers(len(t0s))]
+        y0 = rng.integers(0, ny - roi_size)
+        x0 = rng.integers(0, nx - roi_size)
+        y_bounds = tuple(ds.y_geostationary.values[[y0, y0 + roi_size - 1]])
+        x_bounds = tuple(ds.x_geostationary.values[[x0, x0 + roi_size - 1]])
+
+        start = time.perf_counter()
+        y_hat_full = forecaster.predict(forecaster.load_input(t0))
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        y_hat_roi = forecaster(t0, x_bounds, y_bounds).values
+        roi_time = time.perf_counter() - start
+
+        y_hat_full = y_hat_full[..., y0:y0 + roi_size, x0:x0 + roi_size]
+        abs_diff = np.abs(y_hat_full - y_hat_roi)
+
+        crop_shape = forecaster.window(x_bounds, y_bounds).crop_shape
+        results.append(
+            {
+                "t0": t0,
+                "crop_pixels": crop_shape[0] * crop_shape[1],
+                "max_abs_diff": abs_diff.max(),
+                "mean_abs_diff": abs_diff.mean(),
+                "full_time": full_time,
+                "roi_time": roi_time,
+            }
+        )
+
+    df = pd.DataFrame(results)
+    print(df.to_string(index=False))
+
+    speedup = df.full_time.sum() / df.roi_time.sum()
+    print(
+        f"\nFull domain: {df.full_time.mean():.3f} s/sample, "
+        f"ROI: {df.roi_time.mean():.3f} s/sample, speed-up: {speedup:.1f}x, "
+        f"read {df.crop_pixels.mean() / (nx * ny):.1%} of the grid"
+    )
+    print(
+        f"Max abs difference: {df.max_abs_diff.max():.4f}, "
+        f"mean abs difference: {df.mean_abs_diff.mean():.5f}"
+    )
+
+    if df.max_abs_diff.max() > tolerance:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(roi_inference_report)
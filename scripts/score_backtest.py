@@ -0,0 +1,277 @@
+"""Score a stored backtest forecast archive against the satellite observations
+
+The forecasts are scored in blocks of init times, with the blocks processed in parallel. Each
+block reads the observations it needs once, then iterates over rows of forecast chunks so only one
+row of forecast chunks is in memory at a time. The peak memory of each worker is roughly
+
+    (init_time_block + num_steps) * num_variables * grid_size * 4 bytes  (observations)
+    + init_time_block * num_steps * num_variables * chunk_height * grid_width * 4 bytes  (forecasts)
+
+The masked sums of the absolute and squared errors are stored per init-time block, lead time,
+variable and region (one region per forecast spatial chunk) in a sqlite database. Blocks which
+are already in the database are skipped, so an interrupted run can be resumed. A database can
+only be resumed with the same options, since the blocks are identified by their first init time.
+
+use:
+python scripts/score_backtest.py "/mnt/disks/sat_preds/simvp_preds/part_*.zarr" \
+    /mnt/disks/all_data/sat/2022_nonhrv.zarr /mnt/disks/all_data/sat/2023_nonhrv.zarr \
+    --metrics-db=simvp_metrics.sqlite --num-workers=8
+
+The metrics can then be queried with sql, e.g. the MAE by lead time:
+
+    SELECT step_mins, SUM(sum_abs_error) / SUM(count) AS mae
+    FROM errors GROUP BY step_mins ORDER BY step_mins
+"""
+
+import json
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import typer
+import xarray as xr
+from cloudcasting.dataset import load_satellite_zarrs
+from tqdm import tqdm
+
+from sat_pred.archive import open_backtest_archive
+
+
+SPATIAL_DIMS = ["y_geostationary", "x_geostationary"]
+
+# The datasets are opened once in each worker process
+_forecast_ds = None
+_obs_ds = None
+
+
+def _init_worker(forecast_path: str, obs_paths: list[str]) -> None:
+    global _forecast_ds, _obs_ds
+    _forecast_ds = open_backtest_archive(forecast_path)
+    _obs_ds = load_satellite_zarrs(obs_paths)
+
+
+def _chunk_bounds(chunks: tuple[int, ...]) -> list[tuple[int, int]]:
+    bounds = np.cumsum((0,) + tuple(chunks))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def score_block(
+    init_slice: tuple[int, int],
+    y_chunks: tuple[int, ...],
+    x_chunks: tuple[int, ...],
+    variable: str = "sat_pred",
+) -> pd.DataFrame:
+    """Calculate the masked error sums for a block of init times
+
+    Args:
+        init_slice: The start and stop index of the init times in the block
+        y_chunks: The forecast chunk sizes along the y dimension
+        x_chunks: The forecast chunk sizes along the x dimension
+        variable: The forecast variable to score
+
+    Returns:
+        Dataframe with the error sums per lead time, variable and region
+    """
+    da_fc = _forecast_ds[variable].isel(init_time=slice(*init_slice))
+    da_fc = da_fc.transpose("init_time", "step", "variable", *SPATIAL_DIMS)
+
+    init_times = pd.DatetimeIndex(da_fc.init_time.values)
+    steps = pd.TimedeltaIndex(da_fc.step.values)
+
+    # Load all the observations needed for the block at once. The valid times of consecutive
+    # init times overlap, so this reads each observation time only once
+    valid_times = (init_times[:, None] + steps[None, :])
+    obs_times = pd.DatetimeIndex(np.unique(valid_times.ravel()))
+    da_obs = (
+        _obs_ds.data.sel(time=slice(obs_times[0], obs_times[-1]))
+        .sel(variable=da_fc.variable.values)
+        .transpose("time", "variable", *SPATIAL_DIMS)
+        .compute()
+        .reindex(time=obs_times)
+    )
+    obs_index = obs_times.get_indexer(valid_times.ravel()).reshape(valid_times.shape)
+
+    rows = []
+    for ry, (y0, y1) in enumerate(_chunk_bounds(y_chunks)):
+        # Load one row of forecast chunks and the matching observations. Both have shape
+        # (init_time, step, variable, y, x)
+        fc = da_fc.isel(y_geostationary=slice(y0, y1)).values
+        obs = da_obs.isel(y_geostationary=slice(y0, y1)).values[obs_index]
+
+        for rx, (x0, x1) in enumerate(_chunk_bounds(x_chunks)):
+            y_hat = fc[..., x0:x1]
+            y = obs[..., x0:x1]
+
+            error = y_hat - y
+            valid = np.isfinite(error)
+            error = np.where(valid, error, 0)
+
+            sum_abs = np.abs(error).sum(axis=(0, 3, 4))
+            sum_sq = (error**2).sum(axis=(0, 3, 4))
+            count = valid.sum(axis=(0, 3, 4))
+
+            for i, step in enumerate(steps):
+                for j, var in enumerate(da_fc.variable.values):
+                    rows.append(
+                        {
+                            "init_block_start": str(init_times[0]),
+                            "step_mins": int(step.total_seconds() // 60),
+                            "variable": str(var),
+                            "region_y": ry,
+                            "region_x": rx,
+                            "sum_abs_error": float(sum_abs[i, j]),
+                            "sum_sq_error": float(sum_sq[i, j]),
+                            "count": int(count[i, j]),
+                        }
+                    )
+
+    return pd.DataFrame(rows)
+
+
+def _create_tables(con: sqlite3.Connection) -> None:
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS errors (
+            init_block_start TEXT, step_mins INTEGER, variable TEXT,
+            region_y INTEGER, region_x INTEGER,
+            sum_abs_error REAL, sum_sq_error REAL, count INTEGER
+        )
+        """
+    )
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS regions (
+            region_y INTEGER, region_x INTEGER,
+            y_min REAL, y_max REAL, x_min REAL, x_max REAL,
+            PRIMARY KEY (region_y, region_x)
+        )
+        """
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS completed_blocks (init_block_start TEXT PRIMARY KEY)")
+    con.execute("CREATE TABLE IF NOT EXISTS config (config TEXT)")
+
+
+def _check_config(con: sqlite3.Connection, metrics_db: str, config: dict) -> None:
+    """Save the scoring options, or check they match the options the database was created with
+
+    The completed blocks are keyed by their first init time, so resuming with a different block
+    size would skip blocks which were only partly scored and score others twice.
+    """
+    row = con.execute("SELECT config FROM config").fetchone()
+    if row is None:
+        con.execute("INSERT INTO config VALUES (?)", (json.dumps(config),))
+        con.commit()
+    elif json.loads(row[0]) != config:
+        raise ValueError(
+            f"The metrics database {metrics_db} was created with different options. Remove it "
+            "to start again"
+        )
+
+
+def _write_regions(con: sqlite3.Connection, ds: xr.Dataset, y_chunks, x_chunks) -> None:
+    y, x = ds.y_geostationary.values, ds.x_geostationary.values
+    rows = [
+        (
+            ry, rx,
+            float(min(y[y0], y[y1-1])), float(max(y[y0], y[y1-1])),
+            float(min(x[x0], x[x1-1])), float(max(x[x0], x[x1-1])),
+        )
+        for ry, (y0, y1) in enumerate(_chunk_bounds(y_chunks))
+        for rx, (x0, x1) in enumerate(_chunk_bounds(x_chunks))
+    ]
+    con.executemany("INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+
+
+def score_backtest(
+    forecast_path: str,
+    obs_paths: list[str],
+    metrics_db: str = "backtest_metrics.sqlite",
+    init_time_block: int = 24,
+    num_workers: int = 4,
+    variable: str = "sat_pred",
+):
+    """Score a backtest forecast archive against the satellite observations
+
+    Args:
+        forecast_path: Path to the forecast zarr store, or a glob of part stores
+        obs_paths: Paths to the satellite zarrs to score against
+        metrics_db: The sqlite database to write the metrics to
+        init_time_block: The number of init times scored together by each task. Larger blocks
+            read less overlapping observation data but use more memory
+        num_workers: The number of worker processes
+        variable: The forecast variable to score
+    """
+
+    ds = open_backtest_archive(forecast_path)
+    y_chunks = ds[variable].chunksizes["y_geostationary"]
+    x_chunks = ds[variable].chunksizes["x_geostationary"]
+    init_times = pd.DatetimeIndex(ds.init_time.values)
+
+    con = sqlite3.connect(metrics_db)
+    _create_tables(con)
+    _check_config(
+        con,
+        metrics_db,
+        {"forecast_path": forecast_path, "variable": variable, "init_time_block": init_time_block},
+    )
+    _write_regions(con, ds, y_chunks, x_chunks)
+
+    completed = {r[0] for r in con.execute("SELECT init_block_start FROM completed_blocks")}
+    blocks = [
+        (start, min(start + init_time_block, len(init_times)))
+        for start in range(0, len(init_times), init_time_block)
+        if str(init_times[start]) not in completed
+    ]
+    print(f"Scoring {len(blocks)} blocks ({len(completed)} already complete)")
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(forecast_path, obs_paths),
+    ) as executor:
+
+        # Only keep a limited number of blocks in flight so the results don't pile up in memory
+        pending = set()
+        blocks_iter = iter(blocks)
+        pbar = tqdm(total=len(blocks))
+
+        while True:
+            for block in blocks_iter:
+                pending.add(executor.submit(score_block, block, y_chunks, x_chunks, variable))
+                if len(pending) >= 2 * num_workers:
+                    break
+
+            if len(pending) == 0:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                df = future.result()
+                df.to_sql("errors", con, if_exists="append", index=False)
+                con.execute(
+                    "INSERT INTO completed_blocks VALUES (?)", (df.init_block_start.iloc[0],)
+                )
+                con.commit()
+                pbar.update()
+
+        pbar.close()
+
+    df_step = pd.read_sql(
+        """
+        SELECT step_mins,
+            SUM(sum_abs_error) / SUM(count) AS mae,
+            SUM(sum_sq_error) / SUM(count) AS mse
+        FROM errors GROUP BY step_mins ORDER BY step_mins
+        """,
+        con,
+    )
+    con.close()
+
+    df_step["rmse"] = np.sqrt(df_step.pop("mse"))
+
+    print(df_step.to_string(index=False))
+
+
+if __name__ == "__main__":
+    typer.run(score_backtest)
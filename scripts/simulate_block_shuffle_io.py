@@ -0,0 +1,194 @@
+"""Report the zarr I/O saved by block-shuffled sampling with a per-worker chunk cache
+
+The chunk reads of an epoch are simulated from the dataset index and the zarr chunk layout, so no
+satellite data is loaded. Uniform shuffling without a cache, which is how the default datamodule
+loads samples, is compared against uniform shuffling with a chunk cache and block shuffling with
+a range of block sizes. For each setup this reports the decoded chunks and data read per sample,
+the I/O reduction against the default, and the mean number of distinct days in each batch as a
+measure of how random the batches are.
+
+Optionally the cached dataset is also timed on real samples.
+
+use:
+python scripts/simulate_block_shuffle_io.py --num-workers=8 --block-chunks 1 2 4 8
+"""
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+import typer
+from omegaconf import OmegaConf
+
+from sat_pred.dataset import ChunkCacheSatelliteDataset, IndexedSatelliteDataset
+from sat_pred.samplers import ChunkBlockShuffleSampler, time_chunk_ids
+
+
+def _sample_chunks(dataset: IndexedSatelliteDataset) -> tuple[list[range], np.ndarray]:
+    """Find the time chunks each sample reads and the decoded size of each chunk"""
+    ds = dataset.ds
+    times = ds.get_index("time")
+    chunk_ids = time_chunk_ids(ds, times)
+
+    starts = times.get_indexer(dataset.t0_times - np.timedelta64(dataset.history_mins, "m"))
+    ends = times.get_indexer(dataset.t0_times + np.timedelta64(dataset.forecast_mins, "m"))
+    sample_chunks = [range(chunk_ids[s], chunk_ids[e] + 1) for s, e in zip(starts, ends)]
+
+    frame_bytes = ds.data.isel(time=0).nbytes
+    chunk_bytes = np.bincount(chunk_ids) * frame_bytes
+    return sample_chunks, chunk_bytes
+
+
+def _simulate(
+    order: list[int],
+    sample_chunks: list[range],
+    chunk_bytes: np.ndarray,
+    t0_times,
+    batch_size: int,
+    num_workers: int,
+    cache_chunks: int,
+) -> dict[str, float]:
+    """Count the chunk reads when each worker loads its batches with an LRU chunk cache"""
+    caches = [OrderedDict() for _ in range(max(1, num_workers))]
+    reads, read_bytes, days_per_batch = 0, 0, []
+
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    for batch_num, batch in enumerate(batches):
+        cache = caches[batch_num % len(caches)]
+        days_per_batch.append(len(set(t0_times[batch].date)))
+
+        for idx in batch:
+            # Without a cache the chunks are still only read once per sample
+            sample_cache = cache if cache_chunks > 0 else OrderedDict()
+            for chunk in sample_chunks[idx]:
+                if chunk in sample_cache:
+                    sample_cache.move_to_end(chunk)
+                    continue
+                reads += 1
+                read_bytes += chunk_bytes[chunk]
+                sample_cache[chunk] = None
+                if cache_chunks > 0 and len(sample_cache) > cache_chunks:
+                    sample_cache.popitem(last=False)
+
+    return {
+        "chunks/sample": reads / len(order),
+        "MB/sample": read_bytes / len(order) / 1e6,
+        "days/batch": np.mean(days_per_batch),
+    }
+
+
+def _time_samples(dataset, sampler, num_samples: int) -> float:
+    indices = list(sampler)[:num_samples]
+    start = time.perf_counter()
+    for idx in indices:
+        dataset[idx]
+    return (time.perf_counter() - start) / len(indices)
+
+
+def simulate_block_shuffle_io(
+    data_config_path: str = "configs/datamodule/default.yaml",
+    num_workers: int = 8,
+    batch_size: int = 4,
+    block_chunks: list[int] = [1, 2, 4, 8],
+    cache_chunks: int = 4,
+    seed: int = 0,
+    measure_samples: int = 0,
+):
+    """Simulate an epoch of chunk reads for uniform and block-shuffled sampling
+
+    Args:
+        data_config_path: The datamodule config with the data paths and sample options
+        num_workers: The number of dataloader workers
+        batch_size: The batch size
+        block_chunks: The block sizes to compare, in zarr time chunks
+        cache_chunks: The number of decoded time chunks each worker keeps in memory
+        seed: The random seed
+        measure_samples: If above zero, also time loading this many real samples in a single
+            process with and without block shuffling
+    """
+    config = OmegaConf.to_container(OmegaConf.load(data_config_path))
+    dataset_kwargs = dict(
+        zarr_path=config["zarr_path"],
+        start_time=config["train_period"][0],
+        end_time=config["train_period"][1],
+        history_mins=config["history_mins"],
+        forecast_mins=config["forecast_mins"],
+        sample_freq_mins=config["sample_freq_mins"],
+        nan_to_num=config["nan_to_num"],
+        index_cache_dir=config.get("index_cache_dir"),
+    )
+    dataset = IndexedSatelliteDataset(**dataset_kwargs)
+    sample_chunks, chunk_bytes = _sample_chunks(dataset)
+    t0_chunks = np.array([c[0] for c in sample_chunks])
+
+    rng = np.random.default_rng(seed)
+    uniform_order = rng.permutation(len(dataset)).tolist()
+    samplers = {
+        n: ChunkBlockShuffleSampler(
+            t0_chunks,
+            block_chunks=n,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            num_replicas=1,
+            rank=0,
+            seed=seed,
+        )
+        for n in block_chunks
+    }
+
+    setups = {
+        "uniform": (uniform_order, 0),
+        f"uniform + cache {cache_chunks}": (uniform_order, cache_chunks),
+        **{
+            f"block {n} + cache {cache_chunks}": (list(sampler), cache_chunks)
+            for n, sampler in samplers.items()
+        },
+    }
+
+    results = {}
+    for name, (order, cache_size) in setups.items():
+        results[name] = _simulate(
+            order,
+            sample_chunks,
+            chunk_bytes,
+            dataset.t0_times,
+            batch_size,
+            num_workers,
+            cache_size,
+        )
+
+    baseline = results["uniform"]["chunks/sample"]
+    print(f"\n{len(dataset)} samples, {len(chunk_bytes)} time chunks")
+    print(f"{'setup':<24} {'chunks/sample':>14} {'MB/sample':>10} {'I/O reduction':>14} "
+          f"{'days/batch':>11}")
+    for name, result in results.items():
+        print(
+            f"{name:<24} {result['chunks/sample']:>14.2f} {result['MB/sample']:>10.1f} "
+            f"{baseline / result['chunks/sample']:>13.1f}x {result['days/batch']:>11.2f}"
+        )
+
+    if measure_samples > 0:
+        cached_dataset = ChunkCacheSatelliteDataset(
+            **dataset_kwargs, cache_chunks=cache_chunks
+        )
+        uniform_time = _time_samples(dataset, uniform_order, measure_samples)
+        # A single process loads every batch, so use a single stream of blocks
+        block_sampler = ChunkBlockShuffleSampler(
+            t0_chunks,
+            block_chunks=block_chunks[0],
+            batch_size=batch_size,
+            num_workers=0,
+            num_replicas=1,
+            rank=0,
+            seed=seed,
+        )
+        block_time = _time_samples(cached_dataset, block_sampler, measure_samples)
+        print(
+            f"\nMeasured over {measure_samples} samples: uniform {uniform_time:.3f} s/sample, "
+            f"block {block_chunks[0]} + cache {block_time:.3f} s/sample, "
+            f"{cached_dataset.chunk_misses} chunk reads and {cached_dataset.chunk_hits} cache hits"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(simulate_block_shuffle_io)
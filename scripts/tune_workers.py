@@ -0,0 +1,189 @@
+"""Tune the torch threads, dataloader workers and batch size for running a model on this host
+
+Short trials run the model over satellite samples and measure the throughput in samples per
+second. The torch threads, number of workers, prefetch factor and batch size are tuned one at a
+time, keeping the others at their best values so far, over a number of rounds. With
+`--pin-cores` the main process and each worker are pinned to their own cores in every trial.
+
+The best settings are saved as a runtime config which can be passed to `scripts/backtest.py`,
+`scripts/validate_model.py` and `sat_pred/train.py`. See `sat_pred/runtime.py`.
+
+use:
+python scripts/tune_workers.py path/to/checkpoint_dir runtime.yaml --pin-cores \
+    --zarr-path=/mnt/disks/sat_data/sat_data_all/2016_training_nonhrv.zarr
+"""
+
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import typer
+from cloudcasting.dataset import SatelliteDataset
+from torch.utils.data import DataLoader, Subset
+
+from sat_pred.inference import load_model
+from sat_pred.runtime import RuntimeConfig, available_cores
+
+
+PARAMETERS = ["torch_threads", "num_workers", "prefetch_factor", "batch_size"]
+
+
+def _powers_of_two(maximum: int, start: int = 1) -> list[int]:
+    values = [start]
+    while values[-1] * 2 <= maximum:
+        values.append(values[-1] * 2)
+    return values
+
+
+def _trial(
+    model: torch.nn.Module,
+    dataset: SatelliteDataset,
+    indices: np.ndarray,
+    config: RuntimeConfig,
+    device: torch.device,
+    num_batches: int,
+    warmup_batches: int,
+) -> float:
+    """Measure the throughput in samples per second of the model and dataloader"""
+    config.apply()
+    dataloader = DataLoader(
+        Subset(dataset, indices[:config.batch_size * (warmup_batches + num_batches)].tolist()),
+        batch_size=config.batch_size,
+        shuffle=False,
+        **config.dataloader_kwargs(),
+    )
+
+    num_samples = 0
+    start = None
+    with torch.no_grad():
+        for i, (X, _) in enumerate(dataloader):
+            if i == warmup_batches:
+                # The worker startup and first batches are excluded
+                start = time.perf_counter()
+            model(X.to(device))
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            if i >= warmup_batches:
+                num_samples += len(X)
+
+    return num_samples / (time.perf_counter() - start)
+
+
+def tune_workers(
+    checkpoint_dir_path: str,
+    output_path: str,
+    zarr_path: list[str] | None = None,
+    device: str = "cpu",
+    torch_threads: list[int] | None = None,
+    num_workers: list[int] | None = None,
+    prefetch_factor: list[int] | None = None,
+    batch_size: list[int] | None = None,
+    pin_cores: bool = False,
+    num_batches: int = 10,
+    warmup_batches: int = 2,
+    rounds: int = 2,
+    seed: int = 0,
+):
+    """Find the settings with the highest throughput and save them as a runtime config
+
+    Args:
+        checkpoint_dir_path: The checkpoint directory of the model
+        output_path: The YAML file to save the runtime config to
+        zarr_path: The satellite data to load samples from. Defaults to the data the model was
+            trained on, over its validation period
+        device: The device to run the model on
+        torch_threads: The torch thread counts to try. Defaults to powers of two up to the number
+            of available cores
+        num_workers: The dataloader worker counts to try. Defaults to 0 and powers of two up to
+            the number of available cores
+        prefetch_factor: The prefetch factors to try
+        batch_size: The batch sizes to try
+        pin_cores: Whether to pin the main process and each worker to their own cores
+        num_batches: The number of batches timed in each trial
+        warmup_batches: The number of batches run before timing each trial
+        rounds: The number of times to tune each setting in turn
+        seed: The random seed used to select the samples. The same samples are used in every
+            trial
+    """
+    num_cores = len(available_cores())
+    candidates = {
+        "torch_threads": torch_threads or _powers_of_two(num_cores),
+        "num_workers": num_workers or [0, *_powers_of_two(num_cores, start=2)],
+        "prefetch_factor": prefetch_factor or [2, 4],
+        "batch_size": batch_size or [1, 2, 4, 8],
+    }
+
+    device = torch.device(device)
+    model, _, data_config = load_model(checkpoint_dir_path, device=device)
+    model = model.eval()
+
+    dataset = SatelliteDataset(
+        zarr_path=zarr_path or data_config["zarr_path"],
+        start_time=None if zarr_path else data_config["val_period"][0],
+        end_time=None if zarr_path else data_config["val_period"][1],
+        history_mins=data_config["history_mins"],
+        forecast_mins=data_config["forecast_mins"],
+        sample_freq_mins=data_config["sample_freq_mins"],
+        nan_to_num=data_config["nan_to_num"],
+    )
+
+    # Random samples spread over the period, so the trials don't all read the same chunks
+    num_samples = max(candidates["batch_size"]) * (warmup_batches + num_batches)
+    indices = np.random.default_rng(seed).permutation(len(dataset))[:num_samples]
+
+    # Trials change the affinity of this process, so it is restored afterwards
+    original_cores = available_cores()
+
+    # Start from the middle of each range of candidates
+    best = {name: values[len(values) // 2] for name, values in candidates.items()}
+    results = {}
+
+    print(f"{'threads':>9}{'workers':>9}{'prefetch':>9}{'batch':>9}{'samples/s':>11}")
+    for _ in range(rounds):
+        for name in PARAMETERS:
+            for value in candidates[name]:
+                settings = {**best, name: value}
+                key = tuple(settings[p] for p in PARAMETERS)
+                if key not in results:
+                    config = RuntimeConfig(**settings, pin_cores=pin_cores)
+                    try:
+                        results[key] = _trial(
+                            model, dataset, indices, config, device, num_batches, warmup_batches
+                        )
+                    except torch.cuda.OutOfMemoryError:
+                        results[key] = 0.0
+                    finally:
+                        if hasattr(os, "sched_setaffinity"):
+                            os.sched_setaffinity(0, original_cores)
+                    print("".join(f"{v:>9}" for v in key) + f"{results[key]:>11.2f}")
+
+            best[name] = max(
+                candidates[name],
+                key=lambda v: results[tuple({**best, name: v}[p] for p in PARAMETERS)],
+            )
+
+    throughputs = np.array(list(results.values()))
+    config = RuntimeConfig(
+        **best,
+        pin_cores=pin_cores,
+        throughput=results[tuple(best[p] for p in PARAMETERS)],
+        metadata={
+            "host": socket.gethostname(),
+            "num_cores": num_cores,
+            "device": str(device),
+            "checkpoint": checkpoint_dir_path,
+        },
+    )
+    config.save(output_path)
+
+    print(
+        f"\nBest: {best} at {config.throughput:.2f} samples/s, "
+        f"{config.throughput / np.median(throughputs):.2f}x the median trial"
+    )
+    print(f"Saved to {output_path}")
+
+
+if __name__ == "__main__":
+    typer.run(tune_workers)
@@ -7,10 +7,15 @@ import hydra
 import torch
 from pyaml_env import parse_config
 
+from sat_pred.compilation import compile_model
+from sat_pred.runtime import load_runtime_config
+
 
 checkpoint = "/home/jamesfulton/repos/sat_pred/checkpoints/ob9v9128"
 WANDB_PROJECT = "cloudcasting"
 WANDB_RUN_NAME = "simVP_2008-2016"
+# The torch threads, dataloader workers and batch size tuned by scripts/tune_workers.py
+RUNTIME_CONFIG = None
 
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -63,15 +68,25 @@ def get_model_from_checkpoints(
 class MLModel(AbstractModel):
     """A persistence model which predicts a blury version of the most recent frame"""
 
-    def __init__(self, checkpoint_dir_path: str) -> None:
+    def __init__(
+        self,
+        checkpoint_dir_path: str,
+        compile: bool = False,
+        compile_cache_dir: str | None = "~/.cache/sat_pred/torch_compile",
+    ) -> None:
 
         
-        model, model_config, data_config = get_model_from_checkpoints(checkpoint)
+        model, model_config, data_config = get_model_from_checkpoints(checkpoint_dir_path)
         
         super().__init__(history_steps=12)
 
 
         self.model = model.to(DEVICE)
+
+        if compile:
+            # Mark the batch dimension as dynamic up-front since the last batch is often partial
+            compile_model(self.model, cache_dir=compile_cache_dir, dynamic=True)
+
         self.model_config = model_config
         self.data_config = data_config
         self.checkpoint_dir_path = checkpoint_dir_path
@@ -102,6 +117,15 @@ class MLModel(AbstractModel):
 
 if __name__=="__main__":
 
+    if RUNTIME_CONFIG is not None:
+        # The validation dataloader is built by cloudcasting, so the workers can't be pinned.
+        # They would inherit the cores of this process, so it isn't pinned either
+        runtime = load_runtime_config(RUNTIME_CONFIG)
+        runtime.apply(pin=False)
+        batch_size, num_workers = runtime.batch_size, runtime.num_workers
+    else:
+        batch_size, num_workers = 2, 10
+
     model = MLModel(checkpoint)
 
     validate(
@@ -109,8 +133,8 @@ if __name__=="__main__":
         data_path="/mnt/disks/sat_data_all/2022_test_nonhrv.zarr",
         wandb_project_name=WANDB_PROJECT,
         wandb_run_name=WANDB_RUN_NAME,
-        batch_size = 2,
-        num_workers = 10,
+        batch_size = batch_size,
+        num_workers = num_workers,
         batch_limit = None,
         nan_to_num = model.data_config['nan_to_num']
     )